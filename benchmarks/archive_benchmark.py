@@ -0,0 +1,123 @@
+"""
+ローカルの足のアーカイブ(src/tools/candle-archive/archive.py)のベンチマーク
+
+合成した1分足(1e5〜1e7件)を1回当たりchunk件ずつ追記し、以下を計測する。
+・追記の処理件数(rows/sec)
+・全件の読み込みと終値の合計(ファイルを全て読み込む)の実行時間
+・ランダムな1日分の範囲の読み込みの1回当たりの実行時間
+範囲の読み込み結果が、全件から絞り込んだ結果と一致することも併せて確認する。
+
+実行方法(リポジトリのルートで実行する)
+    pip install -r src/tools/candle-archive/requirements.txt
+    python benchmarks/archive_benchmark.py
+    python benchmarks/archive_benchmark.py --sizes 1000000 --chunk 720
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root_dir, "src", "tools", "candle-archive"))
+
+from archive import CandleArchive  # noqa: E402
+
+
+def create_df(start, rows, seed=0):
+    """
+    start番目の足から、アップロード形式の1分足のデータフレームを生成する
+    """
+    rng = np.random.default_rng(seed + start)
+    times = (start + np.arange(rows, dtype="int64")) * 60
+    close = 100 + rng.standard_normal(rows).cumsum()
+    return pd.DataFrame({
+        "UNIX_TIME": times,
+        "OPEN_PRICE": close,
+        "HIGH_PRICE": close + 1,
+        "LOW_PRICE": close - 1,
+        "CLOSE_PRICE": close,
+        "VOLUME": rng.random(rows),
+        "QUOTE_VOLUME": 0.0,
+        "CLOSE_TIME": pd.to_datetime(times, unit="s", utc=True)
+    })
+
+
+def run(size, chunk, reads):
+    with tempfile.TemporaryDirectory() as root:
+        archive = CandleArchive(root)
+
+        # 追記する足はあらかじめ生成し、追記のみを計測する
+        chunks = [
+            create_df(start, min(chunk, size - start))
+            for start in range(0, size, chunk)
+        ]
+        start = time.perf_counter()
+        for df in chunks:
+            archive.append("BENCH_1M", df)
+        append_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        total = archive.read("BENCH_1M")["CLOSE_PRICE"].sum()
+        full_seconds = time.perf_counter() - start
+
+        # ランダムな1日分(1440件)の範囲を読み込む
+        rng = np.random.default_rng(0)
+        starts = rng.integers(0, size * 60, reads)
+        start = time.perf_counter()
+        for range_start in starts:
+            archive.read("BENCH_1M", range_start, range_start + 86400)
+        range_seconds = (time.perf_counter() - start) / reads
+
+        times = np.asarray(archive.read("BENCH_1M")["UNIX_TIME"])
+        for range_start in starts[:100]:
+            records = archive.read(
+                "BENCH_1M", range_start, range_start + 86400
+            )
+            expected = times[
+                (times >= range_start) & (times < range_start + 86400)
+            ]
+            if not np.array_equal(records["UNIX_TIME"], expected):
+                raise Exception(f"range mismatch: start={range_start}")
+
+        return {
+            "rows": size,
+            "append_rows_per_sec": size / append_seconds,
+            "full_read_seconds": full_seconds,
+            "range_read_ms": range_seconds * 1000,
+            "close_sum": total,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100_000, 1_000_000, 10_000_000]
+    )
+    # 1回に追記する足の件数
+    parser.add_argument("--chunk", type=int, default=100_000)
+    # ランダムな範囲を読み込む回数
+    parser.add_argument("--reads", type=int, default=1000)
+    args = parser.parse_args()
+
+    print(
+        f"{'rows':>12} {'append rows/sec':>16} "
+        f"{'full read (s)':>14} {'1 day read (ms)':>16}"
+    )
+    for size in args.sizes:
+        result = run(size, args.chunk, args.reads)
+        print(
+            f"{result['rows']:>12,} {result['append_rows_per_sec']:>16,.0f} "
+            f"{result['full_read_seconds']:>14.4f} "
+            f"{result['range_read_ms']:>16.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
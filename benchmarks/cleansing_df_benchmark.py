@@ -0,0 +1,158 @@
+"""
+yfinance系collectorのcleansing_dfのマイクロベンチマーク
+
+合成したyfinance形式のデータフレーム(1e3〜1e7行)に対してcleansing_dfを実行し、
+1秒当たりの処理行数(rows/sec)を計測する。
+旧実装(applyによる行単位のunixtime変換)と出力が一致することも併せて確認する。
+
+実行方法(リポジトリのルートで実行する)
+    pip install -r src/functions/stock-collector/requirements.txt
+    python benchmarks/cleansing_df_benchmark.py
+    python benchmarks/cleansing_df_benchmark.py --sizes 1000 100000 --repeat 5
+"""
+import argparse
+import importlib.util
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# デプロイ時に各関数へコピーする共通モジュール
+shared_dir = os.path.join(root_dir, "src", "shared")
+
+
+def load_collector(function_name):
+    """
+    src/functions/<function_name>/main.pyをモジュールとして読み込む
+    """
+    function_dir = os.path.join(root_dir, "src", "functions", function_name)
+    # main.pyと同じディレクトリのモジュールと、共通モジュールを読み込めるようにする
+    for path in (shared_dir, function_dir):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    path = os.path.join(function_dir, "main.py")
+    spec = importlib.util.spec_from_file_location(
+        function_name.replace("-", "_"), path
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def create_yfinance_df(rows, seed=0):
+    """
+    yf.downloadの戻り値と同じ形式(1分足)の合成データフレームを生成する
+    """
+    rng = np.random.default_rng(seed)
+    index = pd.date_range(
+        "2000-01-03 09:30",
+        periods=rows,
+        freq="min",
+        tz="America/New_York",
+        name="Datetime"
+    )
+    close = 100 + rng.standard_normal(rows).cumsum()
+    return pd.DataFrame({
+        "Open": close + rng.standard_normal(rows),
+        "High": close + 1,
+        "Low": close - 1,
+        "Close": close,
+        "Volume": rng.integers(0, 10_000, rows)
+    }, index=index)
+
+
+def legacy_cleansing_df(module, df: pd.DataFrame, target_unixtime):
+    """
+    ベクトル化前のcleansing_df(出力一致の確認用)
+    """
+    if len(df) < 2:
+        return pd.DataFrame()
+
+    df = df.sort_index(ascending=True)
+    df = df[:-1]
+
+    index_name = df.index.name
+    df = df.reset_index()
+    df = df.rename(columns={index_name: "CLOSE_TIME"})
+
+    df["UNIX_TIME"] = df["CLOSE_TIME"].apply(lambda x: int(x.timestamp()))
+    df["CLOSE_TIME"] = pd.to_datetime(df["UNIX_TIME"], unit="s", utc=True)
+    df = df.rename(columns={
+        "Open": module.OPEN,
+        "High": module.HIGH,
+        "Low": module.LOW,
+        "Close": module.CLOSE,
+        "Volume": module.VOLUME
+    })
+    df[module.QUOTE_VOLUME] = 0
+    df[module.float_columns] = df[module.float_columns].astype("float")
+
+    if target_unixtime != 0:
+        df = df.query(f'UNIX_TIME > {target_unixtime}')
+
+    return df
+
+
+def measure(func, repeat):
+    """
+    funcを複数回実行し、最短の実行時間(秒)を返す
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    # 旧実装は遅いため、この行数以下の場合のみ計測・比較する
+    parser.add_argument("--legacy-max-rows", type=int, default=10 ** 5)
+    parser.add_argument("--collector", default="stock-collector")
+    args = parser.parse_args()
+
+    # 整理・正規化はyfinance系collectorの共通モジュールで行う
+    collector = load_collector(args.collector)
+    module = sys.modules[collector.YfinanceSource.__module__]
+
+    print(f"{'rows':>10} {'target':>6} {'rows/sec':>14} {'legacy rows/sec':>16}")
+    for rows in args.sizes:
+        df = create_yfinance_df(rows)
+        # 初回取得(unixtime=0)と、半分のデータが取得済みの場合の両方を計測する
+        middle = int(df.index[rows // 2].timestamp())
+        for label, target_unixtime in [("0", 0), ("half", middle)]:
+            elapsed = measure(
+                lambda: module.cleansing_df(df, target_unixtime), args.repeat
+            )
+
+            legacy = "-"
+            if rows <= args.legacy_max_rows:
+                expected = legacy_cleansing_df(module, df, target_unixtime)
+                actual = module.cleansing_df(df, target_unixtime)
+                pd.testing.assert_frame_equal(
+                    actual.reset_index(drop=True),
+                    expected[actual.columns].reset_index(drop=True)
+                )
+                legacy_elapsed = measure(
+                    lambda: legacy_cleansing_df(module, df, target_unixtime),
+                    args.repeat
+                )
+                legacy = f"{rows / legacy_elapsed:,.0f}"
+
+            print(f"{rows:>10} {label:>6} {rows / elapsed:>14,.0f} {legacy:>16}")
+
+
+if __name__ == "__main__":
+    main()
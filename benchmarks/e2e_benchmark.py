@@ -0,0 +1,457 @@
+"""
+パイプライン全体のオフラインベンチマーク
+
+kraken API, yahoo finance, GCS, BigQuery, Pub/Sub, collectorのHTTPエンドポイントを
+ローカルの代替(benchmarks/fakes.py)へ差し替え、各関数を実際のコードのまま実行する。
+取得対象の系列数(銘柄×時間足)を増やしながら、関数ごとに以下を計測する。
+・1秒当たりの処理系列数(series/sec)
+・処理段階(unixtime取得・データ取得・整理・アップロード・unixtime更新など)ごとの実行時間
+・ピークメモリ(tracemallocで計測したPythonのメモリ確保量)
+
+実行方法(リポジトリのルートで実行する)
+    pip install -r src/functions/crypto-collector/requirements.txt \
+        -r src/functions/stock-collector/requirements.txt \
+        -r src/functions/csv-to-bigquery/requirements.txt \
+        -r src/functions/market-collector/requirements.txt
+    python benchmarks/e2e_benchmark.py
+    python benchmarks/e2e_benchmark.py --series 32 320 3200 --bars 720 \
+        --api-latency 0.05 --gcs-latency 0.02 --bigquery-latency 0.5
+    python benchmarks/e2e_benchmark.py --functions crypto-collector \
+        --format parquet --json result.json
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import ExitStack
+from functools import wraps
+from threading import Lock
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cleansing_df_benchmark import load_collector  # noqa: E402
+from fakes import (  # noqa: E402
+    FakeBigQueryClient,
+    FakeFunctionServer,
+    FakeKrakenSession,
+    FakePublisherClient,
+    FakeStorage,
+    FakeYfinance,
+    Latency,
+    create_id_token
+)
+
+
+# 代替バックエンドを使うため、各関数の環境変数にはダミーの値を設定する
+benchmark_env = {
+    "GCP_PROJECT_ID": "benchmark",
+    "BIGQUERY_DATASET": "benchmark",
+    "MARKET_DATA_BUCKET": "benchmark-market-data",
+    "BIGQUERY_UNIXTIME_TABLE": "RECENTLY_UNIXTIME",
+    "ERROR_REPORT_TOPIC": "error-report",
+}
+
+# yfinance系collectorと、取得元のクラス名
+yfinance_collectors = {
+    "stock-collector": "StockSource",
+    "fx-collector": "FxSource",
+    "commodity-collector": "CommoditySource",
+}
+# collectorごとの取得元のクラス名
+source_classes = {
+    "crypto-collector": "CryptoSource",
+    **yfinance_collectors
+}
+
+# 処理段階ごとの実行時間を計測する関数
+collector_stages = [
+    "load_recently_unixtime",
+    "request_crypto_watch_api",
+    "request_yfinance",
+    "request_yfinance_batch",
+    "cleansing_df",
+    "cleansing_batch_df",
+    "resample_candles",
+    "upload_df_to_gcs",
+    "upload_run_manifest",
+    "save_resample_state",
+    "save_unixtime_manifest",
+    "update_recently_unixtime",
+]
+loader_stages = [
+    "load_run_manifest",
+    "merge_groups",
+    "get_table",
+]
+
+all_functions = [
+    "crypto-collector",
+    "stock-collector",
+    "fx-collector",
+    "commodity-collector",
+    "csv-to-bigquery",
+    "market-collector",
+]
+
+
+class StageTimer:
+    """
+    関数を差し替えて、呼び出し回数と実行時間の合計を処理段階ごとに集計する
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = Lock()
+
+    def wrap(self, stack: ExitStack, module, names):
+        for name in names:
+            func = getattr(module, name, None)
+            if func is None:
+                continue
+            stack.enter_context(
+                mock.patch.object(module, name, self.timed(name, func))
+            )
+
+    def timed(self, name, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+        return wrapper
+
+    def add(self, name, elapsed):
+        with self.lock:
+            calls, total = self.stages.get(name, (0, 0.0))
+            self.stages[name] = (calls + 1, total + elapsed)
+
+
+class Backends:
+    """
+    1回の計測で共有する代替バックエンド
+    """
+
+    def __init__(self, args):
+        self.latency = Latency(
+            api=args.api_latency,
+            gcs=args.gcs_latency,
+            bigquery=args.bigquery_latency,
+            function=args.function_latency
+        )
+        self.storage = FakeStorage(self.latency)
+        self.bigquery = FakeBigQueryClient(self.latency)
+        self.publisher = FakePublisherClient()
+        self.kraken = FakeKrakenSession(self.latency, args.bars)
+        self.yfinance = FakeYfinance(self.latency, args.bars)
+
+
+def patch_collector(stack: ExitStack, module, backends: Backends, args):
+    """
+    collectorのクライアント・取得元を代替バックエンドへ差し替える
+    """
+    pipeline = get_pipeline(module)
+    clients = {
+        "get_bigquery_client": lambda: backends.bigquery,
+        "get_bucket": lambda: backends.storage.bucket(pipeline.bucket_name),
+        "get_publisher_client": lambda: backends.publisher
+    }
+    stack.enter_context(mock.patch.multiple(
+        pipeline, output_format=args.format, **clients
+    ))
+    # main.pyへimportしたクライアントの取得関数も差し替える
+    for name, func in clients.items():
+        if hasattr(module, name):
+            stack.enter_context(mock.patch.object(module, name, func))
+
+    # レート制限は取得元の代替では不要なため、指定が無い場合は制限しない
+    rate = args.api_rate or 1e9
+    # 共通モジュールはload_collectorで読み込めるようになる
+    from ratelimit import RateLimiter
+    limiter = RateLimiter(rate, max(rate, 1))
+    if hasattr(module, "session"):
+        stack.enter_context(mock.patch.multiple(
+            module,
+            session=backends.kraken,
+            kraken_limiter=limiter,
+            fetch_concurrency=args.concurrency,
+            resample_mode=args.resample
+        ))
+    else:
+        stack.enter_context(mock.patch.multiple(
+            get_source_module(module),
+            yf=backends.yfinance,
+            yahoo_limiter=limiter,
+            batch_download=not args.no_batch_download
+        ))
+
+
+def get_pipeline(module):
+    """
+    collectorが使用するパイプライン(pipeline.py)のモジュールを返す
+    """
+    return sys.modules[module.handle_request.__module__]
+
+
+def get_source_module(module):
+    """
+    取得元の処理のモジュールを返す
+    (yfinance系collectorは共通モジュール(yfinance_source.py)、crypto-collectorはmain.py)
+    """
+    if hasattr(module, "YfinanceSource"):
+        return sys.modules[module.YfinanceSource.__module__]
+    return module
+
+
+def create_universe(function_name, module, series):
+    """
+    系列数(銘柄×時間足)がseries以上になるよう、合成した銘柄一覧を返す
+    """
+    count = math.ceil(series / len(get_source_module(module).periods))
+    if function_name == "crypto-collector":
+        return module, "tickers", [
+            {"table": f"PAIR{i:05d}", "ticker": f"PAIR{i:05d}",
+             "res_ticker": f"PAIR{i:05d}"}
+            for i in range(count)
+        ]
+    source = getattr(module, yfinance_collectors[function_name])
+    return source, "instruments", [
+        {"ticker": f"T{i:05d}", "name": f"T{i:05d}"} for i in range(count)
+    ]
+
+
+def run_measured(func, trace_memory):
+    """
+    funcを実行し、実行時間(秒)とピークメモリ(MB)を返す
+    """
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        func()
+    finally:
+        elapsed = time.perf_counter() - start
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            tracemalloc.stop()
+    return elapsed, peak
+
+
+def run_collector(function_name, module, backends, series, args):
+    timer = StageTimer()
+    with ExitStack() as stack:
+        patch_collector(stack, module, backends, args)
+        target, name, universe = create_universe(
+            function_name, module, series
+        )
+        stack.enter_context(mock.patch.object(target, name, universe))
+        timer.wrap(stack, get_source_module(module), collector_stages)
+        timer.wrap(stack, get_pipeline(module), collector_stages)
+
+        pipeline = get_pipeline(module)
+        source_class = getattr(module, source_classes[function_name])
+        series_count = len(universe) * len(
+            get_source_module(module).periods
+        )
+        if function_name == "crypto-collector" and args.resample:
+            series_count = len(universe) * (1 + len(module.resample_periods))
+
+        results = []
+        for run in range(args.runs):
+            timer.stages = {}
+            # 構造化ログは出力せず、処理段階ごとの実行時間はStageTimerで計測する
+            report = pipeline.RunReport(function_name, log_spans=False)
+
+            # シャードに分割する場合は、全シャードを順に実行する
+            def collect():
+                for index in range(args.shards):
+                    pipeline.run_collector(
+                        source_class(),
+                        report,
+                        {"index": index, "count": args.shards}
+                    )
+
+            elapsed, peak = run_measured(collect, not args.no_trace_memory)
+            results.append(create_result(
+                function_name, run, series_count, elapsed, peak, timer
+            ))
+    return results
+
+
+def run_loader(module, backends, args):
+    """
+    collectorがアップロードしたファイルを、GCSのfinalizeイベントの順にcsv-to-bigqueryへ渡す
+    """
+    timer = StageTimer()
+    events = list(backends.storage.events)
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch.multiple(
+            module,
+            get_bigquery_client=lambda: backends.bigquery,
+            get_storage_client=lambda: backends.storage,
+            get_publisher_client=lambda: backends.publisher,
+            # 全系列をまとめる構成は、csv-to-bigqueryと同様に常にまとめて取り込む
+            batch_load=(
+                args.load_batch or args.table_layout == "consolidated"
+            ),
+            merge_load=args.load_merge,
+            table_layout=args.table_layout
+        ))
+        stack.enter_context(mock.patch.dict(module.table_cache, clear=True))
+        timer.wrap(stack, module, loader_stages)
+
+        def load():
+            for bucket, name in events:
+                module.csv_to_bigquery({"bucket": bucket, "name": name})
+
+        elapsed, peak = run_measured(load, not args.no_trace_memory)
+
+    # 取り込み対象の系列数は、アップロードされたファイル数とする
+    files = sum(
+        1 for _, name in events if module.get_source_format(name) is not None
+    )
+    return [create_result(
+        "csv-to-bigquery", 0, files, elapsed, peak, timer
+    )]
+
+
+def run_dispatcher(module, backends, args):
+    """
+    market-collectorから、ローカルのcollectorのエンドポイントへリクエストする
+    """
+    timer = StageTimer()
+    server = FakeFunctionServer(backends.latency).start()
+    try:
+        with ExitStack() as stack:
+            stack.enter_context(mock.patch.multiple(
+                module,
+                collector_shards=args.shards,
+                id_token_cache={},
+                fetch_id_token=lambda request, audience: create_id_token(
+                    audience
+                ),
+                get_publisher_client=lambda: backends.publisher,
+                crypto_collector_endpoint=server.endpoint("crypto-collector"),
+                stock_collector_endpoint=server.endpoint("stock-collector"),
+                fx_collector_endpoint=server.endpoint("fx-collector"),
+                commodity_collector_endpoint=server.endpoint(
+                    "commodity-collector"
+                )
+            ))
+            elapsed, peak = run_measured(
+                module.market_collector, not args.no_trace_memory
+            )
+    finally:
+        server.stop()
+
+    return [create_result(
+        "market-collector", 0, server.requests, elapsed, peak, timer
+    )]
+
+
+def create_result(function_name, run, series, elapsed, peak, timer):
+    stages = {
+        name: {"calls": calls, "seconds": total}
+        for name, (calls, total) in timer.stages.items()
+    }
+    return {
+        "function": function_name,
+        "run": run,
+        "series": series,
+        "seconds": elapsed,
+        "series_per_sec": series / elapsed if elapsed > 0 else 0.0,
+        "peak_mb": peak,
+        "stages": stages,
+    }
+
+
+def print_results(size, results, backends):
+    print(f"\n== series={size} "
+          f"(gcs objects={len(backends.storage.objects)}, "
+          f"gcs bytes={backends.storage.total_bytes():,}, "
+          f"bq queries={backends.bigquery.queries}, "
+          f"bq load jobs={backends.bigquery.load_jobs})")
+    print(f"{'function':<22} {'run':>3} {'series':>7} {'seconds':>9} "
+          f"{'series/sec':>11} {'peak MB':>8}")
+    for result in results:
+        peak = "-" if result["peak_mb"] is None else f"{result['peak_mb']:.1f}"
+        print(f"{result['function']:<22} {result['run']:>3} "
+              f"{result['series']:>7} {result['seconds']:>9.3f} "
+              f"{result['series_per_sec']:>11,.1f} {peak:>8}")
+        for name, stage in result["stages"].items():
+            print(f"    {name:<28} {stage['calls']:>7} calls "
+                  f"{stage['seconds']:>9.3f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    # 関数ごとの取得対象の系列数(銘柄×時間足)
+    parser.add_argument("--series", type=int, nargs="+", default=[32, 320, 3200])
+    parser.add_argument("--functions", nargs="+", default=all_functions)
+    # 取得元が1系列当たりに返す足の本数
+    parser.add_argument("--bars", type=int, default=720)
+    # 1操作当たりの待ち時間(秒)
+    parser.add_argument("--api-latency", type=float, default=0.0)
+    parser.add_argument("--gcs-latency", type=float, default=0.0)
+    parser.add_argument("--bigquery-latency", type=float, default=0.0)
+    parser.add_argument("--function-latency", type=float, default=0.0)
+    # 取得元への1秒当たりのリクエスト数の上限(0の場合は制限しない)
+    parser.add_argument("--api-rate", type=float, default=0)
+    parser.add_argument("--concurrency", type=int, default=4)
+    # collectorのシャード数(market-collectorのCOLLECTOR_SHARDS)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--resample", action="store_true")
+    parser.add_argument("--no-batch-download", action="store_true")
+    parser.add_argument("--load-batch", action="store_true")
+    # csv-to-bigquery: 一時テーブルへ読み込んでからMERGEする
+    parser.add_argument("--load-merge", action="store_true")
+    # csv-to-bigquery: 金融データのテーブル構成(MARKET_TABLE_LAYOUT)
+    parser.add_argument(
+        "--table-layout", choices=["series", "consolidated"], default="series"
+    )
+    # 同じ代替バックエンドで繰り返し実行する回数(2回目以降は取得済みunixtimeがある状態)
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--no-trace-memory", action="store_true")
+    parser.add_argument("--json")
+    args = parser.parse_args()
+
+    for key, value in benchmark_env.items():
+        os.environ.setdefault(key, value)
+
+    modules = {name: load_collector(name) for name in args.functions}
+
+    report = []
+    for size in args.series:
+        backends = Backends(args)
+        results = []
+        for function_name, module in modules.items():
+            if function_name == "csv-to-bigquery":
+                continue
+            if function_name == "market-collector":
+                results += run_dispatcher(module, backends, args)
+                continue
+            results += run_collector(
+                function_name, module, backends, size, args
+            )
+
+        # csv-to-bigqueryは全collectorのアップロード後に取り込む
+        if "csv-to-bigquery" in modules:
+            results += run_loader(modules["csv-to-bigquery"], backends, args)
+
+        print_results(size, results, backends)
+        report.append({"series": size, "results": results})
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
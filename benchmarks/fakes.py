@@ -0,0 +1,466 @@
+"""
+ベンチマーク用のローカルの代替バックエンド(kraken API, yahoo finance, GCS, BigQuery, Pub/Sub)
+
+いずれも外部サービスへは接続せず、メモリ上で動作する。
+各操作には設定した待ち時間(秒)を入れ、ネットワーク越しの呼び出しを模擬する。
+"""
+import asyncio
+import base64
+import io
+import json
+import threading
+import time
+import numpy as np
+import pandas as pd
+from aiohttp import web
+from google.api_core.exceptions import PreconditionFailed
+
+
+class Latency:
+    """
+    バックエンドごとの1操作当たりの待ち時間(秒)
+    """
+
+    def __init__(self, api=0.0, gcs=0.0, bigquery=0.0, function=0.0):
+        self.api = api
+        self.gcs = gcs
+        self.bigquery = bigquery
+        self.function = function
+
+
+class FakeStorage:
+    """
+    GCSの代替(オブジェクトを世代番号付きでメモリ上に保持する)
+    """
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.objects = {}
+        # 書き込まれた順のオブジェクト名(GCSのfinalizeイベントの代わり)
+        self.events = []
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    def bucket(self, name):
+        return FakeBucket(self, name)
+
+    def put(self, bucket_name, name, data, if_generation_match=None):
+        time.sleep(self.latency.gcs)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self.lock:
+            current = self.objects.get((bucket_name, name))
+            current_generation = current[1] if current else 0
+            if (
+                if_generation_match is not None
+                and if_generation_match != current_generation
+            ):
+                raise PreconditionFailed(f"{name}: generation mismatch")
+            self.generation += 1
+            self.objects[(bucket_name, name)] = (data, self.generation)
+            self.events.append((bucket_name, name))
+            return self.generation
+
+    def get(self, bucket_name, name):
+        time.sleep(self.latency.gcs)
+        with self.lock:
+            return self.objects.get((bucket_name, name))
+
+    def total_bytes(self):
+        with self.lock:
+            return sum(len(data) for data, _ in self.objects.values())
+
+
+class FakeBucket:
+    def __init__(self, storage: FakeStorage, name):
+        self.storage = storage
+        self.name = name
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        stored = self.storage.get(self.name, name)
+        if stored is None:
+            return None
+        blob = FakeBlob(self, name)
+        blob.generation = stored[1]
+        return blob
+
+
+class FakeBlob:
+    def __init__(self, bucket: FakeBucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+
+    def upload_from_string(
+        self, data, content_type=None, if_generation_match=None
+    ):
+        # GCSと同様に、アップロード後の世代番号をblobへ設定する
+        self.generation = self.bucket.storage.put(
+            self.bucket.name, self.name, data, if_generation_match
+        )
+
+    def download_as_bytes(self, if_generation_match=None):
+        stored = self.bucket.storage.get(self.bucket.name, self.name)
+        if stored is None or (
+            if_generation_match is not None
+            and if_generation_match != stored[1]
+        ):
+            raise PreconditionFailed(f"{self.name}: generation mismatch")
+        return stored[0]
+
+    def open(self, mode="r", chunk_size=None, ignore_flush=None, **kwargs):
+        writer = FakeBlobWriter(self)
+        if mode in ("w", "wt"):
+            return io.TextIOWrapper(writer, encoding="utf-8")
+        return writer
+
+
+class FakeBlobWriter(io.RawIOBase):
+    """
+    blob.open()の代替(閉じた時点でオブジェクトを保存する)
+    """
+
+    def __init__(self, blob: FakeBlob):
+        self.blob = blob
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += bytes(data)
+        return len(data)
+
+    def tell(self):
+        return len(self.buffer)
+
+    def close(self):
+        if not self.closed:
+            self.blob.upload_from_string(bytes(self.buffer))
+        super().close()
+
+
+class FakeJob:
+    def __init__(self, latency, rows=None):
+        self.latency = latency
+        self.rows = rows or []
+
+    def result(self):
+        time.sleep(self.latency)
+        return self.rows
+
+
+class FakeBigQueryClient:
+    """
+    BigQueryの代替(クエリ・読み込みジョブの件数を数える)
+    """
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.queries = 0
+        self.load_jobs = 0
+        self.loaded_uris = 0
+        self.lock = threading.Lock()
+
+    def query(self, query, job_config=None):
+        with self.lock:
+            self.queries += 1
+        return FakeJob(self.latency.bigquery)
+
+    def get_table(self, table_id):
+        time.sleep(self.latency.bigquery)
+        return table_id
+
+    def load_table_from_uri(self, source_uris, destination, job_config=None):
+        with self.lock:
+            self.load_jobs += 1
+            self.loaded_uris += (
+                1 if isinstance(source_uris, str) else len(source_uris)
+            )
+        return FakeJob(self.latency.bigquery)
+
+
+class FakePublisherClient:
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, topic, data, **attributes):
+        self.messages.append((topic, data, attributes))
+
+
+class FakeKrakenSession:
+    """
+    kraken API(OHLC)へのrequests.Sessionの代替
+    """
+
+    def __init__(self, latency: Latency, bars: int):
+        self.latency = latency
+        self.bars = bars
+
+    def get(self, url, params=None):
+        time.sleep(self.latency.api)
+        interval = int(params["interval"]) * 60
+        end = int(time.time()) // interval * interval
+        times = end - interval * np.arange(self.bars)[::-1]
+        rng = np.random.default_rng(len(params["pair"]))
+        close = 100 + rng.standard_normal(self.bars).cumsum()
+        candles = [
+            [int(t), f"{c:.5f}", f"{c + 1:.5f}", f"{c - 1:.5f}", f"{c:.5f}",
+             f"{c:.5f}", f"{v:.8f}", 10]
+            for t, c, v in zip(times, close, rng.random(self.bars))
+        ]
+        return FakeResponse({
+            "error": [],
+            "result": {params["pair"]: candles, "last": int(end)}
+        })
+
+
+class FakeResponse:
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+
+    @property
+    def content(self):
+        return json.dumps(self.data).encode("utf-8")
+
+    def json(self):
+        return self.data
+
+
+class FakeYfinance:
+    """
+    yfinanceモジュールの代替(yf.downloadと同じ形式のデータフレームを返す)
+    """
+
+    def __init__(self, latency: Latency, bars: int):
+        self.latency = latency
+        self.bars = bars
+        self.shared = type("shared", (), {"_ERRORS": {}})
+
+    def download(
+        self,
+        tickers,
+        interval,
+        period=None,
+        start=None,
+        end=None,
+        auto_adjust=True,
+        group_by=None
+    ):
+        if isinstance(tickers, str):
+            time.sleep(self.latency.api)
+            return self.create_df(tickers, interval, start, end)
+
+        # yfinanceは銘柄ごとに並行してリクエストする
+        time.sleep(self.latency.api)
+        return pd.concat(
+            {
+                ticker: self.create_df(ticker, interval, start, end)
+                for ticker in tickers
+            },
+            axis=1
+        )
+
+    def create_df(self, ticker, interval, start=None, end=None):
+        """
+        現在までの足を生成する(start, endを指定した場合は期間内の足のみ返す)
+        """
+        freq = "min" if interval == "1m" else "D"
+        index = pd.date_range(
+            end=pd.Timestamp.now(tz="UTC").floor(freq),
+            periods=self.bars,
+            freq=freq,
+            name="Datetime"
+        )
+        rng = np.random.default_rng(len(ticker))
+        close = 100 + rng.standard_normal(self.bars).cumsum()
+        df = pd.DataFrame({
+            "Open": close,
+            "High": close + 1,
+            "Low": close - 1,
+            "Close": close,
+            "Volume": rng.integers(0, 10_000, self.bars)
+        }, index=index)
+
+        if start is not None:
+            df = df[df.index >= pd.Timestamp(start)]
+        if end is not None:
+            df = df[df.index < pd.Timestamp(end)]
+        return df
+
+
+class FakeFunctionServer:
+    """
+    collector(Cloud Functions)のHTTPエンドポイントの代替
+
+    別スレッドのイベントループでローカルのHTTPサーバーを起動し、
+    POST /<function>へ設定した待ち時間の後に200を返す。
+    """
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.requests = 0
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.url = None
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        app = web.Application()
+        app.router.add_post("/{function}", self.handle)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        self.loop.run_until_complete(site.start())
+        port = self.runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}"
+        self.thread.start()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(
+            self.runner.cleanup(), self.loop
+        ).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def endpoint(self, function_name):
+        return f"{self.url}/{function_name}"
+
+    async def handle(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency.function)
+        return web.Response(text="ok")
+
+
+class FakeKrakenWebsocket:
+    """
+    kraken API(websocket v2)のOHLCの購読の代替
+
+    別スレッドのイベントループでローカルのwebsocketサーバーを起動する。
+    購読すると、通貨ペアごとに直近snapshot_bars件の足(スナップショット)を送り、
+    以降はtick秒ごとに現在の足の更新を送る。
+    足の間隔はbar_seconds秒(kraken APIの1分足の代わりに短くできる)とし、
+    drop_after件の更新を送るごとに接続を切断する(再接続の確認用)。
+    """
+
+    def __init__(
+        self,
+        bar_seconds=60,
+        tick=0.1,
+        snapshot_bars=10,
+        drop_after=None
+    ):
+        self.bar_seconds = bar_seconds
+        self.tick = tick
+        self.snapshot_bars = snapshot_bars
+        self.drop_after = drop_after
+        self.connections = 0
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.url = None
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        app = web.Application()
+        app.router.add_get("/v2", self.handle)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        self.loop.run_until_complete(site.start())
+        port = self.runner.addresses[0][1]
+        self.url = f"ws://127.0.0.1:{port}/v2"
+        self.thread.start()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(
+            self.runner.cleanup(), self.loop
+        ).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def create_bar(self, symbol, begin):
+        """
+        通貨ペアと足の開始時刻から、常に同じ値の足を生成する
+        """
+        close = 100 + (begin // self.bar_seconds) % 100 + len(symbol)
+        return {
+            "symbol": symbol,
+            "open": close - 0.5,
+            "high": close + 1,
+            "low": close - 1,
+            "close": close,
+            "vwap": close,
+            "trades": 10,
+            "volume": 1.5,
+            # 足の開始時刻はkraken APIと同じRFC3339(ナノ秒まで)の形式とする
+            "interval_begin": pd.Timestamp(begin, unit="s").strftime(
+                "%Y-%m-%dT%H:%M:%S.000000000Z"
+            ),
+            "interval": 1
+        }
+
+    async def handle(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.connections += 1
+
+        subscription = await ws.receive_json()
+        symbols = subscription["params"]["symbol"]
+        for symbol in symbols:
+            await ws.send_json({
+                "method": "subscribe",
+                "result": {"channel": "ohlc", "symbol": symbol},
+                "success": True
+            })
+
+        current = int(time.time()) // self.bar_seconds * self.bar_seconds
+        await ws.send_json({
+            "channel": "ohlc",
+            "type": "snapshot",
+            "data": [
+                self.create_bar(symbol, current - self.bar_seconds * i)
+                for symbol in symbols
+                for i in reversed(range(self.snapshot_bars))
+            ]
+        })
+
+        sent = 0
+        while not ws.closed:
+            await asyncio.sleep(self.tick)
+            begin = int(time.time()) // self.bar_seconds * self.bar_seconds
+            try:
+                await ws.send_json({
+                    "channel": "ohlc",
+                    "type": "update",
+                    "data": [
+                        self.create_bar(symbol, begin) for symbol in symbols
+                    ]
+                })
+            except ConnectionResetError:
+                # 購読側が先に切断した場合
+                break
+            sent += 1
+            if self.drop_after is not None and sent >= self.drop_after:
+                await ws.close()
+
+        return ws
+
+
+def create_id_token(audience, lifetime=3600):
+    """
+    fetch_id_tokenの代替(有効期限のみを持つ署名無しのIDトークンを返す)
+    """
+    def encode(data):
+        return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+    header = encode(json.dumps({"alg": "RS256", "typ": "JWT"}).encode())
+    payload = encode(json.dumps({
+        "aud": audience, "exp": int(time.time()) + lifetime
+    }).encode())
+    return f"{header}.{payload}.{encode(b'signature')}"
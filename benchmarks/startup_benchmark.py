@@ -0,0 +1,128 @@
+"""
+各関数のコールドスタート時の読み込み時間(import time)のベンチマーク
+
+関数ごとに新しいPythonプロセスで`python -X importtime -c "import main"`を実行し、以下を計測する。
+・main.pyの読み込み時間(mainが読み込む全モジュールを含む)
+・main.pyが直接読み込むモジュールごとの読み込み時間(時間の長い順に上位のみ)
+--budgetで関数ごとの読み込み時間の上限(秒)を指定すると、上限を超えた関数がある場合は終了コード1で終了する。
+
+実行方法(リポジトリのルートで実行する)
+    python benchmarks/startup_benchmark.py
+    python benchmarks/startup_benchmark.py --functions crypto-collector \
+        --repeat 5 --top 10 --budget 0.5 --json startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+functions_dir = os.path.join(root_dir, "src", "functions")
+shared_dir = os.path.join(root_dir, "src", "shared")
+
+
+def measure_import(function_name):
+    """
+    新しいプロセスでmain.pyを読み込み、-X importtimeの出力を
+    [(階層, モジュール名, 読み込み時間(マイクロ秒))]で返す
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=os.path.join(functions_dir, function_name),
+        # デプロイ時と同様に、共通モジュールを読み込めるようにする
+        env={**os.environ, "PYTHONPATH": shared_dir},
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        raise Exception(f"failed to import {function_name}: {result.stderr}")
+
+    # 各行は"import time: 自身(us) | 累計(us) | モジュール名"の形式で、階層は名前の字下げで表される
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((depth, name.strip(), int(cumulative)))
+    return entries
+
+
+def summarize(entries):
+    """
+    main.pyの読み込み時間と、直接読み込むモジュールごとの読み込み時間(秒)を返す
+    """
+    # 子のモジュールは親より先に出力されるため、mainの直前にある階層1のモジュールを集める
+    index = max(
+        i for i, (depth, name, _) in enumerate(entries)
+        if depth == 0 and name == "main"
+    )
+    modules = {}
+    for depth, name, cumulative in reversed(entries[:index]):
+        if depth == 0:
+            break
+        if depth == 1:
+            modules[name] = cumulative / 1e6
+
+    return entries[index][2] / 1e6, modules
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--functions",
+        nargs="+",
+        default=sorted(
+            name for name in os.listdir(functions_dir)
+            if os.path.exists(os.path.join(functions_dir, name, "main.py"))
+        )
+    )
+    # 読み込みを繰り返す回数(最短の結果を採用する)
+    parser.add_argument("--repeat", type=int, default=3)
+    # 表示するモジュールの件数
+    parser.add_argument("--top", type=int, default=8)
+    # 関数ごとの読み込み時間の上限(秒)
+    parser.add_argument("--budget", type=float)
+    parser.add_argument("--json")
+    args = parser.parse_args()
+
+    report = []
+    for function_name in args.functions:
+        best = None
+        for _ in range(args.repeat):
+            seconds, modules = summarize(measure_import(function_name))
+            if best is None or seconds < best[0]:
+                best = (seconds, modules)
+
+        seconds, modules = best
+        over_budget = args.budget is not None and seconds > args.budget
+        report.append({
+            "function": function_name,
+            "seconds": round(seconds, 6),
+            "over_budget": over_budget,
+            "modules": {
+                name: round(module_seconds, 6)
+                for name, module_seconds in modules.items()
+            }
+        })
+
+        budget = ""
+        if args.budget is not None:
+            budget = " (over budget)" if over_budget else " (ok)"
+        print(f"{function_name:<22} {seconds:>8.3f} s{budget}")
+        ranked = sorted(modules.items(), key=lambda item: -item[1])
+        for name, module_seconds in ranked[:args.top]:
+            print(f"    {name:<36} {module_seconds:>8.3f} s")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if any(result["over_budget"] for result in report):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+暗号資産のストリーミング収集(src/functions/crypto-collector/stream.py)のベンチマーク
+
+kraken API(websocket)をローカルの代替(benchmarks/fakes.pyのFakeKrakenWebsocket)へ、
+GCS, BigQuery, Pub/Subをメモリ上の代替へ差し替え、stream.pyを実際のコードのまま一定時間実行する。
+足の間隔を短く(既定は1秒)して、以下を計測する。
+・足の終了からアップロードの完了までの秒数(p50, p95, 最大)
+・アップロードした足・ファイルの件数、再接続の回数
+アップロードした足が系列ごとに欠損・重複なく連続していることも併せて確認する。
+
+実行方法(リポジトリのルートで実行する)
+    pip install -r src/functions/crypto-collector/requirements.txt
+    python benchmarks/stream_benchmark.py
+    python benchmarks/stream_benchmark.py --pairs 50 --seconds 30 \
+        --drop-after 40 --gcs-latency 0.05
+"""
+import argparse
+import asyncio
+import os
+from contextlib import ExitStack
+from io import BytesIO
+from unittest import mock
+import numpy as np
+import pandas as pd
+from cleansing_df_benchmark import load_collector
+from e2e_benchmark import benchmark_env, get_pipeline
+from fakes import (
+    FakeBigQueryClient,
+    FakeKrakenWebsocket,
+    FakePublisherClient,
+    FakeStorage,
+    Latency
+)
+
+
+def create_tickers(pairs):
+    return [
+        {
+            "table": f"PAIR{i:03}USD",
+            "pair": f"pair{i:03}usd",
+            "ws_symbol": f"PAIR{i:03}/USD"
+        }
+        for i in range(pairs)
+    ]
+
+
+def patch_stream(stack: ExitStack, stream, module, backends, args):
+    """
+    stream.pyのクライアント・購読対象・足の間隔を差し替える
+    """
+    pipeline = get_pipeline(module)
+    stack.enter_context(mock.patch.multiple(
+        pipeline,
+        get_bigquery_client=lambda: backends["bigquery"],
+        get_bucket=lambda: backends["storage"].bucket(pipeline.bucket_name),
+        get_publisher_client=lambda: backends["publisher"]
+    ))
+    stack.enter_context(mock.patch.multiple(
+        stream,
+        get_bigquery_client=lambda: backends["bigquery"],
+        tickers=create_tickers(args.pairs),
+        stream_period={
+            "name": "1M", "interval": 1, "seconds": args.bar_seconds
+        },
+        stream_flush_seconds=args.flush_seconds,
+        stream_close_grace_seconds=args.grace_seconds,
+        stream_bigquery_seconds=args.bigquery_seconds
+    ))
+
+
+def measure_delays(stack: ExitStack, stream, bar_seconds):
+    """
+    系列ごとのアップロードの完了時に、足の終了からの秒数を記録する
+    """
+    delays = []
+    upload_output = stream.upload_output
+
+    def wrapper(output, execTime, report):
+        gcs_path = upload_output(output, execTime, report)
+        last = output["df"]["UNIX_TIME"].iloc[-1]
+        delays.append(pd.Timestamp.now().timestamp() - last - bar_seconds)
+        return gcs_path
+
+    stack.enter_context(mock.patch.object(stream, "upload_output", wrapper))
+    return delays
+
+
+async def run_for(stream, url, seconds):
+    stop = asyncio.Event()
+    asyncio.get_running_loop().call_later(seconds, stop.set)
+    await stream.run_stream(url, stop)
+
+
+def verify_uploads(storage: FakeStorage, bar_seconds):
+    """
+    アップロードしたファイルを系列ごとに結合し、足が欠損・重複なく連続していることを確認する
+    系列ごとの足の件数を返す
+    """
+    frames = {}
+    for (_, name), (data, _) in storage.objects.items():
+        # name: <dataset>/<ticker>/<execTime>_stream/1M.<csv|parquet>
+        split_slash = name.split("/")
+        if (
+            len(split_slash) != 4
+            or split_slash[1] == "_runs"
+            or not split_slash[2].endswith("_stream")
+        ):
+            continue
+        if name.endswith(".parquet"):
+            df = pd.read_parquet(BytesIO(data))
+        else:
+            df = pd.read_csv(BytesIO(data))
+        frames.setdefault(split_slash[1], []).append(df)
+
+    rows = {}
+    for ticker, dfs in frames.items():
+        times = np.sort(pd.concat(dfs)["UNIX_TIME"].to_numpy())
+        if len(np.unique(times)) != len(times):
+            raise Exception(f"duplicated bars: {ticker}")
+        if len(times) > 1 and not (np.diff(times) == bar_seconds).all():
+            raise Exception(f"missing bars: {ticker}")
+        rows[ticker] = len(times)
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pairs", type=int, default=10)
+    parser.add_argument("--seconds", type=float, default=15)
+    # 代替のwebsocketが送る足の間隔(秒)
+    parser.add_argument("--bar-seconds", type=int, default=1)
+    parser.add_argument("--tick", type=float, default=0.1)
+    parser.add_argument("--flush-seconds", type=float, default=1)
+    parser.add_argument("--grace-seconds", type=float, default=0.2)
+    parser.add_argument("--bigquery-seconds", type=float, default=5)
+    # 指定した件数の更新を送るごとに切断する(再接続の確認用)
+    parser.add_argument("--drop-after", type=int)
+    parser.add_argument("--gcs-latency", type=float, default=0.0)
+    parser.add_argument("--bigquery-latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    for key, value in benchmark_env.items():
+        os.environ.setdefault(key, value)
+
+    module = load_collector("crypto-collector")
+    import stream
+
+    latency = Latency(gcs=args.gcs_latency, bigquery=args.bigquery_latency)
+    backends = {
+        "storage": FakeStorage(latency),
+        "bigquery": FakeBigQueryClient(latency),
+        "publisher": FakePublisherClient()
+    }
+    server = FakeKrakenWebsocket(
+        bar_seconds=args.bar_seconds,
+        tick=args.tick,
+        drop_after=args.drop_after
+    ).start()
+
+    try:
+        with ExitStack() as stack:
+            patch_stream(stack, stream, module, backends, args)
+            delays = measure_delays(stack, stream, args.bar_seconds)
+            asyncio.run(run_for(stream, server.url, args.seconds))
+    finally:
+        server.stop()
+
+    rows = verify_uploads(backends["storage"], args.bar_seconds)
+    if len(rows) != args.pairs:
+        raise Exception(f"uploaded pairs: {len(rows)} / {args.pairs}")
+
+    print(f"pairs:       {args.pairs}")
+    print(f"bars:        {sum(rows.values()):,}")
+    print(f"files:       {len(delays):,}")
+    print(f"reconnects:  {server.connections - 1}")
+    print(
+        "delay (s):   "
+        f"p50={np.percentile(delays, 50):.3f} "
+        f"p95={np.percentile(delays, 95):.3f} "
+        f"max={max(delays):.3f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+#!/usr/bin/bash
+
+# 全系列を1つのテーブルにまとめる構成(MARKET_TABLE_LAYOUT=consolidated)のテーブルを作成する
+# CLOSE_TIMEの月で分割し、SYMBOL, PERIODでクラスタ化するため、
+# CLOSE_TIME・SYMBOL・PERIODで絞り込んだクエリは該当する分割・クラスタのみを読み込む
+# 1D足は初回に全期間(^GSPCなどは数十年分)を取得するため、日付で分割すると
+# 分割数の上限(テーブル当たり10,000, 1ジョブで更新できるのは4,000)を超える。月単位であれば1世紀でも1,200程度に収まる
+
+dataset_name=""
+table_name="MARKET_PRICE"
+
+echo "start create ${table_name} table"
+
+bq mk -t \
+  --time_partitioning_field CLOSE_TIME \
+  --time_partitioning_type MONTH \
+  --clustering_fields SYMBOL,PERIOD \
+  "${dataset_name}.${table_name}" ../schema/MARKET_PRICE_CONSOLIDATED_schema.json
@@ -0,0 +1,25 @@
+#!/usr/bin/bash
+
+# csv-to-bigqueryをMERGEでの取り込み(LOAD_MERGE_MODE=true)に切り替えると、以降はUNIX_TIMEが重複しない。
+# 切り替え前に追記(WRITE_APPEND)で取り込まれた重複データを削除する場合のみ、1度だけ実行する。
+
+dataset_name=""
+
+target_tickers=(BTCUSD ETHBTC)
+
+period_array=(1M 3M 5M 15M 30M 1H 2H 4H 6H 12H 1D 3D 1W)
+
+for exchange in ${target_tickers[@]}; do
+  for period in ${period_array[@]}; do
+    table_name="${exchange}_${period}"
+    echo "start deduplicate ${table_name} table"
+    bq query --use_legacy_sql=false --replace --destination_table "${dataset_name}.${table_name}" "
+      SELECT
+        AS VALUE ANY_VALUE(T)
+      FROM
+        \`${dataset_name}.${table_name}\` AS T
+      GROUP BY
+        T.UNIX_TIME
+    "
+  done
+done
@@ -0,0 +1,19 @@
+#!/usr/bin/bash
+
+# unixtime管理テーブルはTABLE_NAMEをキーとしてupsertされるため、通常は重複しない。
+# upsert導入前にinsertされた重複データを削除する場合のみ、1度だけ実行する。
+
+dataset_name=""
+table_name="RECENTLY_UNIXTIME"
+
+echo "start deduplicate ${table_name} table"
+
+bq query --use_legacy_sql=false --replace --destination_table "${dataset_name}.${table_name}" "
+  SELECT
+    TABLE_NAME,
+    MAX(UNIX_TIME) AS UNIX_TIME
+  FROM
+    \`${dataset_name}.${table_name}\`
+  GROUP BY
+    TABLE_NAME
+"
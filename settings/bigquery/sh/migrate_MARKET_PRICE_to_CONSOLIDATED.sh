@@ -0,0 +1,34 @@
+#!/usr/bin/bash
+
+# 系列ごとのテーブルのデータを、全系列をまとめたテーブル(MARKET_PRICE)へ1度だけ移行する。
+# 移行後にcsv-to-bigqueryとcollectorのMARKET_TABLE_LAYOUTをconsolidatedへ切り替える。
+
+dataset_name=""
+consolidated_table="MARKET_PRICE"
+
+target_tickers=(BTCUSD ETHBTC)
+
+period_array=(1M 3M 5M 15M 30M 1H 2H 4H 6H 12H 1D 3D 1W)
+
+for exchange in ${target_tickers[@]}; do
+  for period in ${period_array[@]}; do
+    table_name="${exchange}_${period}"
+    echo "start migrate ${table_name} table"
+    bq query --use_legacy_sql=false "
+      INSERT INTO
+        \`${dataset_name}.${consolidated_table}\`
+      SELECT
+        '${exchange}' AS SYMBOL,
+        '${period}' AS PERIOD,
+        T.*
+      FROM (
+        SELECT
+          AS VALUE ANY_VALUE(T)
+        FROM
+          \`${dataset_name}.${table_name}\` AS T
+        GROUP BY
+          T.UNIX_TIME
+      ) AS T
+    "
+  done
+done
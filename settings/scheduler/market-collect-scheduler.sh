@@ -8,3 +8,11 @@ gcloud scheduler jobs create pubsub "market-collect-scheduler" \
   --topic=${topicId} \
   --message-body="none" \
   --time-zone="Asia/Tokyo"
+
+# 欠損の補完(1日1回)
+gcloud scheduler jobs create pubsub "market-repair-scheduler" \
+  --schedule="30 3 * * *" \
+  --topic=${topicId} \
+  --message-body="none" \
+  --attributes="mode=repair" \
+  --time-zone="Asia/Tokyo"
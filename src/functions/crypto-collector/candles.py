@@ -0,0 +1,100 @@
+import json
+import numpy as np
+import pandas as pd
+
+
+class CandleBatch:
+    """
+    足(UNIX_TIMEの昇順)を項目ごとの型付き配列で保持する
+
+    取得から上位の時間足の生成まではこの形式のまま扱い、
+    データフレームへの変換はアップロードする時点(to_df)でのみ行う。
+    """
+
+    __slots__ = ("times", "opens", "highs", "lows", "closes", "volumes")
+
+    def __init__(self, times, opens, highs, lows, closes, volumes):
+        # 足の開始時刻(unixtime)
+        self.times = np.asarray(times, dtype="int64")
+        self.opens = np.asarray(opens, dtype="float64")
+        self.highs = np.asarray(highs, dtype="float64")
+        self.lows = np.asarray(lows, dtype="float64")
+        self.closes = np.asarray(closes, dtype="float64")
+        self.volumes = np.asarray(volumes, dtype="float64")
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], [], [], [], [])
+
+    @classmethod
+    def concat(cls, batches: list):
+        """
+        足の開始時刻の順に並んだCandleBatchを連結する
+        """
+        return cls(*(
+            np.concatenate([getattr(batch, name) for batch in batches])
+            for name in cls.__slots__
+        ))
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, key):
+        """
+        スライスまたは真偽値の配列で抽出した足を返す
+        """
+        return CandleBatch(
+            self.times[key],
+            self.opens[key],
+            self.highs[key],
+            self.lows[key],
+            self.closes[key],
+            self.volumes[key]
+        )
+
+    def to_df(self):
+        """
+        crypto-collectorのアップロード形式のデータフレームに変換する
+        """
+        return pd.DataFrame({
+            "UNIX_TIME": self.times,
+            "OPEN_PRICE": self.opens,
+            "HIGH_PRICE": self.highs,
+            "LOW_PRICE": self.lows,
+            "CLOSE_PRICE": self.closes,
+            "VOLUME": self.volumes,
+            "QUOTE_VOLUME": 0.0,
+            "CLOSE_TIME": pd.to_datetime(self.times, unit="s", utc=True)
+        })
+
+
+def decode_kraken_response(content: bytes):
+    """
+    kraken APIのレスポンスボディ(json)を辞書に変換する
+    jsonでない場合は空の辞書を返す
+    """
+    try:
+        return json.loads(content)
+    except ValueError:
+        return {}
+
+
+def decode_kraken_ohlc(rows: list):
+    """
+    kraken API(OHLC)の足の配列を、データフレームを経由せずにCandleBatchへ変換する
+    足は[time, open, high, low, close, vwap, volume, count]の配列で、価格・出来高は文字列で返る
+    """
+    if not rows:
+        return CandleBatch.empty()
+
+    # 足ごとの配列を項目ごとに転置し、項目ごとに1回で型付き配列へ変換する
+    times, opens, highs, lows, closes, _, volumes, _ = zip(*rows)
+
+    return CandleBatch(
+        np.array(times, dtype="int64"),
+        np.array(opens, dtype="float64"),
+        np.array(highs, dtype="float64"),
+        np.array(lows, dtype="float64"),
+        np.array(closes, dtype="float64"),
+        np.array(volumes, dtype="float64")
+    )
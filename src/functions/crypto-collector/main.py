@@ -1,28 +1,68 @@
+import json
 import os
-import time
-from datetime import datetime
-from zoneinfo import ZoneInfo
-import pandas as pd
 import requests
-from google.cloud.bigquery import Client as BqClient
-from google.cloud.storage import Client as StorageClient
-from google.cloud.pubsub import PublisherClient
-
-
-# GCPのプロジェクトID
-project_id = os.getenv("GCP_PROJECT_ID")
-# BigQueryのデータセット名
-dataset = os.getenv("BIGQUERY_DATASET")
-# 金融データ(csv)のアップロード先バケット名
-bucket_name = os.getenv("MARKET_DATA_BUCKET")
-# 最新unixtime管理テーブル名
-recently_unixtime_table = os.getenv("BIGQUERY_UNIXTIME_TABLE")
+from requests.adapters import HTTPAdapter
+from google.api_core.exceptions import PreconditionFailed
+from candles import (
+    CandleBatch,
+    decode_kraken_ohlc,
+    decode_kraken_response
+)
+from pipeline import (
+    Source,
+    get_bucket,
+    handle_request,
+    in_shard,
+    load_manifest,
+    map_concurrently,
+    unixtime_manifest_retries
+)
+from ratelimit import RateLimiter
+from resample import resample_candles
+from runreport import RunReport
+
+
 # 暗号資産データ取得先API(kraken API)
 crypto_api_url = "https://api.kraken.com/0/public/OHLC"
-
+# kraken APIへの同時リクエスト数(1の場合は逐次リクエストする)
+fetch_concurrency = int(os.getenv("CRYPTO_FETCH_CONCURRENCY", "4"))
+# kraken APIへの1秒当たりのリクエスト数の上限と、連続してリクエストできる数
+kraken_rate_limit = float(os.getenv("KRAKEN_RATE_LIMIT", "1"))
+kraken_rate_burst = float(os.getenv("KRAKEN_RATE_BURST", "3"))
+# レート制限を受けた場合の再試行回数
+rate_limit_retries = 5
+# kraken APIから1回に取得できる足の最大件数
+kraken_max_candles = 720
+# 1分足から上位の時間足を生成するか(生成しない場合は時間足ごとにkraken APIから取得する)
+# 生成する場合も、取得履歴の無いテーブルの時間足のうちkraken APIにある時間足(5M〜1W)は、
+# 初回のみkraken APIから過去の足(最大720件)を取得し、1分足から生成した足より前の足として補う
+resample_mode = os.getenv("CRYPTO_RESAMPLE_MODE", "false") == "true"
+# 上位の時間足の未確定の足を次回の実行へ持ち越すためのマニフェスト(json)のパス
+resample_state_path = "_manifest/resample_state/crypto-collector.json"
+
+# kraken APIへのリクエストで使い回すセッション(keep-aliveで接続を再利用する)
+session = requests.Session()
+session.mount(
+    "https://",
+    HTTPAdapter(pool_connections=1, pool_maxsize=max(fetch_concurrency, 1))
+)
+# kraken APIへのリクエスト数を制限する(並行リクエストでも共有する)
+kraken_limiter = RateLimiter(kraken_rate_limit, kraken_rate_burst)
+
+# ws_symbol: kraken API(websocket)の通貨ペア(stream.pyで使用する)
 tickers = [
-    {"table": "BTCUSD", "ticker": "XBTUSD", "res_ticker": "XXBTZUSD"},
-    {"table": "ETHBTC", "ticker": "ETHBTC", "res_ticker": "XETHXXBT"}
+    {
+        "table": "BTCUSD",
+        "ticker": "XBTUSD",
+        "res_ticker": "XXBTZUSD",
+        "ws_symbol": "BTC/USD"
+    },
+    {
+        "table": "ETHBTC",
+        "ticker": "ETHBTC",
+        "res_ticker": "XETHXXBT",
+        "ws_symbol": "ETH/BTC"
+    }
 ]
 
 periods = [
@@ -41,137 +81,249 @@ periods = [
     {"name": "1W", "time": "10080"}
 ]
 
-api_columns = [
-    "UNIX_TIME",
-    "OPEN_PRICE",
-    "HIGH_PRICE",
-    "LOW_PRICE",
-    "CLOSE_PRICE",
-    "VWAP",
-    "VOLUME",
-    "COUNT"
-]
-
-float_columns = [
-    "OPEN_PRICE",
-    "HIGH_PRICE",
-    "LOW_PRICE",
-    "CLOSE_PRICE",
-    "VOLUME",
-    "QUOTE_VOLUME"
+# 1分足から生成する時間足(秒数)
+resample_periods = [
+    {"name": "3M", "seconds": 180},
+    {"name": "5M", "seconds": 300},
+    {"name": "15M", "seconds": 900},
+    {"name": "30M", "seconds": 1800},
+    {"name": "1H", "seconds": 3600},
+    {"name": "2H", "seconds": 7200},
+    {"name": "4H", "seconds": 14400},
+    {"name": "6H", "seconds": 21600},
+    {"name": "12H", "seconds": 43200},
+    {"name": "1D", "seconds": 86400},
+    {"name": "3D", "seconds": 259200},
+    {"name": "1W", "seconds": 604800}
 ]
 
 
 def handler(request):
-    try:
-        crypto_collector()
-    except Exception as e:
-        publish_error_report(str(e))
-        raise e
+    handle_request(CryptoSource(), request)
 
     return "ok"
 
 
-def crypto_collector():
-    bigquery_client = BqClient(project_id)
+class CryptoSource(Source):
+    """
+    kraken APIから暗号資産データを取得する
+    """
 
-    # 最新unixTimeを取得する
-    df_unixtime = load_recently_unixtime(bigquery_client)
+    function_name = "crypto-collector"
+    # 時間足ごとの足の間隔(秒)
+    bar_seconds = {
+        **{period["name"]: int(period["time"]) * 60 for period in periods},
+        **{period["name"]: period["seconds"] for period in resample_periods}
+    }
+    repair_concurrency = fetch_concurrency
+
+    def __init__(self):
+        # 前回取得分のunixtime(TABLE_NAME → UNIX_TIME)
+        self.unixtimes = {}
+        # 上位の時間足の集計状態(TABLE_NAME → 集計済みの最後の1分足・未確定の足の集計値)
+        self.resample_state = {}
+        # 他のシャードの更新との競合を判定するため、取得時の状態を残す
+        self.loaded_resample_state = {}
+        self.state_generation = 0
+        # 今回の実行で1分足から生成した時間足のテーブル
+        self.resampled_tables = []
+        # kraken APIから取得した、取得履歴の無い時間足の過去の足(TABLE_NAME → CandleBatch)
+        self.backfill = {}
+
+    def targets(self, unixtimes: dict, shard: dict):
+        self.unixtimes = unixtimes
+
+        # 1分足から上位の時間足を生成する場合、kraken APIからは1分足と、取得履歴の無い時間足の過去の足のみ取得する
+        # 過去の足は1分足から生成した足と合わせてアップロードするため、1分足より先に取得・変換する
+        fetch_periods = periods
+        if resample_mode:
+            fetch_periods = periods[1:] + periods[:1]
+            state, self.state_generation = load_manifest(resample_state_path)
+            self.resample_state = state or {}
+            self.loaded_resample_state = dict(self.resample_state)
+
+        # 取得対象(通貨ペア×時間足)ごとに前回取得分のunixtimeを求める
+        targets = []
+        for ticker in tickers:
+            for period in fetch_periods:
+
+                table_name = f"{ticker['table']}_{period['name']}"
+
+                # 前回取得分のunixtimeを取得する(取得履歴が無い場合は0)
+                target_unixtime = unixtimes.get(table_name, 0)
+
+                shard_table = table_name
+                if resample_mode:
+                    if period is not periods[0] and target_unixtime != 0:
+                        continue
+                    # 1分足から生成する足と合わせるため、1分足の系列と同じシャードで取得する
+                    shard_table = f"{ticker['table']}_{periods[0]['name']}"
+
+                # 他のシャードが担当する系列は収集しない
+                if not in_shard(shard_table, shard):
+                    continue
+
+                targets.append((ticker, period, table_name, target_unixtime))
+
+        return targets
+
+    def fetch(self, targets: list, report: RunReport):
+        """
+        取得対象の暗号資産データを、同時リクエスト数を制限しつつ並行して取得する
+        (結果はtargetsと同じ順序で返る)
+        """
+        def fetch_target(target):
+            ticker, period, table_name, target_unixtime = target
+            with report.span("fetch", table_name) as span:
+                candles = request_crypto_watch_api(
+                    ticker["res_ticker"],
+                    ticker["ticker"],
+                    period["time"],
+                    target_unixtime
+                )
+                span["rows"] = len(candles)
+            return target, candles
+
+        return map_concurrently(fetch_target, targets, fetch_concurrency)
+
+    def transform(self, target, candles, report: RunReport):
+        ticker, period, table_name, target_unixtime = target
+
+        if resample_mode and period is not periods[0]:
+            # 取得履歴の無い時間足の過去の足は、1分足の変換時に1分足から生成した足と合わせる
+            # (末尾の未確定の足は除く)
+            self.backfill[table_name] = candles[:-1]
+            return []
+
+        # レスポンスデータの長さが2未満の場合、データが無いかもしくは、未来のデータしかないため、処理を中断する
+        if len(candles) < 2:
+            return self.pop_backfill(ticker)
+
+        # kraken APIは最大720件までしか返さないため、前回取得分から720件を超えて空いた場合は途中の足が欠落する
+        is_overflow = (
+            target_unixtime != 0
+            and len(candles) >= kraken_max_candles
+            and int(candles.times[0]) > target_unixtime + 60
+        )
+
+        # レスポンスデータの末尾には未来日の価格に実行時点の最新値が入るが、この値は実行日時によって変化してしまうため、不確実のデータとなる。
+        # よって未来日の項目となる配列の末尾を削除する。
+        candles = candles[:-1]
+
+        with report.span("transform", table_name) as span:
+            # アップロードする時点でデータフレームに変換する
+            df_api = candles.to_df()
+            span["rows"] = len(df_api)
+
+        outputs = [{
+            "table_ticker": ticker["table"],
+            "period": period["name"],
+            "table_name": table_name,
+            "df": df_api
+        }]
+
+        if not resample_mode:
+            return outputs
+
+        # 1分足から上位の時間足を生成する
+        for resample_period in resample_periods:
+            resample_table = f"{ticker['table']}_{resample_period['name']}"
+
+            # 1分足が欠落している場合、前回の未確定の足は使用しない
+            partial = None
+            if not is_overflow:
+                partial = self.resample_state.get(resample_table)
+
+            self.resampled_tables.append(resample_table)
+            with report.span("resample", resample_table) as span:
+                resampled, self.resample_state[resample_table] = (
+                    resample_candles(
+                        candles,
+                        resample_period["seconds"],
+                        partial,
+                        self.unixtimes.get(resample_table, 0)
+                    )
+                )
+                span["rows"] = len(resampled)
 
-    now = datetime.now(ZoneInfo("Asia/Tokyo"))
-    execTime = now.strftime("%Y%m%d_%Hh")
+            backfill = self.backfill.pop(resample_table, None)
+            if backfill is not None:
+                resampled = join_backfill(
+                    backfill, resampled, self.resample_state[resample_table]
+                )
 
-    for ticker in tickers:
-        for period in periods:
+            if len(resampled) == 0:
+                continue
 
+            outputs.append({
+                "table_ticker": ticker["table"],
+                "period": resample_period["name"],
+                "table_name": resample_table,
+                "df": resampled.to_df()
+            })
+
+        return outputs
+
+    def pop_backfill(self, ticker: dict):
+        """
+        1分足を取得できなかった場合、通貨ペアの過去の足をそのままアップロードするデータとして返す
+        """
+        outputs = []
+        for period in periods[1:]:
             table_name = f"{ticker['table']}_{period['name']}"
-
-            df_target_unixtime = df_unixtime.query(
-                f'TABLE_NAME == "{table_name}"'
-            )
-
-            target_unixtime = 0
-            if not df_target_unixtime.empty:
-                target_unixtime = df_target_unixtime["UNIX_TIME"].values[0]
-
-            response_data = request_crypto_watch_api(
-                ticker["res_ticker"],
-                ticker["ticker"],
-                period["time"],
-                target_unixtime
-            )
-
-            # レスポンスデータの長さが2未満の場合、データが無いかもしくは、未来のデータしかないため、処理を中断する
-            if len(response_data) < 2:
+            backfill = self.backfill.pop(table_name, None)
+            if not backfill:
                 continue
 
-            # レスポンスデータの末尾には未来日の価格に実行時点の最新値が入るが、この値は実行日時によって変化してしまうため、不確実のデータとなる。
-            # よって未来日の項目となる配列の末尾を削除する。
-            response_data = response_data[:-1]
-
-            # api取得分のデータ(list in list)をDataFrameに変換
-            df_api = pd.DataFrame(response_data, columns=api_columns)
-
-            # 不要カラム削除
-            df_api = df_api.drop(columns=['VWAP', 'COUNT'])
-
-            # カラム追加
-            df_api['QUOTE_VOLUME'] = 0
-
-            # int → floatへ変換(cryptowatchから小数点無しで来る場合がある)
-            df_api[float_columns] = df_api[float_columns].astype("float")
-            # unixtime → datetimeへ変換
-            df_api["CLOSE_TIME"] = pd.to_datetime(
-                df_api["UNIX_TIME"],
-                unit="s",
-                utc=True
+            outputs.append({
+                "table_ticker": ticker["table"],
+                "period": period["name"],
+                "table_name": table_name,
+                "df": backfill.to_df()
+            })
+
+        return outputs
+
+    def finish(self, shard: dict, report: RunReport):
+        # 上位の時間足の未確定の足を次回の実行へ持ち越す
+        if not resample_mode:
+            return
+
+        with report.span("save_resample_state"):
+            save_resample_state(
+                self.resample_state,
+                self.loaded_resample_state,
+                self.resampled_tables,
+                self.state_generation,
+                unixtime_manifest_retries + shard["count"] - 1
             )
 
-            # api取得分のdfをcsv形式でgcsへアップロードする
-            upload_df_to_gcs(
-                ticker["table"],
-                execTime,
-                period["name"],
-                df_api
-            )
-
-            # api取得データから最新のunixtimeを取得する
-            max_unixtime = df_api["UNIX_TIME"].max()
-
-            if df_target_unixtime.empty:
-                # unixtimeデータフレームが空の場合、追加する
-                df_unixtime = pd.concat([
-                        df_unixtime,
-                        {"TABLE_NAME": table_name, "UNIX_TIME": max_unixtime}
-                    ],
-                    ignore_index=True
+    def fetch_range(self, table_name: str, start: int, end: int):
+        """
+        kraken APIから系列のstart以降の足を取得する
+        kraken APIは直近720件の足しか返さないため、それより前の欠損は補完できない
+        また、1分足から生成する時間足のうちkraken APIに無い時間足(3M, 2Hなど)は補完できない
+        """
+        for ticker in tickers:
+            for period in periods:
+                if f"{ticker['table']}_{period['name']}" != table_name:
+                    continue
+
+                candles = request_crypto_watch_api(
+                    ticker["res_ticker"],
+                    ticker["ticker"],
+                    period["time"],
+                    start - self.bar_seconds[period["name"]]
                 )
-            else:
-                # unixtimeデータフレームが空ではない場合、該当するunixtimeを更新する
-                df_unixtime.loc[
-                    df_unixtime["TABLE_NAME"] == table_name, "UNIX_TIME"
-                ] = max_unixtime
-
-    # unixtime重複削除
-    update_recently_unixtime(bigquery_client, df_unixtime)
-
-
-def load_recently_unixtime(client: BqClient):
-
-    table_name = f"{project_id}.{dataset}.{recently_unixtime_table}"
-    query = f"""
-        SELECT
-            TABLE_NAME,
-            UNIX_TIME
-        FROM
-            `{table_name}`
-        ORDER BY
-            UNIX_TIME DESC;
-    """
-
-    unixtime_df = client.query(query).to_dataframe()
+                # 末尾の未確定の足を除く
+                return {
+                    "table_ticker": ticker["table"],
+                    "period": period["name"],
+                    "table_name": table_name,
+                    "df": candles[:-1].to_df()
+                }
 
-    return unixtime_df
+        return None
 
 
 def request_crypto_watch_api(res_ticker, ticker, period, unixtime):
@@ -182,49 +334,93 @@ def request_crypto_watch_api(res_ticker, ticker, period, unixtime):
     # unixtimeに1を加えた値を設定することで、前回取得分以降のデータを取得する
     params = {"pair": ticker, "interval": period, "since": unixtime + 1}
 
-    response = requests.get(crypto_api_url, params=params).json()
+    for _ in range(rate_limit_retries + 1):
+        kraken_limiter.acquire()
+        response = session.get(crypto_api_url, params=params)
+        # レスポンスボディは1回だけ解析し、足は型付き配列へ直接変換する
+        payload = decode_kraken_response(response.content)
 
-    return response["result"][res_ticker]
+        # レート制限を受けた場合は、待機してから再試行する
+        if is_kraken_rate_limited(response, payload):
+            kraken_limiter.backoff()
+            continue
 
+        kraken_limiter.succeed()
+        return decode_kraken_ohlc(payload["result"][res_ticker])
 
-def upload_df_to_gcs(ticker, execTime, period, df_api):
+    raise Exception(
+        f"kraken API rate limit exceeded: pair={ticker}, interval={period}"
+    )
+
+
+def is_kraken_rate_limited(response: requests.Response, payload: dict):
     """
-    APIデータ（データフレーム）をcsv形式でGCSへアップロードする
+    kraken APIのレスポンスがレート制限によるエラーか判定する
     """
-    client = StorageClient(project_id)
-    bucket = client.get_bucket(bucket_name)
+    if response.status_code == 429:
+        return True
 
-    gcs_path = f"{dataset}/{ticker}/{execTime}/{period}.csv"
+    errors = payload.get("error", [])
 
-    blob = bucket.blob(gcs_path)
-    blob.upload_from_string(
-        df_api.to_csv(index=False, header=True, sep=","),
-        content_type="text/csv"
-    )
+    return any("Rate limit" in error for error in errors)
 
 
-def update_recently_unixtime(client: BqClient, df_unixtime):
+def join_backfill(backfill: CandleBatch, resampled: CandleBatch, state):
     """
-    最新UnixTime管理テーブルのunixtimeを更新する
+    kraken APIから取得した過去の足のうち、1分足から集計した足より前の足を、1分足から生成した足の先頭に加える
     """
-    table_id = f"{project_id}.{dataset}.{recently_unixtime_table}"
+    if len(resampled) > 0:
+        covered = resampled.times[0]
+    else:
+        # 確定した足が無い場合は、次回の実行で確定する足より前の足を加える
+        covered = state.get("start")
 
-    # unixtimeデータフレームをunixtime管理テーブルへinsert
-    client.insert_rows_from_dataframe(client.get_table(table_id), df_unixtime)
+    if covered is not None:
+        backfill = backfill[backfill.times < covered]
 
+    return CandleBatch.concat([backfill, resampled])
 
-def publish_error_report(error: str):
+
+def save_resample_state(
+    resample_state: dict,
+    loaded_state: dict,
+    tables: list,
+    generation,
+    retries: int
+):
     """
-    エラー通知用topicへpublishする
+    上位の時間足の未確定の足をGCSへ保存する
+    取得時から他のシャードで更新されていた場合は、最新の状態へ今回生成した時間足のみ反映して再保存する
+    今回生成した時間足が他の実行で更新されていた場合は、二重に集計しないようエラーとする
     """
-    publisher = PublisherClient()
-    error_report_topic = os.getenv("ERROR_REPORT_TOPIC")
-    topic_name = f"projects/{project_id}/topics/{error_report_topic}"
-
-    publisher.publish(
-        topic_name,
-        data=error.encode("utf-8"),
-        projectId=project_id,
-        functionName="crypto-collector",
-        eventTime=str(int(time.time()))
+    bucket = get_bucket()
+    blob = bucket.blob(resample_state_path)
+
+    for _ in range(retries):
+        try:
+            blob.upload_from_string(
+                json.dumps(resample_state),
+                content_type="application/json",
+                if_generation_match=generation
+            )
+            return
+        except PreconditionFailed:
+            latest, generation = load_manifest(resample_state_path)
+            latest = latest or {}
+            conflicted = [
+                table for table in tables
+                if latest.get(table) != loaded_state.get(table)
+            ]
+            if conflicted:
+                raise Exception(
+                    f"failed to save {resample_state_path}: "
+                    f"updated by another run {conflicted}"
+                )
+            resample_state = {
+                **latest,
+                **{table: resample_state[table] for table in tables}
+            }
+
+    raise Exception(
+        f"failed to save {resample_state_path}: conflicted {retries} times"
     )
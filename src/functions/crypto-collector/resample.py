@@ -0,0 +1,112 @@
+import numpy as np
+from candles import CandleBatch
+
+
+# 元データ(1分足)の時間足の秒数
+base_seconds = 60
+
+
+def resample_candles(
+    base: CandleBatch, seconds, partial=None, unixtime=0
+):
+    """
+    1分足から上位の時間足を生成する
+
+    base: UNIX_TIME(足の開始時刻)の昇順に並んだ確定済みの1分足
+    seconds: 生成する時間足の秒数
+    partial: 前回の実行の集計状態(無い場合はNone)
+        last: 集計済みの最後の1分足の開始時刻
+        start, open, high, low, close, volume: 確定しなかった足の集計値(確定しなかった足がある場合のみ)
+    unixtime: 生成する時間足の取得済みunixtime(未取得の場合は0)
+
+    確定した足と、次回の実行へ持ち越す集計状態を返す
+    足の開始時刻はkraken APIと同じく、unixtimeを時間足の秒数で切り捨てた時刻とする
+    """
+    state = partial
+    # 集計済みの最後の1分足(無い場合はNone)
+    folded = None
+    if partial is not None:
+        # 集計状態の保存後に1分足のunixtimeの保存に失敗した場合、次回の実行で同じ1分足を再取得するため、
+        # 集計済みの1分足を除いて二重に集計しない
+        if "last" in partial:
+            folded = partial["last"]
+            base = base[base.times > folded]
+        if "start" not in partial:
+            partial = None
+
+    times = base.times
+    if len(times) == 0:
+        return CandleBatch.empty(), state
+
+    # 集計済みの最後の1分足の直後から1分足が続いているか
+    continuous = folded is not None and times[0] == folded + base_seconds
+
+    # 1分足が揃っている時刻(最後の1分足の終了時刻)
+    covered_until = times[-1] + base_seconds
+
+    # 1分足ごとに所属する足の開始時刻を求め、足の区切り位置を求める
+    buckets = times - times % seconds
+    first = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    last = np.r_[first[1:] - 1, len(times) - 1]
+
+    starts = buckets[first]
+    opens = base.opens[first]
+    highs = np.maximum.reduceat(base.highs, first)
+    lows = np.minimum.reduceat(base.lows, first)
+    closes = base.closes[last]
+    volumes = np.add.reduceat(base.volumes, first)
+
+    if partial is not None and partial["start"] == starts[0]:
+        # 前回確定しなかった足と同じ足の場合、前回までの集計値と合算する
+        opens[0] = partial["open"]
+        highs[0] = max(highs[0], partial["high"])
+        lows[0] = min(lows[0], partial["low"])
+        volumes[0] += partial["volume"]
+    elif partial is not None and partial["start"] < starts[0]:
+        # 前回確定しなかった足に新しい1分足が無い場合、前回までの集計値を1本の足とする
+        starts = np.r_[partial["start"], starts]
+        opens = np.r_[partial["open"], opens]
+        highs = np.r_[partial["high"], highs]
+        lows = np.r_[partial["low"], lows]
+        closes = np.r_[partial["close"], closes]
+        volumes = np.r_[partial["volume"], volumes]
+    elif times[0] != starts[0] and not continuous:
+        # 前回までの集計値が無く、先頭の足の途中からしか1分足が無い場合、不完全な足となるため除く
+        # (集計状態を失った場合や、初めて生成する場合は、足の区切りから集計を始める)
+        starts, opens, highs, lows, closes, volumes = (
+            values[1:] for values in
+            (starts, opens, highs, lows, closes, volumes)
+        )
+
+    # 集計した最後の1分足の開始時刻は、末尾の足が確定したかに関わらず持ち越す
+    next_state = {"last": int(times[-1])}
+
+    if len(starts) == 0:
+        return CandleBatch.empty(), next_state
+
+    # 足の終了時刻まで1分足が揃っている足を確定とし、取得済みの足は除く
+    complete = starts + seconds <= covered_until
+    target = complete & (starts > unixtime)
+
+    candles = CandleBatch(
+        starts[target],
+        opens[target],
+        highs[target],
+        lows[target],
+        closes[target],
+        volumes[target]
+    )
+
+    # 末尾の足が確定していない場合は、集計値を次回の実行へ持ち越す
+    if not complete[-1]:
+        next_state.update({
+            "start": int(starts[-1]),
+            "open": float(opens[-1]),
+            "high": float(highs[-1]),
+            "low": float(lows[-1]),
+            "close": float(closes[-1]),
+            "volume": float(volumes[-1])
+        })
+
+    return candles, next_state
+
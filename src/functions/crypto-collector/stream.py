@@ -0,0 +1,372 @@
+"""
+kraken API(websocket)から暗号資産データを受信し、確定した1分足を随時GCSへアップロードする(ストリーミング収集)
+
+定期実行のcrypto-collectorは実行間隔ごとにしか最新の足を取得できないため、
+常時起動するプロセス(Cloud Run, GCEなど)で実行し、確定した足を定期実行より短い間隔(既定は5分)でアップロードする。
+・tickersの通貨ペアの1分足(OHLC)を購読し、受信した足を系列ごとに保持する
+・足の終了からstream_close_grace_seconds経過した足を確定とし、stream_flush_seconds間隔でまとめてアップロードする
+・アップロードしたファイルの一覧と最新unixtimeは、crypto-collectorと同じ形式で更新する
+・アップロードの前に最新unixtimeを取得し直し、定期実行のcrypto-collectorがアップロードした足は除く
+  (定期実行のcrypto-collectorも最新unixtime以降のみ取得するため、互いの足を重複してアップロードしない。
+  ただし両者のアップロードが同時に重なった場合のみ同じ足を重複してアップロードしうるため、
+  重複を完全に避ける場合はcsv-to-bigqueryをLOAD_MERGE_MODE=trueで実行する)
+・1分足から上位の時間足を生成する場合(CRYPTO_RESAMPLE_MODE=true)は実行できない
+  (定期実行のcrypto-collectorは1分足の最新unixtime以降の1分足から生成するため、
+  ストリーミング収集でアップロードした1分足が上位の時間足に集計されない)
+・切断された場合は再接続し、購読時のスナップショットで切断中の足を補う
+
+実行方法(crypto-collectorのディレクトリで実行する。共通モジュールはsrc/sharedから読み込む)
+    PYTHONPATH=../../shared python stream.py
+"""
+import asyncio
+import json
+import os
+import signal
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+import aiohttp
+import numpy as np
+from candles import CandleBatch
+from main import CryptoSource, resample_mode, tickers
+from pipeline import (
+    get_bigquery_client,
+    load_recently_unixtime,
+    log_run_spans,
+    publish_error_report,
+    save_unixtime_manifest,
+    unixtime_manifest_retries,
+    update_recently_unixtime,
+    upload_output,
+    upload_run_manifest
+)
+from runreport import RunReport
+
+
+# 暗号資産データ取得先API(kraken API websocket v2)
+kraken_ws_url = os.getenv("KRAKEN_WS_URL", "wss://ws.kraken.com/v2")
+# 確定した足をアップロードする間隔(秒)
+# アップロードごとにcsv-to-bigqueryが系列ごとに1回の読み込みジョブを実行し、
+# 読み込みジョブはテーブル当たり1日1,500回が上限となるため、既定では5分ごとにまとめてアップロードする
+# (5分ごとで1日288回。定期実行のcrypto-collectorと合わせても上限に余裕を残す)
+# 1分程度まで短くする場合は、csv-to-bigqueryをLOAD_MERGE_MODE=true(一時テーブルへの読み込みとMERGE)で実行する
+stream_flush_seconds = float(os.getenv("CRYPTO_STREAM_FLUSH_SECONDS", "300"))
+# 足の終了後、遅れて届く更新を待つ秒数
+stream_close_grace_seconds = float(
+    os.getenv("CRYPTO_STREAM_CLOSE_GRACE_SECONDS", "2")
+)
+# 最新UnixTime管理テーブル(BigQuery)を更新する間隔(秒)
+# マニフェストはアップロードごとに更新し、テーブルはDMLの実行回数を抑えるため間隔を空けて更新する
+stream_bigquery_seconds = 300
+# 再接続までの待ち時間の上限(秒)
+stream_reconnect_max_seconds = 60
+# 購読する時間足
+stream_period = {"name": "1M", "interval": 1, "seconds": 60}
+# アップロードしたファイルの一覧・計測結果に使う関数名
+stream_function_name = "crypto-collector-stream"
+
+
+def main():
+    asyncio.run(run_stream())
+
+
+async def run_stream(url: str = kraken_ws_url, stop: asyncio.Event = None):
+    """
+    stopが設定されるまで受信とアップロードを続ける
+    受信・アップロードのいずれかが失敗した場合は、確定済みの足をアップロードしてからエラーとする
+    """
+    if resample_mode:
+        raise Exception(
+            "crypto stream cannot run with CRYPTO_RESAMPLE_MODE=true"
+        )
+
+    if stop is None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+
+    unixtimes, generation = await asyncio.to_thread(
+        load_recently_unixtime, CryptoSource.function_name
+    )
+    stream = CryptoStream(unixtimes, generation)
+    symbols = {ticker["ws_symbol"]: ticker for ticker in tickers}
+
+    tasks = [
+        asyncio.create_task(receive(url, symbols, stream.buffer, stop)),
+        asyncio.create_task(stream.flush_periodically()),
+        asyncio.create_task(stop.wait())
+    ]
+    try:
+        done, _ = await asyncio.wait(
+            tasks, return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # 終了時点で確定している足をアップロードする
+        await stream.flush(time.time())
+
+    for task in done:
+        task.result()
+
+
+class BarBuffer:
+    """
+    受信した足を系列ごとに保持し、確定した足を取り出す
+    """
+
+    def __init__(self, unixtimes: dict):
+        # 系列ごとのアップロード済みの最新unixtime(TABLE_NAME → UNIX_TIME)
+        self.unixtimes = dict(unixtimes)
+        # 系列ごとの未確定の足(TABLE_NAME → {足の開始時刻: (始値, 高値, 安値, 終値, 出来高)})
+        self.bars = {}
+
+    def update(self, table_name: str, begin: int, bar: tuple):
+        """
+        足を追加・更新する(アップロード済みの足の更新は無視する)
+        """
+        if begin <= self.unixtimes.get(table_name, 0):
+            return
+        self.bars.setdefault(table_name, {})[begin] = bar
+
+    def pop_closed(self, now: float):
+        """
+        終了からstream_close_grace_seconds以上経過した足を、系列ごとのCandleBatchで取り出す
+        """
+        limit = now - stream_close_grace_seconds - stream_period["seconds"]
+
+        closed = {}
+        for table_name, bars in self.bars.items():
+            begins = sorted(begin for begin in bars if begin <= limit)
+            if not begins:
+                continue
+
+            opens, highs, lows, closes, volumes = zip(
+                *(bars.pop(begin) for begin in begins)
+            )
+            closed[table_name] = CandleBatch(
+                begins, opens, highs, lows, closes, volumes
+            )
+            self.unixtimes[table_name] = begins[-1]
+
+        return closed
+
+    def advance(self, unixtimes: dict):
+        """
+        他の実行(定期実行のcrypto-collector)でアップロードされた足を、アップロード済みとして除く
+        """
+        for table_name, unixtime in unixtimes.items():
+            if unixtime <= self.unixtimes.get(table_name, 0):
+                continue
+            self.unixtimes[table_name] = unixtime
+
+            bars = self.bars.get(table_name, {})
+            for begin in [begin for begin in bars if begin <= unixtime]:
+                del bars[begin]
+
+
+class CryptoStream:
+    """
+    確定した足をGCSへアップロードし、最新unixtimeを更新する
+    """
+
+    def __init__(self, unixtimes: dict, generation):
+        self.buffer = BarBuffer(unixtimes)
+        # 最新unixtime管理用マニフェストの最後に取得・保存した内容と世代番号
+        self.unixtimes = unixtimes
+        self.generation = generation
+        # 最新UnixTime管理テーブルへ未反映のunixtime
+        self.pending_bigquery = {}
+        self.bigquery_updated = time.monotonic()
+        self.tables = {
+            f"{ticker['table']}_{stream_period['name']}": ticker
+            for ticker in tickers
+        }
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(stream_flush_seconds)
+            await self.flush(time.time())
+
+    async def flush(self, now: float):
+        # 受信と同じスレッドで確定した足を取り出し、アップロードは別スレッドで行う
+        closed = self.buffer.pop_closed(now)
+        if closed:
+            await asyncio.to_thread(self.upload, closed)
+            # 最新unixtimeの取得・保存で判明した他の実行のアップロード済みの足を、受信中の足からも除く
+            self.buffer.advance(self.unixtimes)
+
+    def upload(self, closed: dict):
+        """
+        確定した足を系列ごとにGCSへアップロードする
+        """
+        report = RunReport(stream_function_name, log_spans=log_run_spans)
+        now = datetime.now(ZoneInfo("Asia/Tokyo"))
+        # 定期実行のcrypto-collector・終了時のアップロードと重複しないよう、
+        # マイクロ秒まで含めたパスへアップロードする
+        execTime = now.strftime("%Y%m%d_%Hh%Mm%Ss%f") + "_stream"
+
+        try:
+            # 前回の保存後に定期実行のcrypto-collectorがアップロードした足を除く
+            with report.span("load_recently_unixtime"):
+                self.unixtimes, self.generation = load_recently_unixtime(
+                    CryptoSource.function_name
+                )
+
+            uploaded_paths = []
+            updated_unixtimes = {}
+            for table_name, candles in closed.items():
+                candles = candles[
+                    candles.times > self.unixtimes.get(table_name, 0)
+                ]
+                if len(candles) == 0:
+                    continue
+
+                output = {
+                    "table_ticker": self.tables[table_name]["table"],
+                    "period": stream_period["name"],
+                    "table_name": table_name,
+                    "df": candles.to_df()
+                }
+                uploaded_paths.append(upload_output(output, execTime, report))
+                updated_unixtimes[table_name] = int(candles.times[-1])
+
+            # 全ての足が定期実行のcrypto-collectorでアップロード済みの場合
+            if not uploaded_paths:
+                report.summary()
+                return
+
+            with report.span("upload_run_manifest", rows=len(uploaded_paths)):
+                upload_run_manifest(
+                    stream_function_name,
+                    execTime,
+                    uploaded_paths,
+                    {"index": 0, "count": 1}
+                )
+
+            self.save_unixtimes(updated_unixtimes, report)
+
+            # 足の終了からアップロードの完了までの秒数
+            report.update(
+                files=len(uploaded_paths),
+                updated_tables=len(updated_unixtimes),
+                delay_seconds=round(
+                    time.time() - stream_period["seconds"]
+                    - max(updated_unixtimes.values()),
+                    3
+                )
+            )
+        except Exception as e:
+            report.summary(error=e)
+            publish_error_report(stream_function_name, str(e))
+            raise e
+        report.summary()
+
+    def save_unixtimes(self, updated_unixtimes: dict, report: RunReport):
+        """
+        最新unixtimeをマニフェストへ反映し、stream_bigquery_seconds間隔で管理テーブルへ反映する
+        定期実行のcrypto-collectorと同じマニフェストを更新するため、競合した場合は再試行する
+        """
+        with report.span(
+            "save_unixtime_manifest", rows=len(updated_unixtimes)
+        ):
+            # 保存後の世代番号を残し、次回の保存で競合による再取得が起きないようにする
+            self.unixtimes, self.generation = save_unixtime_manifest(
+                CryptoSource.function_name,
+                self.unixtimes,
+                updated_unixtimes,
+                self.generation,
+                unixtime_manifest_retries
+            )
+
+        self.pending_bigquery.update(updated_unixtimes)
+        if time.monotonic() - self.bigquery_updated < stream_bigquery_seconds:
+            return
+
+        with report.span(
+            "update_recently_unixtime", rows=len(self.pending_bigquery)
+        ):
+            update_recently_unixtime(
+                get_bigquery_client(), self.pending_bigquery
+            )
+        self.pending_bigquery = {}
+        self.bigquery_updated = time.monotonic()
+
+
+async def receive(url: str, symbols: dict, buffer: BarBuffer, stop):
+    """
+    websocketで足を購読し、受信した足をbufferへ追加する
+    切断された場合は、待ち時間を倍にしながら再接続する
+    """
+    delay = 1
+    async with aiohttp.ClientSession() as session:
+        while not stop.is_set():
+            try:
+                async with session.ws_connect(url, heartbeat=30) as ws:
+                    await ws.send_json({
+                        "method": "subscribe",
+                        "params": {
+                            "channel": "ohlc",
+                            "symbol": list(symbols),
+                            "interval": stream_period["interval"],
+                            "snapshot": True
+                        }
+                    })
+                    async for message in ws:
+                        if message.type != aiohttp.WSMsgType.TEXT:
+                            break
+                        handle_message(
+                            json.loads(message.data), symbols, buffer
+                        )
+                        delay = 1
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(json.dumps({
+                    "function": stream_function_name,
+                    "event": "disconnected",
+                    "error": str(e)
+                }))
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, stream_reconnect_max_seconds)
+
+
+def handle_message(message: dict, symbols: dict, buffer: BarBuffer):
+    """
+    websocketのメッセージのうち、購読した足(スナップショット・更新)をbufferへ追加する
+    """
+    if message.get("method") == "subscribe" and not message.get("success"):
+        raise Exception(
+            f"failed to subscribe kraken websocket: {message.get('error')}"
+        )
+    if message.get("channel") != "ohlc":
+        return
+
+    for row in message.get("data", []):
+        ticker = symbols.get(row["symbol"])
+        if ticker is None:
+            continue
+
+        buffer.update(
+            f"{ticker['table']}_{stream_period['name']}",
+            parse_interval_begin(row["interval_begin"]),
+            (
+                float(row["open"]),
+                float(row["high"]),
+                float(row["low"]),
+                float(row["close"]),
+                float(row["volume"])
+            )
+        )
+
+
+def parse_interval_begin(value: str):
+    """
+    足の開始時刻(RFC3339, ナノ秒まで)をunixtimeに変換する
+    """
+    return int(np.datetime64(value.rstrip("Z"), "s").astype("int64"))
+
+
+if __name__ == "__main__":
+    main()
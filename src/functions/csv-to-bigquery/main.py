@@ -1,9 +1,53 @@
+import json
 import os
+import re
 import time
+from functools import lru_cache
 from google.cloud import bigquery
-from google.cloud.pubsub import PublisherClient
 
 project_id = os.getenv('GCP_PROJECT_ID')
+# 金融データのテーブル構成
+# ・series: 系列(<ticker>_<period>)ごとのテーブル
+# ・consolidated: 全系列を1つのテーブル(CLOSE_TIMEの月で分割し、SYMBOL, PERIODでクラスタ化)にまとめる
+table_layout = os.getenv('MARKET_TABLE_LAYOUT', 'series')
+# 全系列をまとめるテーブル名(settings/bigquery/schema/MARKET_PRICE_CONSOLIDATED_schema.json)
+consolidated_table = os.getenv('MARKET_PRICE_TABLE', 'MARKET_PRICE')
+# 実行単位のファイル一覧(<dataset>/_runs/...)を元にまとめて取り込むか
+# 全系列をまとめたテーブルへは、ファイルごとに取り込むとMERGE(DML)が同じテーブルへ集中し、
+# テーブル当たりの同時実行数の上限(実行中2, 待機中20)を超えるため、常にまとめて取り込む
+batch_load = (
+    os.getenv('LOAD_BATCH_MODE', 'false') == 'true'
+    or table_layout == 'consolidated'
+)
+# 一時テーブルへ読み込んでからUNIX_TIMEをキーとしてMERGEするか
+# (同じファイルを再度取り込んでも重複した行が追加されない)
+merge_load = os.getenv('LOAD_MERGE_MODE', 'false') == 'true'
+# MERGEで取り込む際の一時テーブル名の接頭辞
+staging_table_prefix = '_STAGING_'
+
+# 取得済みのテーブル情報(table_id → Table)。インスタンスが再利用される間は使い回す
+table_cache = {}
+
+# 取り込み対象のファイル形式(拡張子 → BigQueryのファイル形式)
+source_formats = {
+    '.csv': bigquery.SourceFormat.CSV,
+    '.parquet': bigquery.SourceFormat.PARQUET,
+}
+
+# MARKET_PRICEテーブルのスキーマ(settings/bigquery/schema/MARKET_PRICE_schema.json)
+market_price_schema = [
+    bigquery.SchemaField('UNIX_TIME', 'INTEGER', description='UnixTime(キー)'),
+    bigquery.SchemaField('OPEN_PRICE', 'FLOAT', description='始値'),
+    bigquery.SchemaField('HIGH_PRICE', 'FLOAT', description='高値'),
+    bigquery.SchemaField('LOW_PRICE', 'FLOAT', description='低値'),
+    bigquery.SchemaField('CLOSE_PRICE', 'FLOAT', description='終値'),
+    bigquery.SchemaField('VOLUME', 'FLOAT', description='取引量'),
+    bigquery.SchemaField(
+        'QUOTE_VOLUME', 'FLOAT', description='取引量(通貨ペア)'
+    ),
+    bigquery.SchemaField('CLOSE_TIME', 'TIMESTAMP', description='日時'),
+]
+market_price_columns = [field.name for field in market_price_schema]
 
 
 def handler(data, context):
@@ -19,40 +63,296 @@ def csv_to_bigquery(data):
     bucket: str = data['bucket']
     # アップロードされたcsvファイルのパス
     file_path: str = data["name"]
+
+    # 実行単位のファイル一覧の場合、一覧のファイルをまとめて取り込む
+    if is_run_manifest(file_path):
+        if batch_load:
+            load_run_manifest(bucket, file_path)
+        return
+
+    # 金融データのファイル以外(unixtime管理用マニフェストなど)は取り込まない
+    source_format = get_source_format(file_path)
+    if source_format is None:
+        return
+
+    # バッチ取り込みモードの場合、実行単位のファイル一覧でまとめて取り込む
+    if batch_load:
+        return
+
     gcs_uri = f'gs://{bucket}/{file_path}'
 
     dataset, table_name = get_table_name(file_path)
     table_id = f'{dataset}.{table_name}'
+    _, ticker, period = get_series(file_path)
 
-    client = bigquery.Client(project_id)
-    job_config = bigquery.LoadJobConfig()
-    job_config.autodetect = True
-    job_config.source_format = bigquery.SourceFormat.CSV
-    job_config.write_disposition = 'WRITE_APPEND'
+    client = get_bigquery_client()
+
+    # MERGEで取り込む場合、ファイルの実行日時を一時テーブルの識別子とする
+    if merge_load:
+        run_id = file_path.split('/')[2]
+        groups = {(table_id, ticker, period, source_format): [gcs_uri]}
+        merge_groups(client, groups, run_id)
+        return
 
     load_job = client.load_table_from_uri(
         gcs_uri,
-        client.get_table(table_id),
-        job_config=job_config
+        get_table(client, table_id),
+        job_config=create_load_job_config(source_format)
     )
     load_job.result()
 
 
+def load_run_manifest(bucket: str, file_path: str):
+    # 実行単位のファイル一覧を取得し、系列・ファイル形式ごとに1回の読み込みジョブで取り込む
+    blob = get_storage_client().bucket(bucket).blob(file_path)
+    files = json.loads(blob.download_as_bytes())['files']
+
+    groups = {}
+    for gcs_path in files:
+        source_format = get_source_format(gcs_path)
+        if source_format is None:
+            continue
+        dataset, table_name = get_table_name(gcs_path)
+        _, ticker, period = get_series(gcs_path)
+        key = (f'{dataset}.{table_name}', ticker, period, source_format)
+        groups.setdefault(key, []).append(f'gs://{bucket}/{gcs_path}')
+
+    client = get_bigquery_client()
+
+    # MERGEで取り込む場合、ファイル一覧の実行日時と関数名を一時テーブルの識別子とする
+    # 全系列をまとめたテーブルへは、系列(SYMBOL, PERIOD)を付与するため常にMERGEで取り込む
+    if merge_load or table_layout == 'consolidated':
+        _, _, exec_time, manifest_name = file_path.split('/')
+        run_id = f'{exec_time}_{os.path.splitext(manifest_name)[0]}'
+        merge_groups(client, groups, run_id)
+        return
+
+    # 読み込みジョブを全て投入してから完了を待つことで、ジョブを並行して実行する
+    load_jobs = []
+    for (table_id, _, _, source_format), gcs_uris in groups.items():
+        load_job = client.load_table_from_uri(
+            gcs_uris,
+            get_table(client, table_id),
+            job_config=create_load_job_config(source_format)
+        )
+        load_jobs.append((table_id, load_job))
+
+    wait_load_jobs(load_jobs)
+
+
+def merge_groups(client: bigquery.Client, groups: dict, run_id: str):
+    # 系列・ファイル形式ごとのファイルを一時テーブルへ読み込み、
+    # 全テーブルのMERGEと一時テーブルの削除を1回のスクリプトで実行する
+    # 一時テーブルは実行ごとに同じ名前で上書きするため、再実行しても結果は変わらない
+    # groups: (table_id, ticker, period, ファイル形式) → ファイルのURIの一覧
+    staging_tables = {}
+    load_jobs = []
+    for (table_id, ticker, period, source_format), gcs_uris in groups.items():
+        dataset = table_id.split('.')[0]
+        staging_id = get_staging_table_id(
+            dataset, f'{ticker}_{period}', source_format, run_id
+        )
+        job_config = create_load_job_config(source_format)
+        job_config.write_disposition = 'WRITE_TRUNCATE'
+        load_job = client.load_table_from_uri(
+            gcs_uris, staging_id, job_config=job_config
+        )
+        load_jobs.append((table_id, load_job))
+        staging_tables.setdefault((table_id, period), []).append(
+            (staging_id, ticker)
+        )
+
+    wait_load_jobs(load_jobs)
+
+    if not staging_tables:
+        return
+
+    client.query(create_merge_script(staging_tables)).result()
+
+
+def create_merge_script(staging_tables: dict):
+    # テーブル・時間足ごとに一時テーブルの行を重複排除してMERGEし、一時テーブルを削除するスクリプトを生成する
+    # staging_tables: (table_id, period) → [(一時テーブルのtable_id, ticker)]
+    consolidated = table_layout == 'consolidated'
+    # 全系列をまとめたテーブルは、系列(SYMBOL, PERIOD)とUNIX_TIMEをキーとする
+    keys = ['SYMBOL', 'PERIOD', 'UNIX_TIME'] if consolidated else ['UNIX_TIME']
+    columns = keys + [
+        column for column in market_price_columns if column not in keys
+    ]
+    update = ', '.join(
+        f'{column} = S.{column}' for column in columns if column not in keys
+    )
+    insert = ', '.join(columns)
+    values = ', '.join(f'S.{column}' for column in columns)
+    group_by = ', '.join(f'S.{key}' for key in keys)
+    source_columns = ', '.join(market_price_columns)
+    on = ' AND '.join(f'T.{key} = S.{key}' for key in keys)
+
+    # 全系列をまとめたテーブルは、取り込む期間の分割と系列のクラスタのみを読み込むよう、
+    # 取り込む足のCLOSE_TIMEの範囲と銘柄・時間足で絞り込む
+    # (クラスタはSYMBOL, PERIODの順のため、SYMBOLを絞り込まないとクラスタによる絞り込みは効かない)
+    statements = []
+    if consolidated:
+        statements.append('DECLARE min_time, max_time TIMESTAMP;')
+
+    for (table_id, period), staging in staging_tables.items():
+        selects = []
+        for staging_id, ticker in staging:
+            series = ''
+            if consolidated:
+                series = f"'{ticker}' AS SYMBOL, '{period}' AS PERIOD, "
+            selects.append(
+                f'SELECT {series}{source_columns} FROM `{staging_id}`'
+            )
+        sources = '\n                    UNION ALL\n                    '.join(
+            selects
+        )
+
+        condition = on
+        if consolidated:
+            statements.append(f'''
+            SET (min_time, max_time) = (
+                SELECT AS STRUCT MIN(CLOSE_TIME), MAX(CLOSE_TIME) FROM (
+                    {sources}
+                )
+            );''')
+            symbols = ', '.join(
+                sorted({f"'{ticker}'" for _, ticker in staging})
+            )
+            condition = (
+                f"{on} AND T.SYMBOL IN ({symbols}) AND T.PERIOD = '{period}'"
+                ' AND T.CLOSE_TIME BETWEEN min_time AND max_time'
+            )
+
+        statements.append(f'''
+            MERGE
+                `{table_id}` AS T
+            USING (
+                SELECT AS VALUE ANY_VALUE(S) FROM (
+                    {sources}
+                ) AS S
+                GROUP BY {group_by}
+            ) AS S
+            ON
+                {condition}
+            WHEN MATCHED THEN
+                UPDATE SET {update}
+            WHEN NOT MATCHED THEN
+                INSERT ({insert}) VALUES ({values});
+        ''')
+        statements.extend(
+            f'DROP TABLE IF EXISTS `{staging_id}`;'
+            for staging_id, _ in staging
+        )
+
+    return '\n'.join(statements)
+
+
+def get_staging_table_id(
+    dataset: str, table_name: str, source_format: str, run_id: str
+):
+    # 一時テーブルのtable_id: <dataset>._STAGING_<ticker>_<period>_<run_id>_<format>
+    suffix = re.sub(r'[^0-9A-Za-z_]', '_', f'{run_id}_{source_format}')
+
+    return f'{dataset}.{staging_table_prefix}{table_name}_{suffix}'
+
+
+def wait_load_jobs(load_jobs: list):
+    # 全ての読み込みジョブの完了を待ち、失敗したジョブがある場合はまとめてエラーとする
+    errors = []
+    for table_id, load_job in load_jobs:
+        try:
+            load_job.result()
+        except Exception as e:
+            errors.append(f'{table_id}: {e}')
+
+    if errors:
+        raise Exception('\n'.join(errors))
+
+
+def create_load_job_config(source_format: str):
+    # ファイル形式に応じた読み込みジョブの設定を生成する
+    job_config = bigquery.LoadJobConfig()
+    job_config.source_format = source_format
+    if source_format == bigquery.SourceFormat.PARQUET:
+        # parquetはスキーマを固定して取り込む
+        job_config.schema = market_price_schema
+    else:
+        job_config.autodetect = True
+    job_config.write_disposition = 'WRITE_APPEND'
+
+    return job_config
+
+
+def get_table(client: bigquery.Client, table_id: str):
+    # テーブル情報を取得する(取得済みの場合はキャッシュを返す)
+    if table_id not in table_cache:
+        table_cache[table_id] = client.get_table(table_id)
+    return table_cache[table_id]
+
+
+def is_run_manifest(file_path: str):
+    # file_path: <dataset>/_runs/YYYYMMDD_HHh/<function>[-<index>-of-<count>].json
+    split_slash = file_path.split('/')
+    return len(split_slash) == 4 and split_slash[1] == '_runs'
+
+
+def get_source_format(file_path: str):
+    # 拡張子からBigQueryのファイル形式を返す(取り込み対象外の場合はNone)
+    _, extension = os.path.splitext(file_path)
+    return source_formats.get(extension)
+
+
 def get_table_name(file_path: str):
-    # file_path: <dataset>/<ticker>/YYYYMMDD_HHh/<period>.csv
-    # table_name: <ticker>_<period>
+    # file_path: <dataset>/<ticker>/YYYYMMDD_HHh/<period>.<csv|parquet>
+    # table_name: <ticker>_<period>(全系列をまとめる場合はMARKET_PRICE)
+    dataset, ticker, period = get_series(file_path)
+
+    if table_layout == 'consolidated':
+        return dataset, consolidated_table
+
+    return dataset, f'{ticker}_{period}'
+
+
+def get_series(file_path: str):
+    # file_path: <dataset>/<ticker>/YYYYMMDD_HHh/<period>.<csv|parquet>
+    # ファイルのデータセット名・ticker・時間足を返す
 
     split_slash = file_path.split('/')
     dataset = split_slash[0]
     ticker = split_slash[1]
     period = split_slash[-1].split('.')[0]
 
-    return dataset, f'{ticker}_{period}'
+    return dataset, ticker, period
+
+
+# BigQueryのクライアントを返す(インスタンスが再利用される間は同じクライアントを使い回す)
+@lru_cache(maxsize=None)
+def get_bigquery_client():
+    return bigquery.Client(project_id)
+
+
+# Cloud Storageのクライアントを返す(インスタンスが再利用される間は同じクライアントを使い回す)
+# バッチ取り込みモードでのみ使用するため、初回の使用時に読み込む
+@lru_cache(maxsize=None)
+def get_storage_client():
+    from google.cloud.storage import Client as StorageClient
+
+    return StorageClient(project_id)
+
+
+# Pub/Subのクライアントを返す(インスタンスが再利用される間は同じクライアントを使い回す)
+# エラーの通知にのみ使用するため、初回の使用時に読み込む
+@lru_cache(maxsize=None)
+def get_publisher_client():
+    from google.cloud.pubsub import PublisherClient
+
+    return PublisherClient()
 
 
 # エラー通知用topicへpublishする
 def publish_error_report(error: str):
-    publisher = PublisherClient()
+    publisher = get_publisher_client()
     error_report_topic = os.getenv('ERROR_REPORT_TOPIC')
     topic_name = f'projects/{project_id}/topics/{error_report_topic}'
 
@@ -1,5 +1,11 @@
 import base64
+import hashlib
+import json
 import os
+import re
+import time
+import uuid
+from functools import lru_cache
 from typing import TypedDict
 from zoneinfo import ZoneInfo
 import requests
@@ -19,6 +25,24 @@ class PubSubMessage(TypedDict):
 
 # slackのwebhookURL
 webhook_url = os.getenv("SLACK_WEBHOOK_URL")
+# 集約期間ごとにエラーをまとめて通知するか
+aggregate_mode = os.getenv("ERROR_REPORT_AGGREGATE", "false") == "true"
+# 集約中のエラーを記録するバケット名
+report_bucket = os.getenv("ERROR_REPORT_BUCKET")
+# 集約期間(秒)
+aggregate_window_seconds = int(os.getenv("ERROR_REPORT_WINDOW_SECONDS", "30"))
+# 集約期間の終了後、遅れて記録されるエラーを待つ秒数
+aggregate_grace_seconds = 5
+# 集約中のエラーと、集約期間ごとの通知の担当を記録するパス
+pending_prefix = "_error_report/pending/"
+claim_prefix = "_error_report/claims/"
+# 1回の通知に載せるエラーの種類の上限(slackのブロック数の上限は50)
+digest_max_groups = 20
+# 1回の一括削除で削除するオブジェクト数の上限
+delete_batch_size = 100
+
+# slackへのリクエストで使い回すセッション(keep-aliveで接続を再利用する)
+session = requests.Session()
 
 
 def handler(event: PubSubMessage, context):
@@ -26,7 +50,7 @@ def handler(event: PubSubMessage, context):
     エンドポイント
     """
     try:
-        report_error(event)
+        report_error(event, context)
     except Exception as e:
         # ここで何かしらエラーが起こった場合は、ループが起きないよう通知せず、ログに出力するのみとする。
         now = datetime.now(ZoneInfo("Asia/Tokyo"))
@@ -34,9 +58,10 @@ def handler(event: PubSubMessage, context):
         raise e
 
 
-def report_error(event: PubSubMessage):
+def report_error(event: PubSubMessage, context=None):
     """
     エラー内容をslackで通知します
+    集約モードの場合は、集約期間ごとにエラーをまとめて通知します
     """
     error = base64.b64decode(event["data"]).decode("utf-8")
     projectId = event["attributes"]["projectId"]
@@ -46,6 +71,12 @@ def report_error(event: PubSubMessage):
     eventTime = datetime.fromtimestamp(unixtime, ZoneInfo("Asia/Tokyo"))
     print(f"functionName: {functionName}, Time: {eventTime}, error: {error}")
 
+    if aggregate_mode:
+        # 再試行された場合も同じオブジェクトへ記録するよう、イベントIDで記録する
+        event_id = getattr(context, "event_id", None) or uuid.uuid4().hex
+        buffer_error(event_id, projectId, functionName, unixtime, error)
+        return
+
     # slackへ通知
     post_slack_message(projectId, functionName, eventTime, error)
 
@@ -86,13 +117,180 @@ def post_slack_message(
             }
         },
     ]
+    # slackへpostする
+    post_slack_blocks(blocks)
+
+
+def buffer_error(
+    event_id: str, projectId: str, functionName: str, unixtime: int, error: str
+):
+    """
+    エラーを受け取った時刻の集約期間へGCSに記録し、
+    期間の最初のエラーを受け取ったインスタンスのみが、期間の終了後にまとめて通知する
+    それ以外のインスタンスは記録のみで終了するため、エラーが多発しても通知は期間ごとに1回となる
+    """
+    bucket = get_bucket()
+    window = int(time.time())
+    window -= window % aggregate_window_seconds
+
+    # オブジェクト名に集約キー(関数名とエラーの種類)を含め、通知時はオブジェクトの一覧のみで件数を数える
+    group = hashlib.sha1(
+        f"{functionName}\n{get_error_signature(error)}".encode("utf-8")
+    ).hexdigest()[:16]
+    blob = bucket.blob(f"{pending_prefix}{window}/{group}/{event_id}.json")
+    blob.upload_from_string(
+        json.dumps({
+            "projectId": projectId,
+            "functionName": functionName,
+            "eventTime": unixtime,
+            "error": error
+        }),
+        content_type="application/json"
+    )
+
+    # 集約期間の通知の担当を、最初に作成できたインスタンスのみが受け持つ
+    from google.api_core.exceptions import PreconditionFailed
+
+    claim = bucket.blob(f"{claim_prefix}{window}.json")
+    try:
+        claim.upload_from_string(
+            json.dumps({"eventId": event_id}),
+            content_type="application/json",
+            if_generation_match=0
+        )
+    except PreconditionFailed:
+        return
+
+    # 集約期間の終了まで待ってから、記録されたエラーをまとめて通知する
+    time.sleep(max(
+        window + aggregate_window_seconds + aggregate_grace_seconds
+        - time.time(),
+        0
+    ))
+    try:
+        send_digest(bucket, window)
+    finally:
+        # 集約期間の終了後は同じ期間の担当は作成されないため、通知後に担当の記録を削除する
+        # (通知に失敗したエラーの記録は残し、次の集約期間の通知に含める)
+        claim.delete()
+
+
+def send_digest(bucket, window: int):
+    """
+    集約期間window以前に記録されたエラーを、関数名とエラーの種類ごとの件数にまとめて1回で通知する
+    (前回までに通知に失敗したエラーも含める)
+    通知したエラーの記録は削除する
+    """
+    groups = {}
+    blobs = []
+    for blob in bucket.list_blobs(prefix=pending_prefix):
+        # blob.name: _error_report/pending/<window>/<group>/<event_id>.json
+        blob_window, group, _ = blob.name[len(pending_prefix):].split("/")
+        if int(blob_window) > window:
+            continue
+
+        blobs.append(blob)
+        summary = groups.setdefault(group, {
+            "count": 0, "first": blob, "last": blob.time_created
+        })
+        summary["count"] += 1
+        if blob.time_created < summary["first"].time_created:
+            summary["first"] = blob
+        summary["last"] = max(summary["last"], blob.time_created)
+
+    if not groups:
+        return
+
+    # 件数の多い順に、種類ごとに最初のエラーの内容のみを読み込む
+    ranked = sorted(groups.values(), key=lambda summary: -summary["count"])
+    for summary in ranked[:digest_max_groups]:
+        summary["sample"] = json.loads(summary["first"].download_as_bytes())
+
+    post_slack_digest(ranked, len(blobs))
+
+    client = bucket.client
+    for start in range(0, len(blobs), delete_batch_size):
+        with client.batch():
+            for blob in blobs[start:start + delete_batch_size]:
+                blob.delete()
+
+
+def get_error_signature(error: str):
+    """
+    エラーの種類を判定するため、エラー内容の1行目から数値を除いた文字列を返す
+    (unixtimeや件数などの数値のみが異なるエラーは同じ種類とする)
+    """
+    lines = error.strip().splitlines() or [""]
+
+    return re.sub(r"\d+", "#", lines[0])[:200]
+
+
+def post_slack_digest(ranked: list, total: int):
+    """
+    関数名とエラーの種類ごとの件数と、最初のエラーの内容をまとめてslackへ通知する
+    """
+    blocks = [
+        {
+            "type": "header",
+            "text": {
+                "type": "plain_text",
+                "text": f":warning:  {total} Errors ({len(ranked)} kinds)"
+                "  :warning:"
+            }
+        },
+    ]
+    for summary in ranked[:digest_max_groups]:
+        sample = summary["sample"]
+        first, last = (
+            created.astimezone(ZoneInfo("Asia/Tokyo")).strftime(
+                "%Y-%m-%d %H:%M:%S"
+            )
+            for created in (summary["first"].time_created, summary["last"])
+        )
+        blocks.append({
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": (
+                    f"*{sample['functionName']}* x {summary['count']}"
+                    f" ({sample['projectId']}, {first} - {last})\n"
+                    f"```{sample['error'][:1000]}```"
+                )
+            }
+        })
+
+    if len(ranked) > digest_max_groups:
+        others = ranked[digest_max_groups:]
+        blocks.append({
+            "type": "context",
+            "elements": [{
+                "type": "mrkdwn",
+                "text": f"and {len(others)} more kinds "
+                f"({sum(summary['count'] for summary in others)} errors)"
+            }]
+        })
+
+    post_slack_blocks(blocks)
+
+
+def post_slack_blocks(blocks: list):
     requestBody = {
         "blocks": blocks
     }
-    # slackへpostする
-    response = requests.post(webhook_url, json=requestBody)
+    response = session.post(webhook_url, json=requestBody)
 
     if response.status_code != 200:
         error_msg = f"Slack Webhook Error \
             [HTTP STATUS: {response.status_code}], [RESULT: {response.reason}]"
         raise Exception(error_msg)
+
+
+@lru_cache(maxsize=None)
+def get_bucket():
+    """
+    集約中のエラーを記録するバケットを返す(インスタンスが再利用される間は同じクライアントを使い回す)
+    集約モードでのみ使用するため、初回の使用時に読み込む
+    """
+    from google.cloud.storage import Client as StorageClient
+
+    return StorageClient().bucket(report_bucket)
@@ -1,19 +1,15 @@
 import asyncio
 import os
 import time
+from functools import lru_cache
 import aiohttp
-from google.cloud.pubsub import PublisherClient
+from google.auth import jwt
 from google.oauth2.id_token import fetch_id_token
 from google.auth.transport.requests import Request
-from google.cloud.bigquery import Client as BqClient, QueryJobConfig
 
 
 # GCPのプロジェクトID
 project_id = os.getenv("GCP_PROJECT_ID")
-# BigQueryのデータセット名
-dataset = os.getenv("BIGQUERY_DATASET")
-# 最新unixtime管理テーブル名
-recently_unixtime_table = os.getenv("BIGQUERY_UNIXTIME_TABLE")
 # crypto-collectorのエンドポイント
 crypto_collector_endpoint = os.getenv("CRYPTO_COLLECTOR_ENDPOINT")
 # stock-collectorのエンドポイント
@@ -22,6 +18,16 @@ stock_collector_endpoint = os.getenv("STOCK_COLLECTOR_ENDPOINT")
 fx_collector_endpoint = os.getenv("FX_COLLECTOR_ENDPOINT")
 # commodity-collectorのエンドポイント
 commodity_collector_endpoint = os.getenv("COMMODITY_COLLECTOR_ENDPOINT")
+# collectorごとのシャード数(取得対象の系列を分割し、別々の関数インスタンスで並行して収集する)
+collector_shards = int(os.getenv("COLLECTOR_SHARDS", "1"))
+# collectorへの同時リクエスト数の上限(全collectorのシャードで共有する)
+dispatch_concurrency = int(os.getenv("DISPATCH_CONCURRENCY", "4"))
+# IDトークンを有効期限のこの秒数前に更新する
+id_token_refresh_seconds = 300
+
+# 取得済みのIDトークン(audience → (IDトークン, 有効期限のunixtime))
+# インスタンスが再利用される間は、有効期限の前まで使い回す
+id_token_cache = {}
 
 
 def handler(event, context):
@@ -29,13 +35,15 @@ def handler(event, context):
     エンドポイント
     """
     try:
-        market_collector()
+        # 実行モード(collect: 収集, repair: 欠損の補完)はメッセージの属性で指定する
+        attributes = event.get("attributes") or {}
+        market_collector(attributes.get("mode", "collect"))
     except Exception as e:
         publish_error_report(str(e))
         raise e
 
 
-def market_collector():
+def market_collector(mode: str = "collect"):
     """
     金融データを収集する
     """
@@ -43,110 +51,183 @@ def market_collector():
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
 
-    loop.run_until_complete(request_tasks())
-
-    # unixtime管理テーブルの重複データを削除する
-    duplicate_unixtime()
+    try:
+        loop.run_until_complete(request_tasks(mode))
+    finally:
+        loop.close()
 
 
-async def request_tasks():
+async def request_tasks(mode: str):
     # 以下のデータを収集するAPIを実行する
     # ・暗号資産データ
     # ・株指標データ
     # ・為替通貨データ
     # ・コモディデータ
-    request_list = [
-        request_crypto_collector(),
-        # request_stock_collector(),
-        # request_fx_collector(),
-        # request_commodity_collector()
+    semaphore = asyncio.Semaphore(max(dispatch_concurrency, 1))
+    # 全てのリクエストで1つのセッション(コネクションプール)を共有する
+    connector = aiohttp.TCPConnector(limit=max(dispatch_concurrency, 1))
+    async with aiohttp.ClientSession(connector=connector) as session:
+        request_list = [
+            request_crypto_collector(session, semaphore, mode),
+            # request_stock_collector(session, semaphore, mode),
+            # request_fx_collector(session, semaphore, mode),
+            # request_commodity_collector(session, semaphore, mode)
+        ]
+        # いずれかのcollectorが失敗した場合も、全collectorの完了を待ってからエラーとする
+        results = await asyncio.gather(
+            *request_list, return_exceptions=True
+        )
+
+    errors = [
+        str(result) for result in results if isinstance(result, Exception)
     ]
-    await asyncio.gather(*request_list, return_exceptions=True)
+    if errors:
+        raise Exception("\n".join(errors))
 
 
-async def request_crypto_collector():
+async def request_crypto_collector(
+    session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, mode: str
+):
     """
     暗号資産データ収集APIを実行する
     """
-    await request_google_functions(crypto_collector_endpoint)
+    await request_collector_shards(
+        session, crypto_collector_endpoint, semaphore, mode
+    )
 
 
-async def request_stock_collector():
+async def request_stock_collector(
+    session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, mode: str
+):
     """
     株データ収集APIを実行する
     """
-    await request_google_functions(stock_collector_endpoint)
+    await request_collector_shards(
+        session, stock_collector_endpoint, semaphore, mode
+    )
 
 
-async def request_fx_collector():
+async def request_fx_collector(
+    session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, mode: str
+):
     """
     為替通貨データ収集APIを実行する
     """
-    await request_google_functions(fx_collector_endpoint)
+    await request_collector_shards(
+        session, fx_collector_endpoint, semaphore, mode
+    )
 
 
-async def request_commodity_collector():
+async def request_commodity_collector(
+    session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, mode: str
+):
     """
     コモディティデータ収集APIを実行する
     """
-    await request_google_functions(commodity_collector_endpoint)
+    await request_collector_shards(
+        session, commodity_collector_endpoint, semaphore, mode
+    )
 
 
-async def request_google_functions(url: str):
+async def request_collector_shards(
+    session: aiohttp.ClientSession,
+    url: str,
+    semaphore: asyncio.Semaphore,
+    mode: str
+):
+    """
+    collectorの取得対象をシャードに分割し、同時リクエスト数を制限しつつ並行してリクエストする
+    いずれかのシャードが失敗した場合も、全シャードの完了を待ってからエラーとする
+    """
+    # IDトークンはcollectorごとに1回だけ取得し、全シャードで共有する
+    id_token = await get_id_token(url)
+
+    async def request_shard(index: int):
+        body = {
+            "shard": {"index": index, "count": collector_shards},
+            "mode": mode
+        }
+        async with semaphore:
+            await request_google_functions(session, url, id_token, body)
+
+    results = await asyncio.gather(
+        *(request_shard(index) for index in range(collector_shards)),
+        return_exceptions=True
+    )
+
+    errors = [
+        str(result) for result in results if isinstance(result, Exception)
+    ]
+    if errors:
+        raise Exception("\n".join(errors))
+
+
+async def request_google_functions(
+    session: aiohttp.ClientSession, url: str, id_token: str, body: dict
+):
     """
     Google Cloud Functionsの関数をHTTPリクエストする
     """
-    auth_req = Request()
-    id_token = fetch_id_token(auth_req, url)
     headers = {
         "Authorization": f"Bearer {id_token}"
     }
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.post(url) as response:
-            if response.status != 200:
-                function_name = url.split("/")[:-1]
-                error_msg = f"{function_name} Error \
-                    [HTTP STATUS: {response.status}], \
-                        [RESULT: {response.reason}]"
-                raise Exception(error_msg)
-
-
-def duplicate_unixtime():
-    """
-    unixtime管理テーブルでTABLE_NAMEカラムが重複してるデータを削除する
-    """
-
-    client = BqClient(project_id)
-    table_id = f"{project_id}.{dataset}.{recently_unixtime_table}"
-
-    duplicate_query = f"""
-        SELECT
-            * EXCEPT(rowNumber)
-        FROM (
-            SELECT
-                *,
-                ROW_NUMBER() OVER (
-                    PARTITION BY TABLE_NAME ORDER BY UNIX_TIME DESC
-                ) as rowNumber
-            FROM
-                {table_id}
-        )
-        WHERE
-            rowNumber = 1;
+    async with session.post(url, json=body, headers=headers) as response:
+        if response.status != 200:
+            function_name = url.split("/")[:-1]
+            error_msg = f"{function_name} Error \
+                [HTTP STATUS: {response.status}], \
+                    [RESULT: {response.reason}]"
+            raise Exception(error_msg)
+
+
+async def get_id_token(audience: str):
+    """
+    audience(関数のURL)向けのIDトークンを返す
+    取得済みのトークンが有効期限の間近まで有効な場合は使い回し、
+    取得する場合はイベントループを止めないよう別スレッドで取得する
+    """
+    cached = id_token_cache.get(audience)
+    if cached is not None:
+        id_token, expiry = cached
+        if time.time() < expiry - id_token_refresh_seconds:
+            return id_token
+
+    loop = asyncio.get_running_loop()
+    id_token = await loop.run_in_executor(
+        None, fetch_id_token, get_auth_request(), audience
+    )
+
+    # 自身で取得したトークンのため署名は検証せず、有効期限のみ読み取る
+    expiry = jwt.decode(id_token, verify=False)["exp"]
+    id_token_cache[audience] = (id_token, expiry)
+
+    return id_token
+
+
+@lru_cache(maxsize=None)
+def get_auth_request():
+    """
+    IDトークン取得用のリクエストを返す(インスタンスが再利用される間は同じセッションを使い回す)
+    """
+    return Request()
+
+
+@lru_cache(maxsize=None)
+def get_publisher_client():
+    """
+    Pub/Subのクライアントを返す(インスタンスが再利用される間は同じクライアントを使い回す)
+    エラーの通知にのみ使用するため、初回の使用時に読み込む
     """
+    from google.cloud.pubsub import PublisherClient
 
-    job_config = QueryJobConfig()
-    job_config.destination = table_id
-    job_config.write_disposition = "WRITE_TRUNCATE"
-    job = client.query(duplicate_query, job_config=job_config)
-    job.result()
+    return PublisherClient()
 
 
 def publish_error_report(error: str):
     """
     エラー通知用topicへpublishする
     """
-    publisher = PublisherClient()
+    publisher = get_publisher_client()
     error_report_topic = os.getenv("ERROR_REPORT_TOPIC")
     topic_name = f"projects/{project_id}/topics/{error_report_topic}"
 
@@ -0,0 +1,1014 @@
+import json
+import os
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from io import BytesIO
+from queue import Full, Queue
+from typing import TYPE_CHECKING
+from zoneinfo import ZoneInfo
+import numpy as np
+import pandas as pd
+from google.api_core.exceptions import PreconditionFailed
+from google.cloud.storage import Client as StorageClient
+from runreport import RunReport
+
+# BigQuery・Pub/Sub・pyarrowは読み込みに時間がかかり、使用しない実行もあるため、初回の使用時に読み込む
+if TYPE_CHECKING:
+    from google.cloud.bigquery import Client as BqClient
+
+
+# GCPのプロジェクトID
+project_id = os.getenv("GCP_PROJECT_ID")
+# BigQueryのデータセット名
+dataset = os.getenv("BIGQUERY_DATASET")
+# 金融データ(csv)のアップロード先バケット名
+bucket_name = os.getenv("MARKET_DATA_BUCKET")
+# 最新unixtime管理テーブル名
+recently_unixtime_table = os.getenv("BIGQUERY_UNIXTIME_TABLE")
+# 金融データのテーブル構成(series: 系列ごとのテーブル, consolidated: 全系列を1つのテーブルにまとめる)
+market_table_layout = os.getenv("MARKET_TABLE_LAYOUT", "series")
+# 全系列をまとめるテーブル名
+consolidated_table = os.getenv("MARKET_PRICE_TABLE", "MARKET_PRICE")
+# マニフェストの更新が競合した場合の再試行回数
+unixtime_manifest_retries = 5
+# GCSへアップロードする金融データのファイル形式(csv or parquet)
+output_format = os.getenv("MARKET_DATA_FORMAT", "csv")
+# この行数以上のデータフレームは、分割して変換しながらGCSへストリーミングアップロードする
+streaming_upload_min_rows = int(
+    os.getenv("STREAMING_UPLOAD_MIN_ROWS", "100000")
+)
+# ストリーミングアップロードで1回に変換する行数
+upload_chunk_rows = 50000
+# ストリーミングアップロードで1回に送信するサイズ(256KBの倍数)
+upload_chunk_bytes = 8 * 1024 * 1024
+# 処理段階・系列ごとの計測結果を都度ログへ出力するか(falseの場合は実行の最後の集計のみ出力する)
+log_run_spans = os.getenv("RUN_REPORT_SPANS", "true") == "true"
+# 変換待ちの取得結果を先読みする件数
+pipeline_queue_size = int(os.getenv("PIPELINE_QUEUE_SIZE", "8"))
+# GCSへの同時アップロード数
+upload_concurrency = int(os.getenv("UPLOAD_CONCURRENCY", "4"))
+# 欠損の補完を試みる回数の上限(上限に達しても補完できない欠損は、取得元にデータが無いものとして欠損インデックスから除く)
+gap_repair_attempts = 3
+# collectorの実行モード(collect: 前回取得分以降を収集する, repair: 欠損インデックスの欠損を補完する)
+run_modes = ["collect", "repair"]
+
+# クライアントの生成を1回に限る(先読み用のスレッドと同時に生成しないようにする)
+client_lock = threading.Lock()
+
+
+class Source:
+    """
+    collectorの取得元(kraken API, yfinanceなど)ごとの処理
+
+    run_collectorは以下の順に呼び出す。
+    ・targets: 前回取得分のunixtimeから取得対象を求める
+    ・fetch: 取得対象を取得し、(取得単位, 取得結果)を順に返す(取得用のスレッドで実行する)
+    ・transform: 取得結果を整理・正規化し、アップロードするデータの一覧を返す
+      (table_ticker, period, table_name, dfを持つ辞書のリスト)
+    ・finish: 全てのアップロード後に、取得元ごとの状態を保存する
+
+    欠損の検出・補完(run_repair)では以下を使用する。
+    ・bar_seconds: 時間足ごとの足の間隔(秒)
+    ・is_session_break: 足が無い期間が取引時間外によるものか判定する
+    ・fetch_range: 欠損している期間を含む足を取得する(repair_concurrency件まで並行して呼び出す)
+    """
+
+    function_name = None
+    bar_seconds = {}
+    repair_concurrency = 1
+
+    def targets(self, unixtimes: dict, shard: dict):
+        raise NotImplementedError
+
+    def fetch(self, targets: list, report: RunReport):
+        raise NotImplementedError
+
+    def transform(self, work, response, report: RunReport):
+        raise NotImplementedError
+
+    def finish(self, shard: dict, report: RunReport):
+        pass
+
+    def is_session_break(self, period: str, start: int, end: int):
+        """
+        start〜end(足の開始時刻)の足が無いことが、取引時間外によるものか判定する
+        既定は24時間取引とし、常に欠損とみなす
+        """
+        return False
+
+    def fetch_range(self, table_name: str, start: int, end: int):
+        """
+        系列のstart〜endを含む足を取得し、アップロードするデータ(transformと同じ形式の辞書)を返す
+        取得元から取得できない系列の場合はNoneを返す
+        """
+        return None
+
+
+class FetchError:
+    """
+    取得用のスレッドで発生したエラー(変換側のスレッドで送出する)
+    """
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+# 取得結果の終わり
+end_of_items = object()
+
+
+def handle_request(source: Source, request):
+    """
+    collectorへのリクエストを処理する
+    実行の最後に計測結果の集計を出力し、エラーの場合はエラー通知用topicへpublishする
+    """
+    report = RunReport(source.function_name, log_spans=log_run_spans)
+    try:
+        shard = get_shard(request)
+        mode = get_mode(request)
+        report.update(shard=shard, mode=mode)
+        if mode == "repair":
+            run_repair(source, report, shard)
+        else:
+            run_collector(source, report, shard)
+    except Exception as e:
+        report.summary(error=e)
+        publish_error_report(source.function_name, str(e))
+        raise e
+    report.summary()
+
+
+def run_collector(source: Source, report: RunReport, shard: dict):
+    """
+    取得元のデータを収集し、GCSへアップロードする
+    取得・変換・アップロードは並行して実行し、
+    N+1件目の取得とN件目の変換・アップロードを重ねる
+    """
+    # BigQueryのクライアントは通常は最後のunixtime更新まで使わないため、読み込みを取得と重ねる
+    threading.Thread(target=preload_bigquery_client, daemon=True).start()
+
+    # 最新unixTimeを取得する
+    with report.span("load_recently_unixtime") as span:
+        unixtimes, manifest_generation = load_recently_unixtime(
+            source.function_name
+        )
+        span["rows"] = len(unixtimes)
+
+    now = datetime.now(ZoneInfo("Asia/Tokyo"))
+    execTime = now.strftime("%Y%m%d_%Hh")
+
+    # 今回の実行でunixtimeが更新されたテーブル(TABLE_NAME → UNIX_TIME)
+    updated_unixtimes = {}
+    # 今回の実行でGCSへアップロードしたファイルのパス
+    uploaded_paths = []
+
+    def transform(item):
+        work, response = item
+        return source.transform(work, response, report)
+
+    # 今回の実行で検出した欠損(TABLE_NAME → 欠損インデックスの項目)
+    detected_gaps = {}
+
+    def upload(output):
+        gcs_path = upload_output(output, execTime, report)
+        table_name = output["table_name"]
+        times = output["df"]["UNIX_TIME"].to_numpy(dtype="int64")
+        # 前回取得分の足から今回取得分の足までの欠損を検出する
+        gaps = find_gaps(
+            source, output["period"], times, unixtimes.get(table_name, 0)
+        )
+        # 取得データから最新のunixtimeを取得する
+        return output, gcs_path, int(times.max()), gaps
+
+    targets = source.targets(unixtimes, shard)
+    results = run_pipeline(source.fetch(targets, report), transform, upload)
+    for output, gcs_path, max_unixtime, gaps in results:
+        uploaded_paths.append(gcs_path)
+        # 取得したテーブルのunixtimeを更新対象とする
+        updated_unixtimes[output["table_name"]] = max_unixtime
+        if gaps:
+            detected_gaps[output["table_name"]] = {
+                "table_ticker": output["table_ticker"],
+                "period": output["period"],
+                "gaps": [[start, end, 0] for start, end in gaps]
+            }
+
+    # アップロードしたファイルの一覧をGCSへアップロードする
+    with report.span("upload_run_manifest", rows=len(uploaded_paths)):
+        upload_run_manifest(
+            source.function_name, execTime, uploaded_paths, shard
+        )
+
+    # 取得元ごとの状態を保存する
+    source.finish(shard, report)
+
+    # 検出した欠損を欠損インデックスへ追加する
+    # unixtimeの更新より先に保存し、保存に失敗した場合は次回の実行で再び検出する
+    if detected_gaps:
+        with report.span("update_gap_index", rows=len(detected_gaps)):
+            update_gap_index(
+                source.function_name,
+                lambda index: add_gaps(index, detected_gaps),
+                unixtime_manifest_retries + shard["count"] - 1
+            )
+
+    # unixtimeが更新されたテーブルをマニフェストとunixtime管理テーブルへ反映する
+    with report.span("save_unixtime_manifest", rows=len(updated_unixtimes)):
+        # 他のシャードの更新と競合しうるため、シャード数に応じて再試行する
+        save_unixtime_manifest(
+            source.function_name,
+            unixtimes,
+            updated_unixtimes,
+            manifest_generation,
+            unixtime_manifest_retries + shard["count"] - 1
+        )
+    with report.span("update_recently_unixtime", rows=len(updated_unixtimes)):
+        update_recently_unixtime(get_bigquery_client(), updated_unixtimes)
+
+    report.update(
+        targets=len(targets),
+        files=len(uploaded_paths),
+        updated_tables=len(updated_unixtimes),
+        gap_tables=len(detected_gaps)
+    )
+
+
+def run_repair(source: Source, report: RunReport, shard: dict):
+    """
+    欠損インデックスに記録した欠損を、系列ごとに欠損している期間のみ取得して補完する
+    取得は系列ごとに並行して実行し、欠損していた足のみをGCSへアップロードする
+    unixtimeは更新しない
+    """
+    function_name = source.function_name
+
+    with report.span("load_gap_index") as span:
+        index, _ = load_manifest(get_gap_index_path(function_name))
+        # 他のシャードが担当する系列は補完しない
+        entries = {
+            table_name: entry
+            for table_name, entry in (index or {}).items()
+            if in_shard(table_name, shard) and entry["gaps"]
+        }
+        span["rows"] = len(entries)
+
+    # 通常の収集と同じ時間帯に実行しても上書きしないよう、別のパスへアップロードする
+    now = datetime.now(ZoneInfo("Asia/Tokyo"))
+    execTime = now.strftime("%Y%m%d_%Hh") + "_repair"
+
+    # 系列ごとの補完できた足の開始時刻(TABLE_NAME → 配列)
+    filled = {}
+    # 今回の実行でGCSへアップロードしたファイルのパス
+    uploaded_paths = []
+
+    def fetch_table(item):
+        table_name, entry = item
+        start = min(gap[0] for gap in entry["gaps"])
+        end = max(gap[1] for gap in entry["gaps"])
+        with report.span("repair_fetch", table_name) as span:
+            output = source.fetch_range(table_name, start, end)
+            span["rows"] = 0 if output is None else len(output["df"])
+        return table_name, entry, output
+
+    def fetch():
+        return map_concurrently(
+            fetch_table, entries.items(), source.repair_concurrency
+        )
+
+    def transform(item):
+        table_name, entry, output = item
+        if output is None:
+            return []
+
+        # 欠損している足のみをアップロードする
+        df = output["df"]
+        times = df["UNIX_TIME"].to_numpy(dtype="int64")
+        mask = in_gaps(
+            times, entry["gaps"], source.bar_seconds[entry["period"]]
+        )
+        filled[table_name] = times[mask]
+        if not mask.any():
+            return []
+
+        return [{**output, "df": df[mask].reset_index(drop=True)}]
+
+    def upload(output):
+        return upload_output(output, execTime, report)
+
+    for gcs_path in run_pipeline(fetch(), transform, upload):
+        uploaded_paths.append(gcs_path)
+
+    # アップロードしたファイルの一覧をGCSへアップロードする
+    with report.span("upload_run_manifest", rows=len(uploaded_paths)):
+        upload_run_manifest(function_name, execTime, uploaded_paths, shard)
+
+    # 補完できなかった足を欠損として残し、試行回数を加算する
+    unrepaired = []
+    with report.span("update_gap_index", rows=len(entries)):
+        update_gap_index(
+            function_name,
+            lambda index: apply_repair(
+                source, index, entries, filled, unrepaired
+            ),
+            unixtime_manifest_retries + shard["count"] - 1
+        )
+
+    report.update(
+        gap_tables=len(entries),
+        files=len(uploaded_paths),
+        repaired_bars=sum(len(times) for times in filled.values()),
+        unrepaired_gaps=len(unrepaired)
+    )
+
+
+def run_pipeline(items, transform, upload):
+    """
+    取得・変換・アップロードを並行して実行し、アップロードの結果を変換した順に返す
+    ・取得: 取得用のスレッドでitemsを順に取り出し、最大pipeline_queue_size件まで先読みする
+    ・変換: 呼び出し元のスレッドで、取得結果をtransformで順に変換する
+    ・アップロード: 変換結果をuploadで最大upload_concurrency件まで並行してアップロードする
+    メモリ上には、先読みした取得結果とアップロード待ちの変換結果のみを保持する
+    """
+    queue = Queue(maxsize=max(pipeline_queue_size, 1))
+    stop = threading.Event()
+    producer = threading.Thread(
+        target=produce, args=(items, queue, stop), daemon=True
+    )
+    producer.start()
+
+    workers = max(upload_concurrency, 1)
+    pending = deque()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                item = queue.get()
+                if item is end_of_items:
+                    break
+                if isinstance(item, FetchError):
+                    raise item.error
+
+                for output in transform(item):
+                    pending.append(executor.submit(upload, output))
+
+                    # アップロード待ちが溜まった場合は、古い順に完了を待つ
+                    while len(pending) > workers * 2:
+                        yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        stop.set()
+        producer.join()
+
+
+def map_concurrently(func, items, workers: int):
+    """
+    itemsの要素ごとにfuncを最大workers件まで並行して実行し、結果をitemsと同じ順序で返す
+    executor.mapと異なり全件を先に投入せず、実行中の件数をworkers件までに抑えるため、
+    結果を受け取る側が遅い場合も、受け取り待ちの結果は最大workers件となる
+    途中で打ち切られた場合(closeされた場合)は、未実行のものを取り消し、実行中のもののみ完了を待つ
+    """
+    workers = max(workers, 1)
+    if workers <= 1:
+        yield from map(func, items)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def produce(items, queue: Queue, stop: threading.Event):
+    """
+    取得用のスレッドでitemsを順に取り出し、queueへ追加する
+    """
+    try:
+        for item in items:
+            if not put_item(queue, item, stop):
+                return
+        put_item(queue, end_of_items, stop)
+    except Exception as e:
+        put_item(queue, FetchError(e), stop)
+    finally:
+        # 変換側が途中で終了した場合は、取得を打ち切る
+        if stop.is_set() and hasattr(items, "close"):
+            items.close()
+
+
+def put_item(queue: Queue, item, stop: threading.Event):
+    """
+    queueへ追加する(変換側が終了した場合は追加せずFalseを返す)
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def get_mode(request):
+    """
+    リクエストボディの実行モード({"mode": "collect" or "repair"})を返す
+    指定が無い場合は、前回取得分以降を収集する
+    """
+    body = request.get_json(silent=True) or {}
+    mode = body.get("mode") or "collect"
+
+    if mode not in run_modes:
+        raise ValueError(f"invalid mode: {mode}")
+
+    return mode
+
+
+def get_shard(request):
+    """
+    リクエストボディのシャード指定({"shard": {"index": i, "count": n}})を返す
+    指定が無い場合は、全ての系列を1つのシャードで収集する
+    """
+    body = request.get_json(silent=True) or {}
+    shard = body.get("shard") or {}
+    index = int(shard.get("index", 0))
+    count = int(shard.get("count", 1))
+
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"invalid shard: index={index}, count={count}")
+
+    return {"index": index, "count": count}
+
+
+def in_shard(table_name: str, shard: dict):
+    """
+    系列(テーブル名)が指定のシャードの担当か判定する
+    テーブル名のハッシュで割り当てるため、銘柄を追加しても既存の系列の担当シャードは変わらない
+    """
+    table_hash = zlib.crc32(table_name.encode("utf-8"))
+    return table_hash % shard["count"] == shard["index"]
+
+
+def get_unixtime_manifest_path(function_name: str):
+    """
+    最新unixtime管理用マニフェスト(json)のパスを返す
+    """
+    return f"_manifest/recently_unixtime/{function_name}.json"
+
+
+def get_gap_index_path(function_name: str):
+    """
+    欠損インデックス(json)のパスを返す
+    {TABLE_NAME: {table_ticker, period, gaps: [[開始, 終了, 補完の試行回数], ...]}}の形式で、
+    開始・終了は欠損している最初と最後の足の開始時刻(unixtime)とする
+    """
+    return f"_manifest/gaps/{function_name}.json"
+
+
+def find_gaps(source: Source, period: str, times: np.ndarray, previous: int):
+    """
+    足の開始時刻の配列(昇順)から、欠損している足の期間[(開始, 終了)]を返す
+    previousは前回取得分の最後の足の開始時刻(未取得の場合は0とし、先頭より前は検出しない)
+    取引時間外により足が無い期間は欠損としない
+    """
+    step = source.bar_seconds.get(period)
+    if step is None or len(times) == 0:
+        return []
+
+    if previous:
+        times = np.r_[previous, times]
+
+    # 足の間隔から欠損している足の本数を求める(日足の夏時間による時刻のずれは丸めて無視する)
+    missing = np.rint(np.diff(times) / step).astype("int64") - 1
+
+    gaps = []
+    for i in np.flatnonzero(missing > 0):
+        start = int(times[i]) + step
+        end = int(times[i]) + step * int(missing[i])
+        if not source.is_session_break(period, start, end):
+            gaps.append((start, end))
+
+    return gaps
+
+
+def in_gaps(times: np.ndarray, gaps: list, step: int):
+    """
+    足の開始時刻が、いずれかの欠損の期間に含まれるかを配列で返す
+    (日足の夏時間による時刻のずれを許容するため、足の間隔の半分までは期間に含める)
+    """
+    mask = np.zeros(len(times), dtype=bool)
+    for start, end, _ in gaps:
+        mask |= (times >= start - step // 2) & (times <= end + step // 2)
+
+    return mask
+
+
+def add_gaps(index: dict, detected_gaps: dict):
+    """
+    欠損インデックスへ検出した欠損を追加する(記録済みの欠損は追加しない)
+    """
+    for table_name, detected in detected_gaps.items():
+        entry = index.setdefault(table_name, {
+            "table_ticker": detected["table_ticker"],
+            "period": detected["period"],
+            "gaps": []
+        })
+        recorded = {(gap[0], gap[1]) for gap in entry["gaps"]}
+        entry["gaps"] += [
+            gap for gap in detected["gaps"]
+            if (gap[0], gap[1]) not in recorded
+        ]
+
+    return index
+
+
+def apply_repair(
+    source: Source,
+    index: dict,
+    entries: dict,
+    filled: dict,
+    unrepaired: list
+):
+    """
+    補完を試みた欠損を、補完できなかった足の期間に置き換えて試行回数を加算する
+    試行回数が上限に達した欠損は欠損インデックスから除き、unrepairedへ追加する
+    補完の開始後に他の実行で追加された欠損はそのまま残す
+    """
+    unrepaired.clear()
+    for table_name, entry in entries.items():
+        current = index.get(table_name)
+        if current is None:
+            continue
+
+        step = source.bar_seconds[entry["period"]]
+        attempted = {(gap[0], gap[1]) for gap in entry["gaps"]}
+        times = np.sort(filled.get(table_name, np.array([], dtype="int64")))
+
+        gaps = []
+        for gap in current["gaps"]:
+            if (gap[0], gap[1]) not in attempted:
+                gaps.append(gap)
+                continue
+
+            for start, end in find_missing(
+                source, entry["period"], gap[0], gap[1], times, step
+            ):
+                if gap[2] + 1 < gap_repair_attempts:
+                    gaps.append([start, end, gap[2] + 1])
+                else:
+                    unrepaired.append([table_name, start, end])
+
+        current["gaps"] = gaps
+
+    # 欠損が無くなった系列は欠損インデックスから除く
+    return {
+        table_name: entry
+        for table_name, entry in index.items()
+        if entry["gaps"]
+    }
+
+
+def find_missing(source: Source, period, start, end, times, step):
+    """
+    start〜endの足のうち、timesに含まれない足の期間[(開始, 終了)]を返す
+    """
+    expected = np.arange(start, end + 1, step, dtype="int64")
+    if len(times) == 0:
+        missing = np.ones(len(expected), dtype=bool)
+    else:
+        # 日足の夏時間による時刻のずれを許容するため、最も近い足との差が足の間隔の半分未満なら補完済みとする
+        position = np.searchsorted(times, expected)
+        before = times[np.maximum(position - 1, 0)]
+        after = times[np.minimum(position, len(times) - 1)]
+        nearest = np.minimum(
+            np.abs(expected - before), np.abs(after - expected)
+        )
+        missing = nearest * 2 >= step
+
+    # 連続して欠損している足ごとに期間をまとめる
+    indexes = np.flatnonzero(missing)
+    breaks = np.flatnonzero(np.diff(indexes) > 1)
+    firsts = np.r_[indexes[:1], indexes[breaks + 1]]
+    lasts = np.r_[indexes[breaks], indexes[-1:]]
+
+    return [
+        (int(expected[first]), int(expected[last]))
+        for first, last in zip(firsts, lasts)
+        if not source.is_session_break(
+            period, int(expected[first]), int(expected[last])
+        )
+    ]
+
+
+def update_gap_index(function_name: str, update, retries: int):
+    """
+    欠損インデックスを取得してupdateで更新し、GCSへ保存する
+    取得時から他の実行(他のシャードを含む)で更新されていた場合は、最新の欠損インデックスを取得し直して更新する
+    """
+    path = get_gap_index_path(function_name)
+    blob = get_bucket().blob(path)
+
+    for _ in range(retries):
+        index, generation = load_manifest(path)
+        index = update(index or {})
+        try:
+            # 世代番号が取得時と一致する場合のみ保存する(0の場合は新規作成のみ)
+            blob.upload_from_string(
+                json.dumps(index),
+                content_type="application/json",
+                if_generation_match=generation
+            )
+            return
+        except PreconditionFailed:
+            continue
+
+    raise Exception(f"failed to save {path}: conflicted {retries} times")
+
+
+def load_recently_unixtime(function_name: str):
+    """
+    最新unixtimeを{TABLE_NAME: UNIX_TIME}の辞書とマニフェストの世代番号で返す
+    GCSのマニフェストを優先し、マニフェストが無い場合のみBigQueryから取得する
+    """
+    unixtimes, generation = load_manifest(
+        get_unixtime_manifest_path(function_name)
+    )
+
+    if unixtimes is None:
+        unixtimes = load_recently_unixtime_from_bigquery(
+            get_bigquery_client()
+        )
+
+    return unixtimes, generation
+
+
+def load_recently_unixtime_from_bigquery(client: "BqClient"):
+    """
+    最新UnixTime管理テーブルから、テーブルごとの最新unixtimeを取得する
+    全系列を1つのテーブルにまとめる場合は、取り込み済みの足から系列ごとの最新unixtimeを求める
+    """
+    if market_table_layout == "consolidated":
+        return load_recently_unixtime_from_consolidated(client)
+
+    table_name = f"{project_id}.{dataset}.{recently_unixtime_table}"
+    query = f"""
+        SELECT
+            TABLE_NAME,
+            MAX(UNIX_TIME) AS UNIX_TIME
+        FROM
+            `{table_name}`
+        GROUP BY
+            TABLE_NAME;
+    """
+
+    rows = client.query(query).result()
+
+    return {
+        row["TABLE_NAME"]: row["UNIX_TIME"]
+        for row in rows
+        if row["UNIX_TIME"] is not None
+    }
+
+
+def load_recently_unixtime_from_consolidated(client: "BqClient"):
+    """
+    全系列をまとめたテーブルから、系列(<SYMBOL>_<PERIOD>)ごとの最新unixtimeを取得する
+    取り込みはUNIX_TIMEをキーとしたMERGEのため、取り込まれていない足は再取得しても重複しない
+    """
+    table_name = f"{project_id}.{dataset}.{consolidated_table}"
+    query = f"""
+        SELECT
+            CONCAT(SYMBOL, '_', PERIOD) AS TABLE_NAME,
+            MAX(UNIX_TIME) AS UNIX_TIME
+        FROM
+            `{table_name}`
+        GROUP BY
+            SYMBOL, PERIOD;
+    """
+
+    rows = client.query(query).result()
+
+    return {
+        row["TABLE_NAME"]: row["UNIX_TIME"]
+        for row in rows
+        if row["UNIX_TIME"] is not None
+    }
+
+
+def load_manifest(path):
+    """
+    GCSからjson形式のマニフェストを取得し、内容と世代番号を返す
+    マニフェストが無い場合は(None, 0)を返す
+    """
+    bucket = get_bucket()
+
+    blob = bucket.get_blob(path)
+    if blob is None:
+        return None, 0
+
+    # メタデータ取得後に更新された場合に備え、同じ世代のデータのみ取得する
+    data = blob.download_as_bytes(if_generation_match=blob.generation)
+
+    return json.loads(data), blob.generation
+
+
+def save_unixtime_manifest(
+    function_name: str,
+    unixtimes: dict,
+    updated_unixtimes: dict,
+    generation,
+    retries: int = unixtime_manifest_retries
+):
+    """
+    最新unixtime管理用マニフェストをGCSへ保存する
+    取得時から他の実行(他のシャードを含む)で更新されていた場合は、最新のマニフェストへマージして再保存する
+    保存したマニフェストの内容と世代番号を返す(続けて保存する場合は、返した世代番号を使う)
+    """
+    if not updated_unixtimes and generation != 0:
+        return unixtimes, generation
+
+    manifest_path = get_unixtime_manifest_path(function_name)
+    bucket = get_bucket()
+    blob = bucket.blob(manifest_path)
+
+    unixtimes = {**unixtimes, **updated_unixtimes}
+
+    for _ in range(retries):
+        try:
+            # 世代番号が取得時と一致する場合のみ保存する(0の場合は新規作成のみ)
+            blob.upload_from_string(
+                json.dumps(unixtimes),
+                content_type="application/json",
+                if_generation_match=generation
+            )
+            return unixtimes, blob.generation
+        except PreconditionFailed:
+            latest, generation = load_manifest(manifest_path)
+            if latest is not None:
+                unixtimes = latest
+            for table_name, unixtime in updated_unixtimes.items():
+                unixtimes[table_name] = max(
+                    unixtimes.get(table_name, 0), unixtime
+                )
+
+    raise Exception(
+        f"failed to save {manifest_path}: conflicted {retries} times"
+    )
+
+
+def upload_output(output: dict, execTime, report: RunReport):
+    """
+    アップロードするデータ(transformの返り値の要素)をGCSへアップロードし、パスを返す
+    """
+    df = output["df"]
+    with report.span("upload", output["table_name"], rows=len(df)) as span:
+        gcs_path, span["bytes"] = upload_df_to_gcs(
+            output["table_ticker"],
+            execTime,
+            output["period"],
+            df
+        )
+
+    return gcs_path
+
+
+def upload_df_to_gcs(ticker, execTime, period, df: pd.DataFrame):
+    """
+    データフレームをcsvまたはparquet形式でGCSへアップロードする
+    アップロードしたファイルのパスとサイズ(バイト数)を返す
+    """
+    bucket = get_bucket()
+
+    extension = "parquet" if output_format == "parquet" else "csv"
+    gcs_path = f"{dataset}/{ticker}/{execTime}/{period}.{extension}"
+    blob = bucket.blob(gcs_path)
+
+    if len(df) >= streaming_upload_min_rows:
+        # 大きいデータフレームは、ファイル全体をメモリ上に作らずにアップロードする
+        size = stream_df_to_blob(blob, df)
+    elif output_format == "parquet":
+        data = df_to_parquet(df)
+        blob.upload_from_string(data, content_type="application/octet-stream")
+        size = len(data)
+    else:
+        data = df.to_csv(index=False, header=True, sep=",").encode("utf-8")
+        blob.upload_from_string(data, content_type="text/csv")
+        size = len(data)
+
+    return gcs_path, size
+
+
+def upload_run_manifest(function_name: str, execTime, gcs_paths, shard: dict):
+    """
+    今回の実行でアップロードしたファイルの一覧をGCSへアップロードする
+    csv-to-bigqueryのバッチ取り込みモードでは、この一覧を元にまとめて取り込む
+    シャードに分割して収集する場合は、シャードごとに別のファイルとする
+    """
+    if not gcs_paths:
+        return
+
+    bucket = get_bucket()
+
+    file_name = function_name
+    if shard["count"] > 1:
+        file_name += f"-{shard['index']}-of-{shard['count']}"
+
+    blob = bucket.blob(f"{dataset}/_runs/{execTime}/{file_name}.json")
+    blob.upload_from_string(
+        json.dumps({"files": gcs_paths}),
+        content_type="application/json"
+    )
+
+
+def stream_df_to_blob(blob, df: pd.DataFrame):
+    """
+    データフレームを分割して変換しながら、GCSへレジューム可能なアップロードで書き込む
+    メモリ上には変換中の行と送信待ちのデータしか保持しない
+    書き込んだサイズ(バイト数)を返す
+    """
+    chunks = (
+        df.iloc[start:start + upload_chunk_rows]
+        for start in range(0, len(df), upload_chunk_rows)
+    )
+
+    if output_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        parquet_schema = get_parquet_schema()
+        with blob.open(
+            "wb",
+            chunk_size=upload_chunk_bytes,
+            ignore_flush=True,
+            content_type="application/octet-stream"
+        ) as file:
+            with pq.ParquetWriter(
+                file, parquet_schema, compression="snappy"
+            ) as writer:
+                for chunk in chunks:
+                    writer.write_table(pa.Table.from_pandas(
+                        chunk, schema=parquet_schema, preserve_index=False
+                    ))
+            return file.tell()
+    else:
+        with blob.open(
+            "w", chunk_size=upload_chunk_bytes, content_type="text/csv"
+        ) as file:
+            for i, chunk in enumerate(chunks):
+                chunk.to_csv(file, index=False, header=i == 0, sep=",")
+            file.flush()
+            return file.buffer.tell()
+
+
+def df_to_parquet(df: pd.DataFrame):
+    """
+    データフレームをMARKET_PRICEテーブルのスキーマでparquet形式に変換する
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(
+        df, schema=get_parquet_schema(), preserve_index=False
+    )
+
+    buffer = BytesIO()
+    pq.write_table(table, buffer, compression="snappy")
+
+    return buffer.getvalue()
+
+
+def update_recently_unixtime(client: "BqClient", updated_unixtimes: dict):
+    """
+    最新UnixTime管理テーブルへ、unixtimeが更新されたテーブルのみをTABLE_NAMEをキーとしてupsertする
+    """
+    if not updated_unixtimes:
+        return
+
+    from google.cloud.bigquery import (
+        QueryJobConfig,
+        ArrayQueryParameter,
+        StructQueryParameter,
+        ScalarQueryParameter
+    )
+
+    table_id = f"{project_id}.{dataset}.{recently_unixtime_table}"
+
+    # 既存のunixtimeより新しい場合のみ更新し、存在しないテーブルは追加する
+    query = f"""
+        MERGE
+            `{table_id}` AS T
+        USING
+            UNNEST(@unixtimes) AS S
+        ON
+            T.TABLE_NAME = S.TABLE_NAME
+        WHEN MATCHED AND IFNULL(T.UNIX_TIME, 0) < S.UNIX_TIME THEN
+            UPDATE SET UNIX_TIME = S.UNIX_TIME
+        WHEN NOT MATCHED THEN
+            INSERT (TABLE_NAME, UNIX_TIME) VALUES (S.TABLE_NAME, S.UNIX_TIME);
+    """
+
+    job_config = QueryJobConfig()
+    job_config.query_parameters = [
+        ArrayQueryParameter("unixtimes", "STRUCT", [
+            StructQueryParameter(
+                None,
+                ScalarQueryParameter("TABLE_NAME", "STRING", table_name),
+                ScalarQueryParameter("UNIX_TIME", "INT64", unixtime)
+            )
+            for table_name, unixtime in updated_unixtimes.items()
+        ])
+    ]
+    client.query(query, job_config=job_config).result()
+
+
+@lru_cache(maxsize=None)
+def get_parquet_schema():
+    """
+    MARKET_PRICEテーブルのスキーマ(settings/bigquery/schema/MARKET_PRICE_schema.json)に対応するparquetのスキーマを返す
+    """
+    import pyarrow as pa
+
+    return pa.schema([
+        ("UNIX_TIME", pa.int64()),
+        ("OPEN_PRICE", pa.float64()),
+        ("HIGH_PRICE", pa.float64()),
+        ("LOW_PRICE", pa.float64()),
+        ("CLOSE_PRICE", pa.float64()),
+        ("VOLUME", pa.float64()),
+        ("QUOTE_VOLUME", pa.float64()),
+        ("CLOSE_TIME", pa.timestamp("us", tz="UTC"))
+    ])
+
+
+def get_bigquery_client():
+    """
+    BigQueryのクライアントを返す(インスタンスが再利用される間は同じクライアントを使い回す)
+    """
+    with client_lock:
+        return create_bigquery_client()
+
+
+def preload_bigquery_client():
+    """
+    BigQueryのクライアントを先読みする(エラーは実際に使用する時点で送出する)
+    """
+    try:
+        get_bigquery_client()
+    except Exception:
+        pass
+
+
+@lru_cache(maxsize=None)
+def create_bigquery_client():
+    from google.cloud.bigquery import Client as BqClient
+
+    return BqClient(project_id)
+
+
+@lru_cache(maxsize=None)
+def get_bucket():
+    """
+    金融データのアップロード先バケットを返す(インスタンスが再利用される間は同じバケットを使い回す)
+    """
+    return StorageClient(project_id).bucket(bucket_name)
+
+
+@lru_cache(maxsize=None)
+def get_publisher_client():
+    """
+    Pub/Subのクライアントを返す(インスタンスが再利用される間は同じクライアントを使い回す)
+    エラーの通知にのみ使用するため、初回の使用時に読み込む
+    """
+    from google.cloud.pubsub import PublisherClient
+
+    return PublisherClient()
+
+
+def publish_error_report(function_name: str, error: str):
+    """
+    エラー通知用topicへpublishする
+    """
+    publisher = get_publisher_client()
+    error_report_topic = os.getenv("ERROR_REPORT_TOPIC")
+    topic_name = f"projects/{project_id}/topics/{error_report_topic}"
+
+    publisher.publish(
+        topic_name,
+        data=error.encode("utf-8"),
+        projectId=project_id,
+        functionName=function_name,
+        eventTime=str(int(time.time()))
+    )
@@ -0,0 +1,79 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    取得元ごとのリクエスト数を制限するトークンバケット(複数スレッドから共有できる)
+
+    レート制限を受けた場合はレートを半分に下げ、連続回数に応じて一定時間リクエストを止める。
+    その後リクエストが成功するたびに、設定したレートまで少しずつ戻す。
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        backoff_seconds: float = 1.0,
+        max_backoff_seconds: float = 60.0
+    ):
+        # 設定したレート(リクエスト/秒)と、現在のレート
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = rate / 16
+        # バケットの容量(連続してリクエストできる数)
+        self.burst = burst
+        self.tokens = burst
+        # トークンを補充した時刻(待機中はこの時刻から補充を再開する)
+        self.updated = time.monotonic()
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.consecutive_limits = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1):
+        """
+        トークンを予約し、リクエストできるまで待機する
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= tokens
+            # 待機中の残り時間と、不足したトークンが補充されるまでの時間を待つ
+            wait = max(self.updated - now, 0.0)
+            wait += max(-self.tokens, 0.0) / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def backoff(self):
+        """
+        レート制限を受けたため、レートを下げて一定時間リクエストを止める
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.consecutive_limits += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+
+            pause = min(
+                self.max_backoff_seconds,
+                self.backoff_seconds * 2 ** (self.consecutive_limits - 1)
+            )
+            self.tokens = min(self.tokens, 0.0)
+            self.updated = max(self.updated, now + pause)
+
+    def succeed(self):
+        """
+        リクエストが成功したため、設定したレートまで少しずつ戻す
+        """
+        with self.lock:
+            self._refill(time.monotonic())
+            self.consecutive_limits = 0
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.updated = now
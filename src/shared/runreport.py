@@ -0,0 +1,122 @@
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+class RunReport:
+    """
+    1回の実行について、処理段階(stage)・系列(series)ごとの実行時間と行数・バイト数を計測する
+    (複数スレッドから共有できる)
+
+    計測結果は構造化ログ(標準出力へのjson 1行)として出力し、Cloud LoggingのjsonPayloadとして検索できる。
+    処理段階ごとの計測(span)は都度出力し、実行の最後に集計(summary)を出力する。
+    """
+
+    def __init__(
+        self,
+        function_name: str,
+        log_spans: bool = True,
+        slowest_series: int = 10
+    ):
+        self.function_name = function_name
+        self.run_id = uuid.uuid4().hex
+        self.log_spans = log_spans
+        self.slowest_series = slowest_series
+        self.started = time.perf_counter()
+        # 処理段階ごとの集計(stage → 回数・実行時間・行数・バイト数・エラー数)
+        self.stages = {}
+        # 系列ごとの処理段階別の実行時間(series → {stage: 秒})
+        self.series = {}
+        # 集計に付け加える値(アップロードしたファイル数など)
+        self.fields = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage: str, series: str = None, **counts):
+        """
+        withブロックの実行時間を計測する
+        ブロック内で返り値の辞書へrows・bytesなどを設定すると、計測結果に含める
+        """
+        record = dict(counts)
+        error = None
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._add(stage, series, time.perf_counter() - start, record, error)
+
+    def update(self, **fields):
+        """
+        集計に付け加える値を設定する
+        """
+        with self.lock:
+            self.fields.update(fields)
+
+    def summary(self, error: Exception = None):
+        """
+        実行全体の集計を出力する
+        """
+        with self.lock:
+            slowest = sorted(
+                self.series.items(),
+                key=lambda item: sum(item[1].values()),
+                reverse=True
+            )[:self.slowest_series]
+            self._log({
+                "severity": "INFO" if error is None else "ERROR",
+                "message": f"{self.function_name} run summary",
+                "event": "summary",
+                "status": "ok" if error is None else "error",
+                "error": None if error is None else str(error),
+                "seconds": round(time.perf_counter() - self.started, 6),
+                "series": len(self.series),
+                "stages": self.stages,
+                "slowest_series": [
+                    {
+                        "series": series,
+                        "seconds": round(sum(stages.values()), 6),
+                        "stages": stages
+                    }
+                    for series, stages in slowest
+                ],
+                **self.fields
+            })
+
+    def _add(self, stage, series, seconds, record, error):
+        with self.lock:
+            total = self.stages.setdefault(stage, {
+                "count": 0, "seconds": 0.0, "max_seconds": 0.0,
+                "rows": 0, "bytes": 0, "errors": 0
+            })
+            total["count"] += 1
+            total["seconds"] = round(total["seconds"] + seconds, 6)
+            total["max_seconds"] = round(max(total["max_seconds"], seconds), 6)
+            total["rows"] += int(record.get("rows") or 0)
+            total["bytes"] += int(record.get("bytes") or 0)
+            total["errors"] += error is not None
+
+            if series is not None:
+                stages = self.series.setdefault(series, {})
+                stages[stage] = round(stages.get(stage, 0.0) + seconds, 6)
+
+            if self.log_spans:
+                self._log({
+                    "severity": "INFO" if error is None else "ERROR",
+                    "message": f"{self.function_name} {stage}",
+                    "event": "span",
+                    "stage": stage,
+                    "series": series,
+                    "seconds": round(seconds, 6),
+                    "error": None if error is None else str(error),
+                    **record
+                })
+
+    def _log(self, record: dict):
+        record["function"] = self.function_name
+        record["run_id"] = self.run_id
+        print(json.dumps(record, default=str), flush=True)
@@ -0,0 +1,487 @@
+import os
+import time
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import yfinance as yf
+from pipeline import Source, in_shard
+from ratelimit import RateLimiter
+from runreport import RunReport
+
+
+# yahoo financeへの1秒当たりのリクエスト数の上限と、連続してリクエストできる数
+yahoo_rate_limit = float(os.getenv("YAHOO_RATE_LIMIT", "2"))
+yahoo_rate_burst = float(os.getenv("YAHOO_RATE_BURST", "5"))
+# レート制限を受けた場合の再試行回数
+rate_limit_retries = 5
+# 同じ時間足の銘柄をまとめてyfinanceからダウンロードするか
+batch_download = os.getenv("YFINANCE_BATCH_DOWNLOAD", "true") == "true"
+# yahoo financeの時間足ごとの取得期間の上限(秒)
+# window: 1回のリクエストで取得できる期間、lookback: 現在から遡って取得できる期間
+# (1分足は1回7日・過去30日までのため、境界で拒否されないよう1日ずつ短くする)
+yahoo_interval_limits = {
+    "1m": {"window": 6 * 86400, "lookback": 29 * 86400}
+}
+# 1分足でこの秒数以上足が無い期間は、取引時間外(昼休み・夜間・週末)として欠損としない
+session_break_seconds = 3600
+# まとめてダウンロードする場合の1回当たりの銘柄数(分割したダウンロードの整理・アップロードは次のダウンロードと重ねる)
+yfinance_batch_size = int(os.getenv("YFINANCE_BATCH_SIZE", "50"))
+
+# yahoo financeへのリクエスト数を制限する
+yahoo_limiter = RateLimiter(yahoo_rate_limit, yahoo_rate_burst)
+
+periods = [
+    {"name": "1M", "time": "1m"},
+    {"name": "1D", "time": "1d"}
+]
+
+# 時間足ごとの足の間隔(秒)
+period_seconds = {"1M": 60, "1D": 86400}
+
+OPEN = "OPEN_PRICE"
+HIGH = "HIGH_PRICE"
+LOW = "LOW_PRICE"
+CLOSE = "CLOSE_PRICE"
+VOLUME = "VOLUME"
+QUOTE_VOLUME = "QUOTE_VOLUME"
+float_columns = [OPEN, HIGH, LOW, CLOSE, VOLUME, QUOTE_VOLUME]
+columns = ["UNIX_TIME"] + float_columns
+# 複数銘柄をまとめて整理・正規化する際の銘柄カラム
+TICKER = "TICKER"
+# 整理・正規化後のカラム順
+output_columns = [
+    "CLOSE_TIME", OPEN, HIGH, LOW, CLOSE, VOLUME, "UNIX_TIME", QUOTE_VOLUME
+]
+
+
+class YfinanceSource(Source):
+    """
+    yfinanceから取得する取得元(株価指数・為替・商品先物)の共通処理
+
+    各collectorは取得元の関数名と銘柄の一覧のみを定義する。
+    ・instruments: 銘柄の一覧(yfinanceのティッカー"ticker"と、テーブル名に使う"name"を持つ辞書のリスト)
+    ・get_table_ticker: テーブル名に使う銘柄名(既定は"name")
+    """
+
+    bar_seconds = period_seconds
+    instruments = []
+
+    def get_table_ticker(self, instrument: dict):
+        return instrument["name"]
+
+    def series(self):
+        """
+        取得対象の系列(銘柄×時間足)を返す
+        """
+        for period in periods:
+            for instrument in self.instruments:
+
+                table_ticker = self.get_table_ticker(instrument)
+
+                yield {
+                    "ticker": instrument["ticker"],
+                    "table_ticker": table_ticker,
+                    "table_name": f"{table_ticker}_{period['name']}",
+                    "period": period["name"],
+                    "interval": period["time"]
+                }
+
+    def targets(self, unixtimes: dict, shard: dict):
+        # 取得対象の系列ごとに前回取得分のunixtimeを求める
+        targets = []
+        for target in self.series():
+
+            # 他のシャードが担当する系列は収集しない
+            if not in_shard(target["table_name"], shard):
+                continue
+
+            # 前回取得分のunixtimeを取得する(取得履歴が無い場合は0)
+            target["unixtime"] = unixtimes.get(target["table_name"], 0)
+            targets.append(target)
+
+        return targets
+
+    def fetch(self, targets: list, report: RunReport):
+        return fetch_yfinance(targets, report)
+
+    def transform(self, group, response, report: RunReport):
+        return cleansing_yfinance(group, response, report)
+
+    def is_session_break(self, period: str, start: int, end: int):
+        return is_session_break(period, start, end)
+
+    def fetch_range(self, table_name: str, start: int, end: int):
+        return fetch_yfinance_range(self.series(), table_name, start, end)
+
+
+def fetch_yfinance(targets, report: RunReport):
+    """
+    取得対象の銘柄のデータをyfinanceから取得し、(取得した銘柄のリスト, 取得結果)を順に返す
+    yf.downloadは取得結果をモジュール内で共有するため、ダウンロードは並行せず順に実行する
+    まとめてダウンロードする場合、取得の計測は系列ごとではなくダウンロード単位となる
+    """
+    def fetch_group(group):
+        # まとめた銘柄のうち、最も古い前回取得分以降を取得する
+        interval = group[0]["interval"]
+        windows, truncated = get_fetch_windows(
+            interval, min(target["unixtime"] for target in group)
+        )
+
+        if not batch_download:
+            target = group[0]
+            with report.span(
+                "fetch", target["table_name"], windows=len(windows)
+            ) as span:
+                response = request_yfinance(
+                    target["ticker"], interval, windows
+                )
+                span["rows"] = len(response)
+                span["truncated"] = truncated
+            return group, response
+
+        with report.span(
+            "fetch", tickers=len(group), windows=len(windows)
+        ) as span:
+            response = request_yfinance_batch(
+                [target["ticker"] for target in group], interval, windows
+            )
+            span["rows"] = len(response)
+            span["truncated"] = truncated
+        return group, response
+
+    if not batch_download:
+        groups = [[target] for target in targets]
+    else:
+        # 時間足と前回取得分の日ごとにまとめる(まとめた銘柄で余分に取得するのは1日未満となる)
+        # 未取得(unixtime=0)の銘柄は全期間を取得するため、別のまとまりとなる
+        batches = {}
+        for target in targets:
+            batches.setdefault(
+                (target["interval"], target["unixtime"] // 86400), []
+            ).append(target)
+
+        # 取得と整理・アップロードを重ねられるよう、一定の銘柄数ごとに分割する
+        size = max(yfinance_batch_size, 1)
+        groups = [
+            batch[start:start + size]
+            for batch in batches.values()
+            for start in range(0, len(batch), size)
+        ]
+
+    for group in groups:
+        yield fetch_group(group)
+
+
+def fetch_yfinance_range(series, table_name, start, end):
+    """
+    系列のstart〜endを含む足をyfinanceから取得し、整理・正規化する
+    取得対象に無い系列の場合はNoneを返す
+    """
+    target = next(
+        (target for target in series if target["table_name"] == table_name),
+        None
+    )
+    if target is None:
+        return None
+
+    # 整理時に末尾の足を除くため、endの次の足まで取得する
+    step = period_seconds[target["period"]]
+    windows, _ = get_fetch_windows(
+        target["interval"], start, until=end + step * 2
+    )
+    response = request_yfinance(target["ticker"], target["interval"], windows)
+
+    return {
+        "table_ticker": target["table_ticker"],
+        "period": target["period"],
+        "table_name": table_name,
+        "df": cleansing_df(response, start - 1)
+    }
+
+
+def is_session_break(period: str, start: int, end: int):
+    """
+    start〜end(足の開始時刻)の足が無いことが、取引時間外によるものか判定する
+    ・日足: 全て土日の足の場合(足の開始時刻は取引所の現地時刻の0時のため、12時間後の日付で曜日を判定する)
+    ・1分足: session_break_seconds以上足が無い場合(取引所ごとの取引時間は持たない)
+    """
+    if period == "1D":
+        days = (np.arange(start, end + 1, 86400) + 43200) // 86400
+        # 1970/1/1(木曜日)からの日数を月曜日=0の曜日に変換する
+        return bool(((days + 3) % 7 >= 5).all())
+
+    return end - start + 60 >= session_break_seconds
+
+
+def cleansing_yfinance(group, response, report: RunReport):
+    """
+    yfinanceの取得結果を整理・正規化し、アップロードするデータの一覧を返す
+    """
+    if not batch_download:
+        target = group[0]
+        with report.span("cleansing", target["table_name"]) as span:
+            df = cleansing_df(response, target["unixtime"])
+            span["rows"] = len(df)
+        dfs = {target["ticker"]: df}
+    else:
+        with report.span("cleansing", tickers=len(group)) as span:
+            dfs = cleansing_batch_df(
+                response,
+                {target["ticker"]: target["unixtime"] for target in group}
+            )
+            span["rows"] = sum(len(df) for df in dfs.values())
+
+    outputs = []
+    for target in group:
+        df = dfs.get(target["ticker"])
+        if df is None or df.empty:
+            continue
+
+        outputs.append({
+            "table_ticker": target["table_ticker"],
+            "period": target["period"],
+            "table_name": target["table_name"],
+            "df": df
+        })
+
+    return outputs
+
+
+def get_fetch_windows(interval, unixtime, until=None):
+    """
+    前回取得分のunixtimeから、yfinanceで取得する期間(yf.downloadの引数)の一覧を返す
+    未取得(unixtime=0)の場合は全期間とし、取得済みの場合は前回取得分の足からuntil(省略時は現在)までとする
+    1回で取得できる期間を超える場合は分割し、遡って取得できない期間がある場合はTrueを併せて返す
+    """
+    if unixtime == 0:
+        return [{"period": "max"}], False
+
+    # 前回取得分の足も含めて取得する(取得済みの足はcleansing_dfで除く)
+    start = unixtime
+    truncated = False
+    windows = []
+
+    limits = yahoo_interval_limits.get(interval)
+    if limits is not None:
+        now = int(time.time())
+        # 遡って取得できる期間より前の足は取得できないため、取得できる範囲から取得する
+        if start < now - limits["lookback"]:
+            start = now - limits["lookback"]
+            truncated = True
+
+        while (until or now) - start > limits["window"]:
+            windows.append({
+                "start": to_datetime(start),
+                "end": to_datetime(start + limits["window"])
+            })
+            start += limits["window"]
+
+    # 最後の期間はuntilまで取得する(省略時は現在までとし、末尾の未確定の足は整理時に除く)
+    if until is None:
+        windows.append({"start": to_datetime(start)})
+    elif start < until:
+        windows.append({
+            "start": to_datetime(start), "end": to_datetime(until)
+        })
+
+    return windows, truncated
+
+
+def to_datetime(unixtime):
+    """
+    unixtimeをyf.downloadの期間指定に使用するUTCの日時に変換する
+    """
+    return datetime.fromtimestamp(unixtime, timezone.utc)
+
+
+def request_yfinance(ticker, interval, windows):
+    """
+    1銘柄のデータを取得する期間ごとにyfinanceからダウンロードし、まとめて返す
+    """
+    responses = [
+        download_yfinance(
+            1,
+            tickers=ticker,
+            interval=interval,
+            auto_adjust=True,
+            **window
+        )
+        for window in windows
+    ]
+    return concat_responses(responses)
+
+
+def concat_responses(responses):
+    """
+    期間ごとにダウンロードしたデータフレームを日時の順につなげる
+    """
+    responses = [response for response in responses if not response.empty]
+    if not responses:
+        return pd.DataFrame()
+    if len(responses) == 1:
+        return responses[0]
+
+    df = pd.concat(responses)
+    # 期間の境界の足が重複した場合は、後の期間の値を使用する
+    return df[~df.index.duplicated(keep="last")]
+
+
+def download_yfinance(request_count: int, **kwargs):
+    """
+    リクエスト数を制限しつつyfinanceからダウンロードする
+    レート制限を受けた場合は、待機してから再試行する
+    """
+    for _ in range(rate_limit_retries + 1):
+        yahoo_limiter.acquire(request_count)
+
+        try:
+            response = yf.download(**kwargs)
+        except Exception as e:
+            if not is_yahoo_rate_limited(str(e)):
+                raise e
+        else:
+            # yf.downloadは銘柄ごとのエラーを例外とせず、yfinance.sharedへ記録する
+            errors = getattr(getattr(yf, "shared", None), "_ERRORS", {})
+            if not any(is_yahoo_rate_limited(str(e)) for e in errors.values()):
+                yahoo_limiter.succeed()
+                return response
+
+        yahoo_limiter.backoff()
+
+    raise Exception(
+        f"yahoo finance rate limit exceeded: tickers={kwargs.get('tickers')}"
+    )
+
+
+def is_yahoo_rate_limited(error: str):
+    """
+    yahoo financeのエラーがレート制限によるものか判定する
+    """
+    return "Too Many Requests" in error or "Rate limit" in error
+
+
+def cleansing_df(df: pd.DataFrame, target_unixtime):
+    # レスポンスデータの長さが2未満の場合、データが無いかもしくは、未来のデータしかないため、処理を中断する
+    if len(df) < 2:
+        return pd.DataFrame()
+
+    # datetimeindexを使って日付の昇順にソート(ソート済みの場合はコピーを避ける)
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index(ascending=True)
+
+    # レスポンスデータの末尾には未来日の価格に実行時点の最新値が入るが、この値は実行日時によって変化してしまうため、不確実のデータとなる。
+    # よって未来日の項目となる配列の末尾を削除する。
+    df = df.iloc[:-1]
+
+    # datetimeindexからunixtimeを生成する
+    unixtime = to_unixtime(df.index)
+
+    # unixtimeより上のデータを抽出する
+    if target_unixtime != 0:
+        mask = unixtime > target_unixtime
+        df = df[mask]
+        unixtime = unixtime[mask]
+
+    return build_output_df(df, unixtime)
+
+
+def to_unixtime(close_time):
+    """
+    日時(DatetimeIndex, Series)をunixtime(秒)のint64配列に変換する
+    """
+    close_time = pd.DatetimeIndex(close_time)
+    # タイムゾーンが無い日時はUTCとして扱う
+    if close_time.tz is None:
+        close_time = close_time.tz_localize("UTC")
+
+    elapsed = close_time - pd.Timestamp(0, tz="UTC")
+    return (elapsed // pd.Timedelta(seconds=1)).to_numpy(dtype="int64")
+
+
+def build_output_df(df: pd.DataFrame, unixtime):
+    """
+    yfinanceの列名のデータフレームとunixtimeから、出力カラムのデータフレームを生成する
+    """
+    return pd.DataFrame({
+        # CLOSE_TIMEをUTCに変換する
+        "CLOSE_TIME": pd.to_datetime(unixtime, unit="s", utc=True),
+        # int → floatへ変換
+        OPEN: df["Open"].to_numpy(dtype="float64"),
+        HIGH: df["High"].to_numpy(dtype="float64"),
+        LOW: df["Low"].to_numpy(dtype="float64"),
+        CLOSE: df["Close"].to_numpy(dtype="float64"),
+        VOLUME: df["Volume"].to_numpy(dtype="float64"),
+        "UNIX_TIME": unixtime,
+        # QUOTE_VOLUMEカラムを設定する
+        QUOTE_VOLUME: 0.0
+    }, columns=output_columns)
+
+
+def request_yfinance_batch(tickers, interval, windows):
+    """
+    複数銘柄のデータを取得する期間ごとにyfinanceから1回でダウンロードし、まとめて返す
+    """
+    responses = []
+    for window in windows:
+        # yfinanceは内部で銘柄ごとにリクエストするため、銘柄数分のリクエストとして制限する
+        response = download_yfinance(
+            len(tickers),
+            tickers=tickers,
+            interval=interval,
+            auto_adjust=True,
+            group_by="ticker",
+            **window
+        )
+
+        # 1銘柄のみの場合はカラムが(銘柄, 項目)の2階層にならないことがあるため、揃える
+        if (
+            not response.empty
+            and not isinstance(response.columns, pd.MultiIndex)
+        ):
+            response = pd.concat({tickers[0]: response}, axis=1)
+
+        responses.append(response)
+
+    return concat_responses(responses)
+
+
+def cleansing_batch_df(df: pd.DataFrame, target_unixtimes: dict):
+    """
+    複数銘柄のデータフレームを1回でまとめて整理・正規化し、銘柄ごとに分割して返す
+    """
+    if df.empty:
+        return {}
+
+    # 銘柄ごとのカラムを行方向へ積み上げ、(銘柄, 日時)をインデックスとする縦長のデータフレームにする
+    tickers = df.columns.get_level_values(0).unique()
+    df = pd.concat(
+        {ticker: df[ticker] for ticker in tickers},
+        names=[TICKER, "CLOSE_TIME"]
+    )
+    # 他の銘柄にしか存在しない日時の行は全項目が欠損となるため、削除する
+    df = df.dropna(how="all")
+
+    # 銘柄、日時の昇順にソート
+    df = df.sort_index(ascending=True)
+
+    # レスポンスデータの末尾には未来日の価格に実行時点の最新値が入るが、この値は実行日時によって変化してしまうため、不確実のデータとなる。
+    # よって銘柄ごとに未来日の項目となる末尾を削除する。(データが1件以下の銘柄は全て削除される)
+    df = df[df.groupby(level=TICKER).cumcount(ascending=False) > 0]
+
+    # CLOSE_TIMEからunixtimeを生成する
+    unixtime = to_unixtime(df.index.get_level_values("CLOSE_TIME"))
+
+    # 銘柄ごとに前回取得分のunixtimeより上のデータを抽出する
+    df_tickers = df.index.get_level_values(TICKER)
+    target_unixtime = df_tickers.map(target_unixtimes).to_numpy(dtype="int64")
+    mask = (target_unixtime == 0) | (unixtime > target_unixtime)
+    df = df[mask]
+    unixtime = unixtime[mask]
+
+    df = build_output_df(df, unixtime)
+    df[TICKER] = df_tickers[mask].to_numpy()
+
+    return {
+        ticker: df_ticker[output_columns].reset_index(drop=True)
+        for ticker, df_ticker in df.groupby(TICKER, sort=False)
+    }
@@ -0,0 +1,252 @@
+"""
+ローカルの足のアーカイブ
+
+系列(<ticker>_<period>)ごとに1つの追記専用ファイル(<table_name>.candles)へ、
+MARKET_PRICEテーブルの項目(UNIX_TIMEとOHLCV)を固定長のレコードで書き込む。
+・レコードは56バイト固定のため、ファイルをnp.memmapでそのまま読み込み、範囲を切り出しても複製しない
+・項目ごとの配列(records["CLOSE_PRICE"]など)も、レコードの配列を参照するビューとして取得できる
+・index_stride件ごとのUNIX_TIMEを疎なインデックス(<table_name>.index)に持ち、
+  範囲の開始・終了位置はインデックスと該当する区間のUNIX_TIMEのみを読み込んで求める
+CLOSE_TIMEはUNIX_TIMEから求められるため保存しない。
+書き込みは1プロセスからのみ行う前提とする。
+"""
+import os
+import struct
+import numpy as np
+import pandas as pd
+
+
+# ファイルの先頭に書き込む識別子
+archive_magic = b"MCCANDLE"
+# ヘッダーのバイト数(識別子, レコードのバイト数, インデックスの間隔)
+header_size = 64
+header_format = "<8sII"
+# 疎なインデックスに記録する間隔(レコード数)
+default_index_stride = 4096
+
+# レコードの形式(settings/bigquery/schema/MARKET_PRICE_schema.jsonのCLOSE_TIME以外)
+record_dtype = np.dtype([
+    ("UNIX_TIME", "<i8"),
+    ("OPEN_PRICE", "<f8"),
+    ("HIGH_PRICE", "<f8"),
+    ("LOW_PRICE", "<f8"),
+    ("CLOSE_PRICE", "<f8"),
+    ("VOLUME", "<f8"),
+    ("QUOTE_VOLUME", "<f8"),
+])
+
+
+class CandleArchive:
+    """
+    ディレクトリ(root)配下の系列ごとのアーカイブを読み書きする
+    """
+
+    def __init__(self, root: str, index_stride: int = default_index_stride):
+        self.root = root
+        self.index_stride = index_stride
+        os.makedirs(root, exist_ok=True)
+
+    def tables(self):
+        """
+        アーカイブ済みの系列の一覧を返す
+        """
+        return sorted(
+            name[:-len(".candles")]
+            for name in os.listdir(self.root)
+            if name.endswith(".candles")
+        )
+
+    def append(self, table_name: str, df: pd.DataFrame):
+        """
+        アップロード形式のデータフレームの足を、アーカイブ済みの最新の足より後のもののみ追記する
+        追記専用のため、最新の足より前の足(欠損の補完など)は追記しない
+        追記した件数を返す
+        """
+        stride = self.open_for_append(table_name)
+        path = self.get_path(table_name)
+        count = self.count(table_name)
+        # 前回の追記が途中で中断していた場合に備え、追記前にインデックスを揃える
+        self.load_index(table_name, count, stride)
+
+        records = to_records(df)
+        if count > 0:
+            last_time = self.read_records(table_name, count - 1, count)[
+                "UNIX_TIME"
+            ][0]
+            records = records[records["UNIX_TIME"] > last_time]
+        if len(records) == 0:
+            return 0
+
+        with open(path, "ab") as f:
+            f.write(records.tobytes())
+
+        # 追記したレコードのうち、インデックスの間隔に当たるもののUNIX_TIMEを記録する
+        first = -(-count // stride) * stride
+        positions = np.arange(first, count + len(records), stride)
+        with open(self.get_index_path(table_name), "ab") as f:
+            f.write(records["UNIX_TIME"][positions - count].tobytes())
+
+        return len(records)
+
+    def read(self, table_name: str, start: int = None, end: int = None):
+        """
+        UNIX_TIMEがstart以上end未満の足を、ファイルを参照するレコードの配列で返す
+        (startまたはendを省略した場合は先頭または末尾まで)
+        """
+        if not os.path.exists(self.get_path(table_name)):
+            return np.empty(0, dtype=record_dtype)
+
+        stride = read_header(self.get_path(table_name))
+        count = self.count(table_name)
+        if count == 0:
+            return np.empty(0, dtype=record_dtype)
+
+        records = self.map_records(table_name, count)
+        index = self.load_index(table_name, count, stride)
+
+        lo = 0 if start is None else search(records, index, stride, start)
+        hi = count if end is None else search(records, index, stride, end)
+
+        return records[lo:max(lo, hi)]
+
+    def read_df(self, table_name: str, start: int = None, end: int = None):
+        """
+        UNIX_TIMEがstart以上end未満の足を、アップロード形式のデータフレームで返す
+        """
+        records = self.read(table_name, start, end)
+        df = pd.DataFrame(records)
+        df["CLOSE_TIME"] = pd.to_datetime(df["UNIX_TIME"], unit="s", utc=True)
+
+        return df
+
+    def count(self, table_name: str):
+        """
+        アーカイブ済みの足の件数を返す
+        """
+        size = os.path.getsize(self.get_path(table_name)) - header_size
+
+        return size // record_dtype.itemsize
+
+    def open_for_append(self, table_name: str):
+        """
+        追記するファイルを準備し、インデックスの間隔を返す
+        ファイルが無い場合はヘッダーを書き込み、
+        書き込み途中で中断したレコードがある場合は切り詰める
+        """
+        path = self.get_path(table_name)
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(create_header(self.index_stride))
+            open(self.get_index_path(table_name), "wb").close()
+            return self.index_stride
+
+        stride = read_header(path)
+        size = os.path.getsize(path) - header_size
+        if size % record_dtype.itemsize:
+            complete = size - size % record_dtype.itemsize
+            os.truncate(path, header_size + complete)
+
+        return stride
+
+    def load_index(self, table_name: str, count: int, stride: int):
+        """
+        疎なインデックス(stride件ごとのUNIX_TIME)を読み込む
+        レコードの件数と一致しない場合(追記の途中で中断した場合など)は作成し直す
+        """
+        index_path = self.get_index_path(table_name)
+        if os.path.exists(index_path):
+            index = np.fromfile(index_path, dtype="<i8")
+            if len(index) == -(-count // stride):
+                return index
+
+        index = np.empty(0, dtype="<i8")
+        if count > 0:
+            records = self.map_records(table_name, count)
+            index = np.ascontiguousarray(records["UNIX_TIME"][::stride])
+        index.tofile(index_path)
+
+        return index
+
+    def map_records(self, table_name: str, count: int):
+        """
+        ファイルのレコードをメモリマップした配列を返す
+        """
+        return np.memmap(
+            self.get_path(table_name),
+            dtype=record_dtype,
+            mode="r",
+            offset=header_size,
+            shape=(count,)
+        )
+
+    def read_records(self, table_name: str, lo: int, hi: int):
+        """
+        lo番目からhi番目の前までのレコードを読み込む
+        """
+        with open(self.get_path(table_name), "rb") as f:
+            f.seek(header_size + lo * record_dtype.itemsize)
+            return np.fromfile(f, dtype=record_dtype, count=hi - lo)
+
+    def get_path(self, table_name: str):
+        return os.path.join(self.root, f"{table_name}.candles")
+
+    def get_index_path(self, table_name: str):
+        return os.path.join(self.root, f"{table_name}.index")
+
+
+def search(records: np.ndarray, index: np.ndarray, stride: int, time: int):
+    """
+    UNIX_TIMEがtime以上となる最初のレコードの位置を返す
+    疎なインデックスで区間を絞り込み、区間内のUNIX_TIMEのみを二分探索する
+    """
+    block = int(np.searchsorted(index, time, side="left"))
+    lo = max(block - 1, 0) * stride
+    hi = min(block * stride, len(records))
+    if hi <= lo:
+        return lo
+
+    times = records["UNIX_TIME"][lo:hi]
+
+    return lo + int(np.searchsorted(times, time, side="left"))
+
+
+def to_records(df: pd.DataFrame):
+    """
+    アップロード形式のデータフレームを、UNIX_TIMEの昇順で重複の無いレコードの配列に変換する
+    (同じUNIX_TIMEの足は後のものを使う)
+    """
+    records = np.empty(len(df), dtype=record_dtype)
+    for name in record_dtype.names:
+        if name in df:
+            records[name] = df[name].to_numpy(dtype=record_dtype[name])
+        else:
+            records[name] = 0
+
+    times = records["UNIX_TIME"]
+    if len(times) > 1 and not (np.diff(times) > 0).all():
+        # 逆順に並べてから重複を除くことで、同じUNIX_TIMEの後の足を残す
+        _, positions = np.unique(times[::-1], return_index=True)
+        records = records[len(times) - 1 - positions]
+
+    return records
+
+
+def create_header(index_stride: int):
+    header = struct.pack(
+        header_format, archive_magic, record_dtype.itemsize, index_stride
+    )
+    return header.ljust(header_size, b"\0")
+
+
+def read_header(path: str):
+    """
+    ヘッダーを検証し、インデックスの間隔を返す
+    """
+    with open(path, "rb") as f:
+        header = f.read(header_size)
+
+    magic, itemsize, index_stride = struct.unpack_from(header_format, header)
+    if magic != archive_magic or itemsize != record_dtype.itemsize:
+        raise Exception(f"invalid candle archive: {path}")
+
+    return index_stride
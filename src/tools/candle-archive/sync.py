@@ -0,0 +1,99 @@
+"""
+collectorがGCSへアップロードした金融データを、ローカルの足のアーカイブへ追記する
+
+collectorが実行ごとにアップロードするファイルの一覧(<dataset>/_runs/YYYYMMDD_HHh/<function>.json)を
+古い順に読み込み、一覧のファイル(csv or parquet)を系列(<ticker>_<period>)ごとのアーカイブへ追記する。
+追記済みのファイルの一覧は<archive>/_synced.jsonに記録し、次回以降は追記しない。
+
+実行方法(リポジトリのルートで実行する)
+    pip install -r src/tools/candle-archive/requirements.txt
+    python src/tools/candle-archive/sync.py --bucket <MARKET_DATA_BUCKET> \
+        --dataset <BIGQUERY_DATASET> --archive ./candles
+"""
+import argparse
+import json
+import os
+from io import BytesIO
+import pandas as pd
+from archive import CandleArchive
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bucket", required=True)
+    parser.add_argument("--dataset", required=True)
+    parser.add_argument("--archive", required=True)
+    # この実行日時(YYYYMMDD_HHh)以降のファイルのみ追記する
+    parser.add_argument("--since")
+    args = parser.parse_args()
+
+    from google.cloud.storage import Client as StorageClient
+
+    bucket = StorageClient().bucket(args.bucket)
+    archive = CandleArchive(args.archive)
+
+    appended = sync(bucket, args.dataset, archive, args.since)
+    for table_name, rows in sorted(appended.items()):
+        print(f"{table_name:<24} {rows:>10,} rows")
+
+
+def sync(bucket, dataset: str, archive: CandleArchive, since: str = None):
+    """
+    未追記の実行単位のファイル一覧を古い順に読み込み、一覧のファイルをアーカイブへ追記する
+    系列ごとの追記した件数を返す
+    """
+    state_path = os.path.join(archive.root, "_synced.json")
+    synced = set()
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            synced = set(json.load(f))
+
+    prefix = f"{dataset}/_runs/"
+    manifests = sorted(
+        blob.name for blob in bucket.list_blobs(prefix=prefix)
+        if blob.name not in synced
+        and (since is None or blob.name[len(prefix):] >= since)
+    )
+
+    appended = {}
+    for manifest in manifests:
+        files = json.loads(bucket.blob(manifest).download_as_bytes())["files"]
+        for gcs_path in files:
+            table_name = get_table_name(gcs_path)
+            df = read_market_file(gcs_path, bucket.blob(gcs_path))
+            appended[table_name] = (
+                appended.get(table_name, 0)
+                + archive.append(table_name, df)
+            )
+
+        # ファイルの一覧ごとに記録し、中断した場合も追記済みの一覧は再度追記しない
+        synced.add(manifest)
+        with open(state_path, "w") as f:
+            json.dump(sorted(synced), f)
+
+    return appended
+
+
+def read_market_file(gcs_path: str, blob):
+    """
+    collectorがアップロードしたファイルを、アップロード形式のデータフレームで返す
+    """
+    data = BytesIO(blob.download_as_bytes())
+    if gcs_path.endswith(".parquet"):
+        return pd.read_parquet(data)
+
+    return pd.read_csv(data)
+
+
+def get_table_name(gcs_path: str):
+    # gcs_path: <dataset>/<ticker>/YYYYMMDD_HHh/<period>.<csv|parquet>
+    # table_name: <ticker>_<period>
+    split_slash = gcs_path.split("/")
+    ticker = split_slash[1]
+    period = split_slash[-1].split(".")[0]
+
+    return f"{ticker}_{period}"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+"""
+collectorの共通モジュール(src/shared)とcrypto-collectorのモジュールを、デプロイ時と同様に読み込めるようにする
+
+実行方法(リポジトリのルートで実行する)
+    pip install -r src/functions/crypto-collector/requirements.txt \
+        -r src/functions/stock-collector/requirements.txt pytest
+    python -m pytest tests
+"""
+import os
+import sys
+
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in (
+    os.path.join(root_dir, "src", "shared"),
+    os.path.join(root_dir, "src", "functions", "crypto-collector"),
+):
+    if path not in sys.path:
+        sys.path.insert(0, path)
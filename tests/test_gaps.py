@@ -0,0 +1,243 @@
+"""
+欠損の検出・補完(src/shared/pipeline.py)のテスト
+"""
+import numpy as np
+from pipeline import (
+    Source,
+    add_gaps,
+    apply_repair,
+    find_gaps,
+    find_missing,
+    gap_repair_attempts
+)
+
+
+# 1分足・日足の区切りとなる時刻(2023-11-14 00:00 UTC)
+base_time = 1699920000
+
+
+class StubSource(Source):
+    """
+    取引時間外の期間を指定できる取得元
+    """
+
+    function_name = "test-collector"
+    bar_seconds = {"1M": 60, "1D": 86400}
+
+    def __init__(self, session_breaks=()):
+        self.session_breaks = list(session_breaks)
+
+    def is_session_break(self, period: str, start: int, end: int):
+        return (period, start, end) in self.session_breaks
+
+
+def minutes(*indexes):
+    return np.array([base_time + i * 60 for i in indexes], dtype="int64")
+
+
+def test_find_gaps_detects_missing_bars():
+    times = minutes(0, 1, 4, 5, 7)
+
+    assert find_gaps(StubSource(), "1M", times, 0) == [
+        (base_time + 120, base_time + 180),
+        (base_time + 360, base_time + 360)
+    ]
+
+
+def test_find_gaps_checks_previous_run():
+    # 前回取得分の最後の足(previous)から今回の先頭までの欠損も検出する
+    previous = base_time - 180
+    times = minutes(0, 1)
+
+    assert find_gaps(StubSource(), "1M", times, previous) == [
+        (base_time - 120, base_time - 60)
+    ]
+    # 未取得(previous=0)の場合、先頭より前は検出しない
+    assert find_gaps(StubSource(), "1M", times, 0) == []
+
+
+def test_find_gaps_tolerates_dst_shift():
+    # 夏時間により日足の開始時刻が1時間ずれても欠損としない
+    day = 86400
+    times = np.array(
+        [base_time, base_time + day, base_time + day * 2 + 3600],
+        dtype="int64"
+    )
+
+    assert find_gaps(StubSource(), "1D", times, 0) == []
+
+    # 1日分空いた場合は、ずれがあっても欠損とする
+    times = np.array(
+        [base_time, base_time + day * 2 + 3600], dtype="int64"
+    )
+    assert find_gaps(StubSource(), "1D", times, 0) == [
+        (base_time + day, base_time + day)
+    ]
+
+
+def test_find_gaps_skips_session_breaks():
+    source = StubSource([("1M", base_time + 60, base_time + 120)])
+    times = minutes(0, 3, 5)
+
+    assert find_gaps(source, "1M", times, 0) == [
+        (base_time + 240, base_time + 240)
+    ]
+
+
+def test_find_gaps_ignores_unknown_period_and_empty_times():
+    assert find_gaps(StubSource(), "1W", minutes(0, 5), 0) == []
+    assert find_gaps(
+        StubSource(), "1M", np.array([], dtype="int64"), base_time
+    ) == []
+
+
+def test_find_missing_groups_consecutive_bars():
+    times = minutes(1, 2, 5)
+
+    assert find_missing(
+        StubSource(), "1M", base_time, base_time + 360, times, 60
+    ) == [
+        (base_time, base_time),
+        (base_time + 180, base_time + 240),
+        (base_time + 360, base_time + 360)
+    ]
+
+
+def test_find_missing_without_filled_bars():
+    empty = np.array([], dtype="int64")
+
+    assert find_missing(
+        StubSource(), "1M", base_time, base_time + 120, empty, 60
+    ) == [(base_time, base_time + 120)]
+
+
+def test_find_missing_tolerates_dst_shift():
+    day = 86400
+    # 補完で取得した日足が夏時間により1時間ずれている
+    times = np.array(
+        [base_time + 3600, base_time + day + 3600], dtype="int64"
+    )
+
+    assert find_missing(
+        StubSource(), "1D", base_time, base_time + day * 2, times, day
+    ) == [(base_time + day * 2, base_time + day * 2)]
+
+
+def test_find_missing_skips_session_breaks():
+    source = StubSource([("1M", base_time + 60, base_time + 60)])
+    times = minutes(0, 2)
+
+    assert find_missing(
+        source, "1M", base_time, base_time + 180, times, 60
+    ) == [(base_time + 180, base_time + 180)]
+
+
+def test_add_gaps_skips_recorded_gaps():
+    index = {
+        "BTCUSD_1M": {
+            "table_ticker": "BTCUSD",
+            "period": "1M",
+            "gaps": [[base_time, base_time + 60, 1]]
+        }
+    }
+    detected = {
+        "BTCUSD_1M": {
+            "table_ticker": "BTCUSD",
+            "period": "1M",
+            "gaps": [
+                [base_time, base_time + 60, 0],
+                [base_time + 300, base_time + 300, 0]
+            ]
+        },
+        "ETHUSD_1M": {
+            "table_ticker": "ETHUSD",
+            "period": "1M",
+            "gaps": [[base_time, base_time, 0]]
+        }
+    }
+
+    index = add_gaps(index, detected)
+
+    # 記録済みの欠損は試行回数を保ったまま残す
+    assert index["BTCUSD_1M"]["gaps"] == [
+        [base_time, base_time + 60, 1],
+        [base_time + 300, base_time + 300, 0]
+    ]
+    assert index["ETHUSD_1M"] == {
+        "table_ticker": "ETHUSD",
+        "period": "1M",
+        "gaps": [[base_time, base_time, 0]]
+    }
+
+
+def create_index(*gaps):
+    return {
+        "BTCUSD_1M": {
+            "table_ticker": "BTCUSD",
+            "period": "1M",
+            "gaps": [list(gap) for gap in gaps]
+        }
+    }
+
+
+def test_apply_repair_keeps_unfilled_bars():
+    gap = [base_time, base_time + 240, 0]
+    index = create_index(gap)
+    entries = create_index(gap)
+    filled = {"BTCUSD_1M": minutes(0, 1, 3)}
+    unrepaired = []
+
+    index = apply_repair(StubSource(), index, entries, filled, unrepaired)
+
+    # 補完できなかった足の期間に置き換え、試行回数を加算する
+    assert index["BTCUSD_1M"]["gaps"] == [
+        [base_time + 120, base_time + 120, 1],
+        [base_time + 240, base_time + 240, 1]
+    ]
+    assert unrepaired == []
+
+
+def test_apply_repair_gives_up_after_attempts():
+    gap = [base_time, base_time + 60, gap_repair_attempts - 1]
+    index = create_index(gap)
+    entries = create_index(gap)
+    unrepaired = []
+
+    index = apply_repair(StubSource(), index, entries, {}, unrepaired)
+
+    # 試行回数が上限に達した欠損は欠損インデックスから除く
+    assert index == {}
+    assert unrepaired == [["BTCUSD_1M", base_time, base_time + 60]]
+
+
+def test_apply_repair_removes_filled_tables():
+    gap = [base_time, base_time + 60, 0]
+    index = create_index(gap)
+    entries = create_index(gap)
+    filled = {"BTCUSD_1M": minutes(0, 1)}
+
+    assert apply_repair(StubSource(), index, entries, filled, []) == {}
+
+
+def test_apply_repair_keeps_concurrently_added_gaps():
+    attempted = [base_time, base_time + 60, 0]
+    added = [base_time + 600, base_time + 600, 0]
+    # 補完の開始後に他の実行で欠損が追加された
+    index = create_index(attempted, added)
+    entries = create_index(attempted)
+    filled = {"BTCUSD_1M": minutes(0, 1)}
+
+    index = apply_repair(StubSource(), index, entries, filled, [])
+
+    assert index["BTCUSD_1M"]["gaps"] == [added]
+
+
+def test_apply_repair_skips_removed_tables():
+    # 補完の開始後に他の実行で欠損インデックスから除かれた系列は戻さない
+    entries = create_index([base_time, base_time + 60, 0])
+    unrepaired = [["STALE_1M", base_time, base_time]]
+
+    index = apply_repair(StubSource(), {}, entries, {}, unrepaired)
+
+    assert index == {}
+    assert unrepaired == []
@@ -0,0 +1,266 @@
+"""
+1分足からの上位の時間足の生成(src/functions/crypto-collector/resample.py)のテスト
+"""
+import numpy as np
+import main
+from candles import CandleBatch
+from resample import resample_candles
+from runreport import RunReport
+
+
+# 5分足・3分足の区切りとなる時刻(2023-11-14 00:00 UTC)
+base_time = 1699920000
+
+
+def minutes(first, last, volume=1.0):
+    """
+    first〜last本目の1分足(始値は何本目か、出来高はvolume)を返す
+    """
+    indexes = np.arange(first, last + 1)
+    return CandleBatch(
+        base_time + indexes * 60,
+        indexes,
+        indexes + 0.5,
+        indexes - 0.5,
+        indexes + 0.25,
+        np.full(len(indexes), volume)
+    )
+
+
+def to_rows(candles: CandleBatch):
+    return list(zip(
+        candles.times.tolist(),
+        candles.opens.tolist(),
+        candles.highs.tolist(),
+        candles.lows.tolist(),
+        candles.closes.tolist(),
+        candles.volumes.tolist()
+    ))
+
+
+def test_carries_partial_candle_to_next_run():
+    candles, state = resample_candles(minutes(0, 6), 300)
+
+    assert to_rows(candles) == [(base_time, 0, 4.5, -0.5, 4.25, 5)]
+    assert state == {
+        "last": base_time + 360,
+        "start": base_time + 300,
+        "open": 5.0,
+        "high": 6.5,
+        "low": 4.5,
+        "close": 6.25,
+        "volume": 2.0
+    }
+
+    candles, state = resample_candles(minutes(7, 11), 300, state, base_time)
+
+    # 前回確定しなかった足は、前回までの集計値と合算して確定する
+    assert to_rows(candles) == [(base_time + 300, 5, 9.5, 4.5, 9.25, 5)]
+    assert state["last"] == base_time + 660
+    assert state["start"] == base_time + 600
+    assert state["volume"] == 2.0
+
+
+def test_refetched_candles_are_not_counted_twice():
+    _, state = resample_candles(minutes(0, 6), 300)
+
+    # 集計状態の保存後に1分足のunixtimeの保存に失敗し、集計済みの1分足(5〜6本目)から再取得した
+    candles, state = resample_candles(minutes(5, 11), 300, state, base_time)
+
+    assert to_rows(candles) == [(base_time + 300, 5, 9.5, 4.5, 9.25, 5)]
+    assert state["volume"] == 2.0
+
+
+def test_completed_candle_is_not_emitted_again():
+    candles, state = resample_candles(minutes(0, 4), 300)
+
+    assert to_rows(candles) == [(base_time, 0, 4.5, -0.5, 4.25, 5)]
+    # 末尾の足が確定した場合も、集計した最後の1分足は持ち越す
+    assert state == {"last": base_time + 240}
+
+    # 上位の時間足のunixtimeの保存にも失敗した場合、確定済みの足を再度集計しない
+    candles, state = resample_candles(minutes(0, 9), 300, state, 0)
+
+    assert to_rows(candles) == [(base_time + 300, 5, 9.5, 4.5, 9.25, 5)]
+    assert state == {"last": base_time + 540}
+
+
+def test_no_new_candles_keeps_state():
+    _, state = resample_candles(minutes(0, 6), 300)
+
+    candles, next_state = resample_candles(
+        minutes(0, 6), 300, state, base_time
+    )
+
+    assert len(candles) == 0
+    assert next_state == state
+
+
+def test_state_without_last():
+    # 集計済みの最後の1分足を持たない以前の形式の集計状態
+    state = {
+        "start": base_time + 300,
+        "open": 5.0,
+        "high": 6.5,
+        "low": 4.5,
+        "close": 6.25,
+        "volume": 2.0
+    }
+
+    candles, state = resample_candles(minutes(7, 11), 300, state, base_time)
+
+    assert to_rows(candles) == [(base_time + 300, 5, 9.5, 4.5, 9.25, 5)]
+    assert state["last"] == base_time + 660
+
+
+def test_skips_incomplete_first_candle():
+    # 前回までの集計値が無く、足の途中からしか1分足が無い足は生成しない
+    candles, state = resample_candles(minutes(2, 10), 300)
+
+    assert candles.times.tolist() == [base_time + 300]
+    assert state["start"] == base_time + 600
+
+
+def test_skips_incomplete_first_candle_after_watermark():
+    # 集計状態を失った(もしくは初めて生成する)場合、取得済みの足の直後の足でも途中からしか1分足が無ければ生成しない
+    candles, state = resample_candles(
+        minutes(3, 11), 300, None, base_time - 300
+    )
+
+    assert to_rows(candles) == [(base_time + 300, 5, 9.5, 4.5, 9.25, 5)]
+    assert state["start"] == base_time + 600
+
+
+def test_keeps_first_candle_continuing_folded_candles():
+    # 末尾の足が確定した後、1分足が途切れずに続く場合は、足の途中から始まっても生成する
+    state = {"last": base_time + 120}
+
+    candles, state = resample_candles(minutes(3, 9), 300, state, 0)
+
+    assert to_rows(candles) == [
+        (base_time, 3, 4.5, 2.5, 4.25, 2),
+        (base_time + 300, 5, 9.5, 4.5, 9.25, 5)
+    ]
+
+
+def transform(source, target_unixtime, candles):
+    ticker = main.tickers[0]
+    target = (
+        ticker, main.periods[0], f"{ticker['table']}_1M", target_unixtime
+    )
+    outputs = source.transform(target, candles, RunReport("test", False))
+    return {output["table_name"]: output["df"] for output in outputs}
+
+
+def create_source(monkeypatch):
+    monkeypatch.setattr(main, "resample_mode", True)
+    monkeypatch.setattr(main, "resample_periods", [
+        {"name": "3M", "seconds": 180},
+        {"name": "5M", "seconds": 300}
+    ])
+
+    source = main.CryptoSource()
+    # 前回の実行で5分足(50〜54本目の1分足)の途中の52本目まで集計した
+    source.resample_state = {
+        "BTCUSD_5M": {
+            "last": base_time + 52 * 60,
+            "start": base_time + 50 * 60,
+            "open": 50.0,
+            "high": 52.5,
+            "low": 49.5,
+            "close": 52.25,
+            "volume": 100.0
+        }
+    }
+    source.unixtimes = {
+        "BTCUSD_1M": base_time + 52 * 60,
+        "BTCUSD_5M": base_time + 45 * 60
+    }
+    return source
+
+
+def test_transform_merges_partial_candle(monkeypatch):
+    source = create_source(monkeypatch)
+
+    # 末尾の足(未来日の足)は除かれる
+    outputs = transform(source, base_time + 52 * 60, minutes(53, 60))
+
+    df = outputs["BTCUSD_5M"]
+    assert df["UNIX_TIME"].tolist() == [
+        base_time + 50 * 60, base_time + 55 * 60
+    ]
+    assert df["VOLUME"].tolist() == [102, 5]
+    assert source.resample_state["BTCUSD_5M"]["last"] == base_time + 59 * 60
+    assert "BTCUSD_3M" in outputs
+
+
+def test_transform_drops_partial_candle_on_overflow(monkeypatch):
+    source = create_source(monkeypatch)
+    overflow_start = 120
+
+    # 前回取得分から720件を超えて空き、途中の1分足が欠落した
+    candles = minutes(
+        overflow_start, overflow_start + main.kraken_max_candles
+    )
+    outputs = transform(source, base_time + 52 * 60, candles)
+
+    # 前回の未確定の足は、欠落した1分足を含むため使用しない
+    df = outputs["BTCUSD_5M"]
+    assert df["UNIX_TIME"].iloc[0] == base_time + overflow_start * 60
+    assert (df["VOLUME"] == 5).all()
+    assert source.resample_state["BTCUSD_5M"]["last"] == (
+        base_time + (overflow_start + main.kraken_max_candles - 1) * 60
+    )
+
+
+def test_targets_fetch_history_of_new_tables(monkeypatch):
+    source = create_source(monkeypatch)
+    monkeypatch.setattr(main, "load_manifest", lambda path: (None, 0))
+    unixtimes = {
+        f"{ticker['table']}_{period['name']}": base_time
+        for ticker in main.tickers
+        for period in main.periods
+    }
+    del unixtimes["BTCUSD_1D"]
+
+    targets = source.targets(unixtimes, {"index": 0, "count": 1})
+
+    # 取得履歴の無い時間足のみ、1分足より先にkraken APIから取得する
+    assert [target[2] for target in targets] == [
+        "BTCUSD_1D", "BTCUSD_1M", "ETHBTC_1M"
+    ]
+    assert targets[0][3] == 0
+
+
+def test_transform_joins_history_of_new_table(monkeypatch):
+    source = create_source(monkeypatch)
+    source.resample_state = {}
+    source.unixtimes = {"BTCUSD_1M": base_time + 52 * 60}
+    ticker = main.tickers[0]
+    period_5m = next(
+        period for period in main.periods if period["name"] == "5M"
+    )
+
+    # kraken APIから取得した5分足(末尾の未確定の足を含む)
+    history = CandleBatch(
+        base_time + np.arange(0, 60, 5) * 60,
+        np.zeros(12),
+        np.ones(12),
+        np.zeros(12),
+        np.ones(12),
+        np.full(12, 7.0)
+    )
+    assert source.transform(
+        (ticker, period_5m, "BTCUSD_5M", 0), history,
+        RunReport("test", False)
+    ) == []
+
+    outputs = transform(source, base_time + 52 * 60, minutes(53, 61))
+
+    # 1分足から生成した足より前の足は、kraken APIから取得した足で補う
+    df = outputs["BTCUSD_5M"]
+    assert df["UNIX_TIME"].tolist() == [
+        base_time + i * 60 for i in range(0, 60, 5)
+    ]
+    assert df["VOLUME"].tolist() == [7.0] * 11 + [5.0]
+    assert source.backfill == {}
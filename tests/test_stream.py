@@ -0,0 +1,88 @@
+"""
+ストリーミング収集(src/functions/crypto-collector/stream.py)のテスト
+"""
+import asyncio
+import pytest
+import stream
+
+
+# 1分足の区切りとなる時刻(2023-11-14 00:00 UTC)
+base_time = 1699920000
+
+
+def bar(i):
+    return (i, i + 0.5, i - 0.5, i + 0.25, 1.0)
+
+
+def create_stream(monkeypatch, manifest: dict):
+    """
+    最新unixtime管理用マニフェスト(manifest)とアップロード先をメモリ上の代替へ差し替えた、
+    CryptoStreamとアップロードした足の一覧を返す
+    """
+    uploaded = []
+
+    def save_unixtime_manifest(name, unixtimes, updated, generation, _):
+        manifest.update(updated)
+        return dict(manifest), generation + 1
+
+    def upload_output(output, execTime, report):
+        uploaded.append((
+            output["table_name"], output["df"]["UNIX_TIME"].tolist()
+        ))
+        return f"{output['table_name']}/{execTime}"
+
+    monkeypatch.setattr(
+        stream, "load_recently_unixtime", lambda name: (dict(manifest), 1)
+    )
+    monkeypatch.setattr(
+        stream, "save_unixtime_manifest", save_unixtime_manifest
+    )
+    monkeypatch.setattr(stream, "upload_output", upload_output)
+    monkeypatch.setattr(stream, "upload_run_manifest", lambda *args: None)
+    monkeypatch.setattr(stream, "stream_bigquery_seconds", 3600)
+
+    return stream.CryptoStream(dict(manifest), 1), uploaded
+
+
+def flush_minutes(crypto_stream, *indexes):
+    for i in indexes:
+        crypto_stream.buffer.update("BTCUSD_1M", base_time + i * 60, bar(i))
+    asyncio.run(crypto_stream.flush(base_time + 3600))
+
+
+def test_skips_bars_uploaded_by_collector(monkeypatch):
+    manifest = {"BTCUSD_1M": base_time}
+    crypto_stream, uploaded = create_stream(monkeypatch, manifest)
+
+    flush_minutes(crypto_stream, 1, 2)
+    assert uploaded == [("BTCUSD_1M", [base_time + 60, base_time + 120])]
+
+    # 定期実行のcrypto-collectorが、前回のアップロード後に4本目の足までアップロードした
+    manifest["BTCUSD_1M"] = base_time + 240
+    flush_minutes(crypto_stream, 3, 4, 5)
+
+    assert uploaded[1:] == [("BTCUSD_1M", [base_time + 300])]
+    assert manifest["BTCUSD_1M"] == base_time + 300
+
+
+def test_drops_buffered_bars_uploaded_by_collector(monkeypatch):
+    manifest = {"BTCUSD_1M": base_time}
+    crypto_stream, uploaded = create_stream(monkeypatch, manifest)
+    crypto_stream.buffer.update("BTCUSD_1M", base_time + 60, bar(1))
+    manifest["BTCUSD_1M"] = base_time + 600
+
+    # 全ての足がアップロード済みの場合はアップロードしない
+    asyncio.run(crypto_stream.flush(base_time + 3600))
+    assert uploaded == []
+
+    # 最新unixtimeの取得後は、アップロード済みの足の更新を受け付けない
+    crypto_stream.buffer.update("BTCUSD_1M", base_time + 600, bar(10))
+    crypto_stream.buffer.update("BTCUSD_1M", base_time + 660, bar(11))
+    assert list(crypto_stream.buffer.bars["BTCUSD_1M"]) == [base_time + 660]
+
+
+def test_refuses_resample_mode(monkeypatch):
+    monkeypatch.setattr(stream, "resample_mode", True)
+
+    with pytest.raises(Exception, match="CRYPTO_RESAMPLE_MODE"):
+        asyncio.run(stream.run_stream("ws://localhost", asyncio.Event()))